@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import json
 import logging
 import os
 import uuid
@@ -14,8 +13,9 @@ from fastapi.responses import StreamingResponse
 from backend.database.mongo_manager import get_mongo_manager
 from backend.services.chat_stream_service import ChatStreamService
 from backend.services.memory_summary_service import MemorySummaryService
+from backend.utils.json_utils import sse_data_frame
 from backend.utils.snowflake import generate_snowflake_id
-from backend.services.checkpoint_service import CheckpointService
+from backend.services.checkpoint_service import get_checkpoint_service
 from backend.services.session_cancel_service import get_session_cancel_service
 from backend.services.stream_session_manager import get_stream_session_manager
 
@@ -131,7 +131,7 @@ async def delete_chat_session(session_id: str, assistant_id: str = "agent") -> d
         raise HTTPException(status_code=500, detail=str(exc) or "failed to delete mongo session") from exc
 
     try:
-        checkpoint_service = CheckpointService()
+        checkpoint_service = get_checkpoint_service()
         ck = await checkpoint_service.delete_session(session_id=session_id)
     except Exception as exc:  # noqa: BLE001
         raise HTTPException(status_code=500, detail=str(exc) or "failed to delete checkpoints") from exc
@@ -302,7 +302,7 @@ async def chat_stream_sse(payload: dict[str, Any]) -> StreamingResponse:
     # SSE 响应从 buffer 消费，客户端断连只影响这个 generator
     async def event_generator():
         async for event in manager.subscribe(session_id, from_index=0):
-            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            yield sse_data_frame(event)
 
     return StreamingResponse(
         event_generator(),
@@ -342,7 +342,7 @@ async def chat_stream_resume(session_id: str, from_index: int = 0) -> StreamingR
 
     async def event_generator():
         async for event in manager.subscribe(session_id, from_index=from_index):
-            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            yield sse_data_frame(event)
 
     return StreamingResponse(
         event_generator(),
@@ -1,9 +1,9 @@
 from __future__ import annotations
 
 import logging
-import json
 import queue
 import threading
+import time
 from pathlib import Path
 from typing import Any, Callable
 
@@ -12,6 +12,7 @@ from fastapi.responses import StreamingResponse
 
 from backend.services.creative_agent_service import CreativeAppError
 from backend.services.creative_state_machine_service import CreativeStateMachineService
+from backend.utils.json_utils import sse_data_frame
 from backend.utils.snowflake import generate_snowflake_id
 
 
@@ -22,6 +23,10 @@ logger = logging.getLogger(__name__)
 # 项目根目录：deepagents-webapp/
 BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent
 
+# 关键逻辑：chunk 合并下发阈值（字符数 / 时间间隔，任一满足即 flush），与对话流的 chat.delta 合并策略一致
+_CHUNK_FLUSH_CHARS = 32
+_CHUNK_FLUSH_SECONDS = 0.02
+
 
 def _service() -> CreativeStateMachineService:
     return CreativeStateMachineService(workspace_root=BASE_DIR)
@@ -33,8 +38,8 @@ def _raise_creative_http_error(exc: Exception) -> None:
     raise HTTPException(status_code=500, detail={"code": "CREATIVE_INTERNAL_ERROR", "message": str(exc)}) from exc
 
 
-def _sse_event(payload: dict[str, Any]) -> str:
-    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+def _sse_event(payload: dict[str, Any]) -> bytes:
+    return sse_data_frame(payload)
 
 
 def _creative_sse_response(
@@ -46,17 +51,55 @@ def _creative_sse_response(
 ) -> StreamingResponse:
     out_queue: queue.Queue[dict[str, Any] | object] = queue.Queue()
     sentinel = object()
+    # 说明：缓冲从空变为非空、且没有立即下发时投递的唤醒标记；SSE 消费端据此设置 flush 截止时间
+    pending_marker = object()
+
+    # 说明：worker 线程追加、SSE 消费线程按超时 flush，合并缓冲用锁保护；入队也在锁内，保证帧顺序
+    buffer_lock = threading.Lock()
+    pending_chunks: list[str] = []
+    pending_chars = 0
+    last_flush = time.monotonic()
+    first_chunk_sent = False
+
+    def flush_chunks() -> None:
+        nonlocal pending_chars, last_flush
+        with buffer_lock:
+            last_flush = time.monotonic()
+            if not pending_chunks:
+                return
+            out_queue.put({"type": "chunk", "stage": stage, "text": "".join(pending_chunks)})
+            pending_chunks.clear()
+            pending_chars = 0
 
     def emit_chunk(text: str) -> None:
+        nonlocal pending_chars, first_chunk_sent
         chunk = str(text or "")
-        if chunk:
-            out_queue.put({"type": "chunk", "stage": stage, "text": chunk})
+        if not chunk:
+            return
+        with buffer_lock:
+            was_empty = not pending_chunks
+            pending_chunks.append(chunk)
+            pending_chars += len(chunk)
+            # 说明：首个 chunk 立即下发，不让合并窗口拖慢首字时间；之后逐 token 的小片段合并成一帧
+            should_flush = (
+                not first_chunk_sent
+                or pending_chars >= _CHUNK_FLUSH_CHARS
+                or time.monotonic() - last_flush >= _CHUNK_FLUSH_SECONDS
+            )
+            if not should_flush:
+                if was_empty:
+                    out_queue.put(pending_marker)
+                return
+            first_chunk_sent = True
+        flush_chunks()
 
     def run_worker() -> None:
         try:
             done_run = worker(emit_chunk)
+            flush_chunks()
             out_queue.put({"type": "done", "run": done_run})
         except Exception as exc:  # noqa: BLE001
+            flush_chunks()
             logger.exception("creative sse worker failed | stage=%s | run_id=%s", stage, ack_run.get("run_id"))
             err = str(exc)
             try:
@@ -83,11 +126,26 @@ def _creative_sse_response(
 
     def event_iter():
         yield _sse_event({"type": "ack", "run": ack_run})
+        # 关键逻辑：缓冲里有未下发的文本时最多等 _CHUNK_FLUSH_SECONDS，到期由消费端主动 flush；
+        # 避免 worker 随后进入长时间的工具调用/阶段切换时，已生成的文本一直卡在缓冲里
+        flush_deadline: float | None = None
         while True:
-            item = out_queue.get()
+            timeout = None if flush_deadline is None else max(flush_deadline - time.monotonic(), 0.0)
+            try:
+                item = out_queue.get(timeout=timeout)
+            except queue.Empty:
+                flush_deadline = None
+                flush_chunks()
+                continue
             if item is sentinel:
                 break
+            if item is pending_marker:
+                flush_deadline = time.monotonic() + _CHUNK_FLUSH_SECONDS
+                continue
             if isinstance(item, dict):
+                if item.get("type") == "chunk":
+                    # 说明：缓冲刚被清空；之后再有文本入缓冲会重新投递唤醒标记
+                    flush_deadline = None
                 yield _sse_event(item)
 
     return StreamingResponse(
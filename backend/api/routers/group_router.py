@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import json
 import logging
 import re
 from pathlib import Path
@@ -11,6 +10,7 @@ from fastapi.responses import StreamingResponse
 
 from backend.services.chat_stream_service import ChatStreamService
 from backend.services.group_chat_service import GroupChatService
+from backend.utils.json_utils import sse_data_frame
 from backend.utils.snowflake import generate_snowflake_id
 
 
@@ -111,11 +111,11 @@ async def group_chat_stream_sse(payload: dict[str, Any]) -> StreamingResponse:
 
     async def event_generator():
         start_event = {"type": "session.status", "status": "thinking", "session_id": session_id}
-        yield f"data: {json.dumps(start_event, ensure_ascii=False)}\n\n"
+        yield sse_data_frame(start_event)
 
         if not queue:
             done_event = {"type": "session.status", "status": "done", "session_id": session_id}
-            yield f"data: {json.dumps(done_event, ensure_ascii=False)}\n\n"
+            yield sse_data_frame(done_event)
             return
 
         prior_replies: list[dict[str, str]] = []
@@ -133,7 +133,7 @@ async def group_chat_stream_sse(payload: dict[str, Any]) -> StreamingResponse:
                 "queue_total": total,
                 "session_id": session_id,
             }
-            yield f"data: {json.dumps(character_event, ensure_ascii=False)}\n\n"
+            yield sse_data_frame(character_event)
 
             prompt = group_svc.build_group_prompt(
                 user_text=text,
@@ -178,7 +178,7 @@ async def group_chat_stream_sse(payload: dict[str, Any]) -> StreamingResponse:
                         assistant_chunks.append(clean_text)
 
                     event["session_id"] = session_id
-                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                    yield sse_data_frame(event)
             except Exception as exc:  # noqa: BLE001
                 logger.exception("group chat speaker failed | session_id=%s | speaker=%s", session_id, speaker)
                 err = {
@@ -186,7 +186,7 @@ async def group_chat_stream_sse(payload: dict[str, Any]) -> StreamingResponse:
                     "message": f"{speaker.get('speaker_name') or '角色'} 发言失败：{str(exc) or 'unknown'}",
                     "session_id": session_id,
                 }
-                yield f"data: {json.dumps(err, ensure_ascii=False)}\n\n"
+                yield sse_data_frame(err)
 
             reply_text = "".join(assistant_chunks).strip()
             if reply_text:
@@ -198,7 +198,7 @@ async def group_chat_stream_sse(payload: dict[str, Any]) -> StreamingResponse:
                 )
 
         done_event = {"type": "session.status", "status": "done", "session_id": session_id}
-        yield f"data: {json.dumps(done_event, ensure_ascii=False)}\n\n"
+        yield sse_data_frame(done_event)
 
     return StreamingResponse(
         event_generator(),
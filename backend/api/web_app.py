@@ -3,6 +3,8 @@ from __future__ import annotations
 from dotenv import load_dotenv
 load_dotenv()  # 加载 .env 环境变量，必须在其他模块导入前执行
 
+import logging
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -16,6 +18,8 @@ from backend.api.routers.creative_router import router as creative_router
 from backend.api.routers.group_router import router as group_router
 
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="DeepAgents CLI Web")
 
 app.add_middleware(
@@ -36,6 +40,33 @@ app.include_router(creative_router)
 app.include_router(group_router)
 
 
+@app.on_event("startup")
+async def _startup_open_checkpointer() -> None:
+    """服务启动时打开共享的 checkpoint 连接，各请求复用，避免每轮对话重新打开 SQLite。
+
+    说明：打开失败（权限、文件被锁、磁盘满等）不阻止服务启动，get_checkpointer 会回退为按请求打开连接
+    """
+
+    try:
+        from backend.services.checkpointer_provider import open_shared_checkpointer
+
+        await open_shared_checkpointer()
+    except Exception:
+        logger.exception("open shared checkpointer failed, fallback to per-request connections")
+
+
+@app.on_event("shutdown")
+async def _shutdown_close_checkpointer() -> None:
+    """服务退出时关闭共享的 checkpoint 连接。"""
+
+    try:
+        from backend.services.checkpointer_provider import close_shared_checkpointer
+
+        await close_shared_checkpointer()
+    except Exception:
+        return
+
+
 @app.on_event("shutdown")
 async def _shutdown_cleanup() -> None:
     """服务退出时清理 OpenSandbox。
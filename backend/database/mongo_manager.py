@@ -10,6 +10,7 @@ from bson.binary import Binary
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 from pymongo import ReturnDocument
+from pymongo import UpdateOne
 
 from backend.utils.snowflake import generate_snowflake_id
 
@@ -545,6 +546,28 @@ class MongoDbManager:
             "content_preview": content_preview,
         }
 
+    def get_document_filenames(self, *, doc_ids: list[str]) -> dict[str, str]:
+        """批量查询文档文件名（一次 $in 查询，只取 filename 字段）。
+
+        Returns:
+            {doc_id: filename}，非法 ID / 不存在 / 无文件名的文档不会出现在结果里
+        """
+        oids = []
+        for doc_id in doc_ids:
+            try:
+                oids.append(ObjectId(doc_id))
+            except Exception:
+                continue
+        if not oids:
+            return {}
+
+        out: dict[str, str] = {}
+        for item in self._collection().find({"_id": {"$in": oids}}, {"filename": 1}):
+            filename = item.get("filename")
+            if filename:
+                out[str(item.get("_id"))] = str(filename)
+        return out
+
     def rename_document(self, *, doc_id: str, filename: str) -> bool:
         try:
             oid = ObjectId(doc_id)
@@ -635,7 +658,7 @@ class MongoDbManager:
         result = self._chat_collection().insert_one(doc)
         return str(result.inserted_id)
 
-    def upsert_tool_message(
+    def _tool_message_upsert(
         self,
         *,
         thread_id: str,
@@ -648,7 +671,8 @@ class MongoDbManager:
         started_at: datetime | None = None,
         ended_at: datetime | None = None,
         created_at: datetime | None = None,
-    ) -> None:
+    ) -> tuple[dict[str, Any], dict[str, Any]]:
+        """构造 tool message upsert 的 (filter, update)，单条与批量写入共用。"""
         if created_at is None:
             created_at = get_beijing_time()
 
@@ -676,7 +700,7 @@ class MongoDbManager:
         if ended_at is not None:
             set_doc["ended_at"] = ended_at
 
-        self._chat_collection().update_one(
+        return (
             {
                 "thread_id": thread_id,
                 "assistant_id": assistant_id,
@@ -687,9 +711,60 @@ class MongoDbManager:
                 "$setOnInsert": set_on_insert,
                 "$set": set_doc,
             },
-            upsert=True,
         )
 
+    def upsert_tool_message(
+        self,
+        *,
+        thread_id: str,
+        assistant_id: str,
+        tool_call_id: str,
+        tool_name: str,
+        tool_args: Any | None = None,
+        tool_status: str | None = None,
+        tool_output: Any | None = None,
+        started_at: datetime | None = None,
+        ended_at: datetime | None = None,
+        created_at: datetime | None = None,
+    ) -> None:
+        filter_doc, update_doc = self._tool_message_upsert(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            tool_call_id=tool_call_id,
+            tool_name=tool_name,
+            tool_args=tool_args,
+            tool_status=tool_status,
+            tool_output=tool_output,
+            started_at=started_at,
+            ended_at=ended_at,
+            created_at=created_at,
+        )
+        self._chat_collection().update_one(filter_doc, update_doc, upsert=True)
+
+    def bulk_upsert_tool_messages(self, items: list[dict[str, Any]]) -> None:
+        """批量 upsert tool message（一次 bulk_write 往返）。
+
+        说明：
+        - items 中每一项是 upsert_tool_message 的关键字参数
+        - 同一个 tool 的 start/end 可能在同一批里：先按 tool 合并成一条（插入字段取第一条，
+          $set 字段按顺序后写覆盖），合并后每条操作对应不同文档，可以用 ordered=False 让服务端不必逐条串行
+        """
+        if not items:
+            return
+        merged: dict[tuple[Any, Any, Any], dict[str, Any]] = {}
+        for item in items:
+            key = (item.get("thread_id"), item.get("assistant_id"), item.get("tool_call_id"))
+            current = merged.get(key)
+            if current is None:
+                merged[key] = dict(item)
+                continue
+            for field_name in _TOOL_MESSAGE_SET_FIELDS:
+                value = item.get(field_name)
+                if value is not None:
+                    current[field_name] = value
+        ops = [UpdateOne(*self._tool_message_upsert(**item), upsert=True) for item in merged.values()]
+        self._chat_collection().bulk_write(ops, ordered=False)
+
     def set_chat_memory(
         self,
         *,
@@ -820,6 +895,50 @@ class MongoDbManager:
         # 反转结果，按时间升序返回（旧消息在前，新消息在后）
         return list(reversed(out))
 
+    def set_message_suggested_questions(self, *, thread_id: str, message_id: str, questions: list[str]) -> None:
+        """回填单条消息的推荐问题（消息先落库、推荐问题后生成的场景）。"""
+        try:
+            from bson import ObjectId  # 延迟导入，避免模块加载时出错
+        except Exception:
+            return
+
+        try:
+            oid = ObjectId(str(message_id))
+        except Exception:
+            return
+
+        self._chat_collection().update_one(
+            {"_id": oid, "thread_id": thread_id},
+            {"$set": {"suggested_questions": list(questions), "updated_at": get_beijing_time()}},
+        )
+
+    def update_chat_message_content(
+        self,
+        *,
+        thread_id: str,
+        message_id: str,
+        content: str,
+        attachments: list[Any] | None = None,
+        references: list[dict[str, Any]] | None = None,
+    ) -> None:
+        """覆盖单条消息的正文（流式回复分段增量落库的场景），附件/引用传入时一并更新。"""
+        try:
+            from bson import ObjectId  # 延迟导入，避免模块加载时出错
+        except Exception:
+            return
+
+        try:
+            oid = ObjectId(str(message_id))
+        except Exception:
+            return
+
+        set_doc: dict[str, Any] = {"content": content, "updated_at": get_beijing_time()}
+        if attachments is not None:
+            set_doc["attachments"] = attachments
+        if references is not None:
+            set_doc["references"] = references
+        self._chat_collection().update_one({"_id": oid, "thread_id": thread_id}, {"$set": set_doc})
+
     def update_message_feedback(self, *, thread_id: str, message_id: str, index: int) -> None:
         """更新单条消息的反馈信息。
 
@@ -1283,23 +1402,49 @@ class MongoDbManager:
         assistant_text: str,
         max_chars: int = 8000,
     ) -> None:
-        prev = self.get_chat_memory(thread_id=thread_id, assistant_id=assistant_id)
+        """追加一轮对话到会话记忆（超过 max_chars 时只保留末尾）。
+
+        说明：
+        - 用聚合管道更新在服务端完成“读旧值 + 拼接 + 截断”，一次往返，且并发追加不会互相覆盖
+        - 需要 MongoDB 4.2+（pipeline update）
+        """
         block = f"User: {user_text.strip()}\nAssistant: {assistant_text.strip()}".strip()
-        merged = (prev + "\n\n" + block).strip() if prev else block
-        if max_chars > 0 and len(merged) > max_chars:
-            merged = merged[-max_chars:]
+        prev = {"$ifNull": ["$memory_text", ""]}
+        merged: Any = {
+            "$cond": [
+                {"$gt": [{"$strLenCP": prev}, 0]},
+                {"$concat": [prev, "\n\n", {"$literal": block}]},
+                {"$literal": block},
+            ]
+        }
+        if max_chars > 0:
+            merged = {
+                "$let": {
+                    "vars": {"merged": merged},
+                    "in": {
+                        "$substrCP": [
+                            "$$merged",
+                            {"$max": [0, {"$subtract": [{"$strLenCP": "$$merged"}, max_chars]}]},
+                            max_chars,
+                        ]
+                    },
+                }
+            }
 
         now = get_beijing_time()
         self._chat_memory_collection().update_one(
             {"thread_id": thread_id, "assistant_id": assistant_id},
-            {
-                "$set": {
-                    "thread_id": thread_id,
-                    "assistant_id": assistant_id,
-                    "memory_text": merged,
-                    "updated_at": now,
+            [
+                {
+                    "$set": {
+                        # 说明：管道里以 $ 开头的字符串会被当成字段路径，外部传入的值统一包一层 $literal
+                        "thread_id": {"$literal": thread_id},
+                        "assistant_id": {"$literal": assistant_id},
+                        "memory_text": merged,
+                        "updated_at": now,
+                    }
                 }
-            },
+            ],
             upsert=True,
         )
 
@@ -1321,6 +1466,9 @@ _DEFAULT_CREATIVE_FINAL_DOCS_COLLECTION = (
 )
 _DEFAULT_DISTRIBUTED_LOCKS_COLLECTION = os.getenv("DEEPAGENTS_MONGO_DISTRIBUTED_LOCKS_COLLECTION") or "distributed_locks"
 
+# tool message 里走 $set（后写覆盖）的字段，批量 upsert 合并同一 tool 的多次写入时使用
+_TOOL_MESSAGE_SET_FIELDS = ("tool_args", "tool_status", "tool_output", "started_at", "ended_at")
+
 
 def get_mongo_manager() -> MongoDbManager:
     return MongoDbManager(
@@ -1,5 +1,11 @@
 """中间件模块"""
 from backend.middleware.rag_middleware import LlamaIndexRagMiddleware
 from backend.middleware.podcast_middleware import build_podcast_middleware, PodcastMiddleware
+from backend.middleware.turn_context_middleware import TurnContextMiddleware
 
-__all__ = ["LlamaIndexRagMiddleware", "build_podcast_middleware", "PodcastMiddleware"]
+__all__ = [
+    "LlamaIndexRagMiddleware",
+    "build_podcast_middleware",
+    "PodcastMiddleware",
+    "TurnContextMiddleware",
+]
@@ -5,6 +5,8 @@ import json
 import os
 import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
@@ -149,6 +151,12 @@ class LlamaIndexRagMiddleware(AgentMiddleware):
         self._manifest_path = self._persist_dir / "manifest.json"
         # 文件锁路径，保护索引构建过程
         self._lock_path = self._persist_dir / ".lock"
+        # 最近查询文本的 embedding（实例按附件集合复用，强制检索与语义缓存查询共用同一次计算）
+        self._embedding_memo: OrderedDict[str, list[float]] = OrderedDict()
+        self._embedding_memo_lock = threading.Lock()
+        # 已加载的索引：(持久化文件签名, index)；索引重建后文件 mtime 变化，签名不一致时重新加载
+        self._loaded_index: tuple[tuple[Any, ...], Any] | None = None
+        self._loaded_index_lock = threading.Lock()
 
     def _parse_filesystem_write_ref(self, raw: str) -> tuple[str, str] | None:
         """解析 filesystem_writes 引用标识。
@@ -357,17 +365,47 @@ class LlamaIndexRagMiddleware(AgentMiddleware):
             results.append(path)
         return results
 
-    def query(self, query: str) -> list[dict[str, Any]]:
+    def query(self, query: str, embedding: list[float] | None = None) -> list[dict[str, Any]]:
         """执行 RAG 查询，返回相关的文档片段。
         
         Args:
             query: 查询文本
+            embedding: 已计算好的查询向量（可选，传入时检索阶段不再重复计算）
             
         Returns:
             相关文档片段列表，每个片段包含 text/score/source/mongo_id 字段
         """
         self._ensure_index()
-        return self._retrieve(query)
+        return self._retrieve(query, embedding=embedding)
+
+    def embed(self, text: str) -> list[float] | None:
+        """计算查询文本的 embedding（用于语义缓存），失败时返回 None。
+
+        说明：同一实例内按文本记忆最近的结果，同一问题的重复查询不再调用 embedding 模型
+        """
+        with self._embedding_memo_lock:
+            cached = self._embedding_memo.get(text)
+            if cached is not None:
+                self._embedding_memo.move_to_end(text)
+                return cached
+
+        try:
+            from llama_index.core import Settings as LlamaIndexSettings
+        except Exception:
+            return None
+
+        self._configure_llamaindex_embeddings()
+        try:
+            embedding = list(LlamaIndexSettings.embed_model.get_query_embedding(text))
+        except Exception:
+            logger.warning("RAG query embedding failed. persist_dir=%s", str(self._persist_dir), exc_info=True)
+            return None
+
+        with self._embedding_memo_lock:
+            self._embedding_memo[text] = embedding
+            while len(self._embedding_memo) > 32:
+                self._embedding_memo.popitem(last=False)
+        return embedding
 
     def _load_manifest(self) -> dict[str, RagDocument]:
         """加载索引元数据文件，用于检测文件变更。
@@ -715,11 +753,35 @@ class LlamaIndexRagMiddleware(AgentMiddleware):
                 except Exception:
                     pass
 
-    def _retrieve(self, query: str) -> list[dict[str, Any]]:
+    def index_signature(self) -> tuple[Any, ...]:
+        """持久化索引文件的 (文件名, mtime_ns, size) 签名，用于判断已加载的索引、检索缓存是否过期。"""
+        signature: list[tuple[str, int, int]] = []
+        for name in ("docstore.json", "index_store.json", "default__vector_store.json"):
+            try:
+                stat = (self._persist_dir / name).stat()
+            except OSError:
+                continue
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _load_index(self, storage_context_cls: Any, load_index_from_storage: Any) -> Any:
+        """加载持久化索引；文件未变化时复用上次加载的实例，避免每次检索都反序列化整个索引。"""
+        signature = self.index_signature()
+        with self._loaded_index_lock:
+            loaded = self._loaded_index
+            if loaded is not None and loaded[0] == signature:
+                return loaded[1]
+            storage_context = storage_context_cls.from_defaults(persist_dir=str(self._persist_dir))
+            index = load_index_from_storage(storage_context)
+            self._loaded_index = (signature, index)
+            return index
+
+    def _retrieve(self, query: str, embedding: list[float] | None = None) -> list[dict[str, Any]]:
         """执行向量检索，返回相关的文档片段。
 
         Args:
             query: 查询文本
+            embedding: 已计算好的查询向量（可选）
 
         Returns:
             相关文档片段列表，每个片段包含 text/score/source/mongo_id 字段
@@ -741,10 +803,14 @@ class LlamaIndexRagMiddleware(AgentMiddleware):
             return []
 
         try:
-            storage_context = StorageContext.from_defaults(persist_dir=str(self._persist_dir))
-            index = load_index_from_storage(storage_context)
+            index = self._load_index(StorageContext, load_index_from_storage)
             retriever = index.as_retriever(similarity_top_k=self._top_k)
-            nodes = retriever.retrieve(query)
+            if embedding is not None:
+                from llama_index.core.schema import QueryBundle
+
+                nodes = retriever.retrieve(QueryBundle(query_str=query, embedding=embedding))
+            else:
+                nodes = retriever.retrieve(query)
         except Exception:
             logger.exception("RAG retrieve failed. persist_dir=%s", str(self._persist_dir))
             return []
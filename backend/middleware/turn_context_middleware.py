@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from typing import Any
+
+from langchain.agents.middleware.types import AgentMiddleware, ModelRequest, ModelResponse
+from langchain_core.messages import HumanMessage
+
+
+class TurnContextMiddleware(AgentMiddleware):
+    """把本轮的动态上下文作为一条临时用户消息，插到本轮用户输入之前。
+
+    说明：
+    - 附件列表、会话记忆、<rag_context> 每轮都会变化；放在系统消息里会让其后的整段历史都无法命中前缀缓存
+    - 这里只在发给模型的请求里插入，不写回 agent state/checkpoint，历史消息保持原样
+    - 这样 [系统消息 + 历史对话] 跨轮次字节级不变，本轮内多次模型调用也共享同一前缀
+    - 用 HumanMessage 而不是第二条 SystemMessage：部分 OpenAI 兼容供应方不接受非首位的 system 消息
+    """
+
+    def __init__(self, context: str) -> None:
+        self._context = context
+
+    def _override(self, request: ModelRequest) -> ModelRequest:
+        if not self._context:
+            return request
+        messages = list(request.messages)
+        # 关键逻辑：定位本轮用户输入（最后一条 HumanMessage），上下文紧贴在它前面
+        insert_at = len(messages)
+        for idx in range(len(messages) - 1, -1, -1):
+            if isinstance(messages[idx], HumanMessage):
+                insert_at = idx
+                break
+        messages.insert(insert_at, HumanMessage(content=self._context))
+        return request.override(messages=messages)
+
+    def wrap_model_call(self, request: ModelRequest, handler: Any) -> ModelResponse:  # type: ignore[override]
+        return handler(self._override(request))
+
+    async def awrap_model_call(self, request: ModelRequest, handler: Any) -> ModelResponse:  # type: ignore[override]
+        return await handler(self._override(request))
+
+
+__all__ = ["TurnContextMiddleware"]
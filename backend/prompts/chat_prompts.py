@@ -226,6 +226,23 @@ def tool_whitelist_prompt(tool_names: list[str]) -> str:
     )
 
 
+# 推荐问题 prompt 只取 AI 回复的前 N 个字符；流式过程中攒够 N 字即可提前发起生成
+SUGGESTED_QUESTIONS_CONTEXT_CHARS = 500
+
+
+# 推荐问题 prompt 模板：固定文本在模块加载时拼好，每次只做一次 format
+_SUGGESTED_QUESTIONS_PROMPT_TEMPLATE = (
+    "基于以下对话，生成 3 个简短的延续问题（每个问题不超过 20 字），帮助用户深入了解相关内容。\n\n"
+    "用户问题：{user}\n\n"
+    "AI 回答：{assistant}\n\n"
+    "要求：\n"
+    "1. 问题要具体、可操作\n"
+    "2. 与当前话题紧密相关\n"
+    "3. 每个问题一行，不要编号\n"
+    "4. 只输出 3 个问题，不要其他内容"
+)
+
+
 def suggested_questions_prompt(user_text: str, assistant_text: str) -> str:
     """生成推荐问题的 prompt 模板。
 
@@ -236,13 +253,7 @@ def suggested_questions_prompt(user_text: str, assistant_text: str) -> str:
     Returns:
         完整的 prompt 字符串
     """
-    return (
-        f"基于以下对话，生成 3 个简短的延续问题（每个问题不超过 20 字），帮助用户深入了解相关内容。\n\n"
-        f"用户问题：{user_text}\n\n"
-        f"AI 回答：{assistant_text[:500]}\n\n"
-        "要求：\n"
-        "1. 问题要具体、可操作\n"
-        "2. 与当前话题紧密相关\n"
-        "3. 每个问题一行，不要编号\n"
-        "4. 只输出 3 个问题，不要其他内容"
+    return _SUGGESTED_QUESTIONS_PROMPT_TEMPLATE.format(
+        user=user_text,
+        assistant=assistant_text[:SUGGESTED_QUESTIONS_CONTEXT_CHARS],
     )
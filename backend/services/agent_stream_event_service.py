@@ -1,18 +1,85 @@
 from __future__ import annotations
 
+import asyncio
+import io
 import json
 import logging
-from dataclasses import dataclass
-from typing import Any
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable
 
 from langchain_core.messages import ToolMessage
 
 from backend.database.mongo_manager import get_beijing_time
+from backend.utils.json_utils import json_loads
 
 
 logger = logging.getLogger(__name__)
 
 
+def _as_str_id(raw: Any) -> str | None:
+    """把 tool id / 工具名规范成 str；已是 str 时原样返回，空值返回 None。"""
+    if not raw:
+        return None
+    return raw if type(raw) is str else str(raw)
+
+
+def _rag_references_signature(refs: list[dict[str, Any]]) -> tuple[tuple[Any, ...], ...]:
+    """生成引用列表指纹，用于判断两次检索结果是否一致。"""
+    return tuple((r.get("index"), r.get("source"), r.get("mongo_id"), r.get("text")) for r in refs)
+
+
+# JSON 结构扫描只关心这几类字符：转义序列（整体跳过）、引号、括号；其余字符由正则在 C 层直接跳过
+_JSON_STRUCTURE_RE = re.compile(r'\\.|["{}\[\]]', re.S)
+
+
+@dataclass
+class ToolArgsBuffer:
+    """单个 tool_call 的参数分片缓冲。
+
+    说明：
+    - 追加分片时增量跟踪 JSON 括号深度（跳过字符串内部），每个分片只扫描一次
+    - 只有顶层对象/数组闭合时才拼接并解析一次，不再每来一个分片就 join + 尝试 json 解析
+    - 参数不是对象/数组（例如纯文本）时，保持原行为：每个分片都尝试解析
+    """
+
+    parts: list[str] = field(default_factory=list)
+    depth: int = 0
+    in_string: bool = False
+    is_container: bool | None = None
+    carry: str = ""
+
+    def feed(self, text: str) -> bool:
+        """追加一个分片，返回当前是否可能已是完整的 JSON 值。"""
+        self.parts.append(text)
+        if self.is_container is None:
+            head = text.lstrip()
+            if not head:
+                return False
+            self.is_container = head[0] in "{["
+        if not self.is_container:
+            return True
+
+        scan = self.carry + text
+        self.carry = ""
+        last_end = 0
+        for m in _JSON_STRUCTURE_RE.finditer(scan):
+            last_end = m.end()
+            ch = m.group()
+            if ch == '"':
+                self.in_string = not self.in_string
+            elif self.in_string or len(ch) > 1:
+                continue
+            elif ch in "{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+        # 说明：分片恰好以转义符结尾时，留到下一个分片和后续字符一起识别
+        if last_end < len(scan) and scan.endswith("\\"):
+            self.carry = "\\"
+        return self.depth <= 0 and not self.in_string
+
+
 @dataclass
 class StreamParseState:
     """流式解析状态。
@@ -20,16 +87,24 @@ class StreamParseState:
     说明：
     - 该状态在单次 stream_chat 调用生命周期内使用
     - 用于处理 tool call 期间的文本增量暂存、工具开始/结束事件等
+    - 工具调用期间的文本写入 StringIO，工具结束后合并成一条 chat.delta 推出
     """
 
     started_tools: set[str]
     active_tool_ids: set[str]
-    pending_text_deltas: list[str]
+    pending_text: io.StringIO
     saw_tool_call: bool
-    pending_tool_args: dict[str, list[str]]
+    pending_tool_args: dict[str, ToolArgsBuffer]
     tool_id_to_name: dict[str, str]
     last_tool_id: str | None
 
+    def drain_pending_text(self) -> str:
+        """取出工具调用期间暂存的文本（合并为一段），并清空缓冲。"""
+        text = self.pending_text.getvalue()
+        if text:
+            self.pending_text = io.StringIO()
+        return text
+
 
 @dataclass(frozen=True)
 class StreamParseOutput:
@@ -49,17 +124,106 @@ class AgentStreamEventService:
 
     注意：
     - 这里不负责调用 agent.astream（上层负责循环）
-    - 这里不负责保存最终 assistant message（交给 ChatService）
+    - 这里不负责组装最终 assistant message（交给 ChatService），但上层可以复用 schedule_write 落库
+    - 落库放到后台写队列里串行执行，不阻塞事件循环；上层在结束前需要 await flush_writes()
     """
 
     def __init__(self, *, mongo: Any) -> None:
         self._mongo = mongo
+        self._write_queue: asyncio.Queue[tuple[Callable[..., Any], dict[str, Any]]] | None = None
+        self._write_worker: asyncio.Task | None = None
+
+    def schedule_write(self, func: Callable[..., Any], /, **kwargs: Any) -> None:
+        """把阻塞的 Mongo 写入放进后台写队列（fire-and-forget）。
+
+        说明：
+        - 单个后台 worker 按入队顺序执行，保证同一个 tool 的 start/end 不会乱序覆盖
+        - worker 每次把队列里已积压的写入一起放到一次 to_thread 里执行，减少线程切换
+        - 没有运行中的事件循环时（例如同步调用场景）退化为直接同步写入
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._run_writes([(func, kwargs)])
+            return
+
+        if self._write_queue is None:
+            self._write_queue = asyncio.Queue()
+        if self._write_worker is None or self._write_worker.done():
+            self._write_worker = loop.create_task(self._write_loop(self._write_queue))
+        self._write_queue.put_nowait((func, kwargs))
+
+    def _run_writes(self, batch: list[tuple[Callable[..., Any], dict[str, Any]]]) -> None:
+        # 关键逻辑：连续的 tool message upsert 合并成一次 bulk_write，其它写入保持原顺序逐条执行
+        upsert_tool_message = getattr(self._mongo, "upsert_tool_message", None)
+        bulk_upsert = getattr(self._mongo, "bulk_upsert_tool_messages", None)
+        pending_upserts: list[dict[str, Any]] = []
+
+        def flush_upserts() -> None:
+            if not pending_upserts:
+                return
+            if len(pending_upserts) == 1 or bulk_upsert is None:
+                for item in pending_upserts:
+                    self._run_write(upsert_tool_message, item)
+            else:
+                try:
+                    bulk_upsert(list(pending_upserts))
+                except Exception:
+                    # 说明：upsert 是幂等的，批量失败时逐条重试，尽量不丢工具状态
+                    logger.warning("mongo bulk tool upsert failed, fallback to single writes", exc_info=True)
+                    for item in pending_upserts:
+                        self._run_write(upsert_tool_message, item)
+            pending_upserts.clear()
+
+        for func, kwargs in batch:
+            if upsert_tool_message is not None and func == upsert_tool_message:
+                pending_upserts.append(kwargs)
+                continue
+            flush_upserts()
+            self._run_write(func, kwargs)
+        flush_upserts()
+
+    def _run_write(self, func: Callable[..., Any], kwargs: dict[str, Any]) -> None:
+        try:
+            func(**kwargs)
+        except Exception:
+            logger.warning("mongo write failed | func=%s", getattr(func, "__name__", ""), exc_info=True)
+
+    async def _write_loop(self, queue: asyncio.Queue[tuple[Callable[..., Any], dict[str, Any]]]) -> None:
+        # 说明：队列清空即退出，下次 schedule_write 时再拉起；流被中途取消时也不会残留常驻任务
+        while True:
+            batch: list[tuple[Callable[..., Any], dict[str, Any]]] = []
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self._run_writes, batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def flush_writes(self, timeout: float | None = None) -> bool:
+        """等待所有后台写入完成（在流结束前调用）。
+
+        说明：传入 timeout 时最多等这么久，超时返回 False；只是不再等待，后台 worker 不会被取消，积压的写入继续执行
+        """
+        if self._write_queue is None:
+            return True
+        try:
+            await asyncio.wait_for(self._write_queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
 
     def init_state(self) -> StreamParseState:
         return StreamParseState(
             started_tools=set(),
             active_tool_ids=set(),
-            pending_text_deltas=[],
+            pending_text=io.StringIO(),
             saw_tool_call=False,
             pending_tool_args={},
             tool_id_to_name={},
@@ -71,7 +235,7 @@ class AgentStreamEventService:
             try:
                 if not raw.strip():
                     return {}
-                return json.loads(raw)
+                return json_loads(raw)
             except json.JSONDecodeError:
                 return {"value": raw}
         return raw
@@ -87,12 +251,16 @@ class AgentStreamEventService:
         if not text:
             return None
 
-        buffer = state.pending_tool_args.setdefault(tool_id, [])
-        buffer.append(text)
-        combined = "".join(buffer)
+        buffer = state.pending_tool_args.get(tool_id)
+        if buffer is None:
+            buffer = state.pending_tool_args[tool_id] = ToolArgsBuffer()
+
+        # 关键逻辑：对象/数组的顶层括号还没闭合时肯定解析不了，直接跳过，避免每个分片都 join + 解析一次
+        if not buffer.feed(text):
+            return None
 
         try:
-            return json.loads(combined)
+            return json_loads("".join(buffer.parts).strip())
         except Exception:
             return None
 
@@ -108,19 +276,17 @@ class AgentStreamEventService:
         tool_name: str,
         args_value: Any,
     ) -> None:
-        """发送/更新 tool.start 事件，并同步 upsert tool message。"""
-        try:
-            self._mongo.upsert_tool_message(
-                thread_id=thread_id,
-                assistant_id=assistant_id,
-                tool_call_id=tool_id,
-                tool_name=tool_name,
-                tool_args=args_value,
-                tool_status="running",
-                started_at=get_beijing_time(),
-            )
-        except Exception:
-            pass
+        """发送/更新 tool.start 事件，并在后台 upsert tool message。"""
+        self.schedule_write(
+            self._mongo.upsert_tool_message,
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            tool_call_id=tool_id,
+            tool_name=tool_name,
+            tool_args=args_value,
+            tool_status="running",
+            started_at=get_beijing_time(),
+        )
 
         events.append({"type": "tool.start", "id": tool_id, "name": tool_name, "args": args_value, "message_id": current_message_id})
 
@@ -155,117 +321,126 @@ class AgentStreamEventService:
         if mode != "messages":
             return StreamParseOutput(events=events, assistant_deltas=assistant_deltas)
 
-        messages: list[Any] = []
-        if isinstance(data, list) and data:
+        # 关键逻辑：stream_mode=["messages"] 下绝大多数 chunk 都是 (message, metadata)，先走这条快路径
+        if type(data) is tuple and len(data) == 2:
+            messages: Any = (data[0],)
+        elif isinstance(data, list) and data:
             messages = data
-        elif isinstance(data, tuple) and len(data) == 2:
-            message, _metadata = data
-            messages = [message]
         else:
             return StreamParseOutput(events=events, assistant_deltas=assistant_deltas)
 
         def handle_message(message: Any) -> None:
             # ToolMessage：代表工具调用结果返回
             if isinstance(message, ToolMessage):
-                tool_id = getattr(message, "tool_call_id", None)
+                # 关键逻辑：属性只取一次，后续分支复用局部变量；tool id 统一规范成 str
+                raw_tool_id = getattr(message, "tool_call_id", None)
+                tid = _as_str_id(raw_tool_id)
                 tool_name = getattr(message, "name", "")
+                tool_status = getattr(message, "status", "success")
+                tool_content = message.content
 
                 # 特殊处理：rag_query 的输出用于更新 rag.references
                 if tool_name == "rag_query" and rag_references_out is not None:
                     try:
-                        raw_content = message.content
-                        parsed = json.loads(raw_content) if isinstance(raw_content, str) else raw_content
+                        parsed = json_loads(tool_content) if isinstance(tool_content, str) else tool_content
                         if isinstance(parsed, list):
-                            rag_references = [x for x in parsed if isinstance(x, dict)]
-                            rag_references_out[:] = rag_references
-                            events.append({"type": "rag.references", "references": rag_references})
+                            # 说明：常见情况下元素已全是 dict，直接复用，不再复制一份列表
+                            if all(type(x) is dict for x in parsed):
+                                rag_references = parsed
+                            else:
+                                rag_references = [x for x in parsed if isinstance(x, dict)]
+                            # 关键逻辑：与已推送的引用（例如强制 RAG 结果）完全一致时不再重复推送
+                            if _rag_references_signature(rag_references) != _rag_references_signature(rag_references_out):
+                                rag_references_out[:] = rag_references
+                                events.append({"type": "rag.references", "references": rag_references})
                     except Exception:
                         pass
 
-                if tool_id:
-                    tool_id_str = str(tool_id)
-                    if tool_id_str in state.active_tool_ids:
-                        state.active_tool_ids.discard(tool_id_str)
-
-                    try:
-                        self._mongo.upsert_tool_message(
-                            thread_id=thread_id,
-                            assistant_id=assistant_id,
-                            tool_call_id=tool_id_str,
-                            tool_name=tool_name,
-                            tool_status=str(getattr(message, "status", "success")),
-                            tool_output=message.content,
-                            ended_at=get_beijing_time(),
-                        )
-                    except Exception:
-                        pass
+                if tid:
+                    state.active_tool_ids.discard(tid)
+
+                    self.schedule_write(
+                        self._mongo.upsert_tool_message,
+                        thread_id=thread_id,
+                        assistant_id=assistant_id,
+                        tool_call_id=tid,
+                        tool_name=tool_name,
+                        tool_status=str(tool_status),
+                        tool_output=tool_content,
+                        ended_at=get_beijing_time(),
+                    )
 
                     events.append(
                         {
                             "type": "tool.end",
-                            "id": tool_id,
+                            "id": tid,
                             "name": tool_name,
-                            "status": getattr(message, "status", "success"),
-                            "output": message.content,
+                            "status": tool_status,
+                            "output": tool_content,
                             "message_id": current_message_id,
                         }
                     )
 
                     # 如果工具期间暂存了文本，且当前已经没有 active tool，则把暂存文本刷出去
-                    if state.saw_tool_call and not state.active_tool_ids and state.pending_text_deltas:
-                        for delta in state.pending_text_deltas:
-                            assistant_deltas.append(str(delta))
-                            events.append({"type": "chat.delta", "text": str(delta)})
-                        state.pending_text_deltas = []
+                    if state.saw_tool_call and not state.active_tool_ids:
+                        pending_text = state.drain_pending_text()
+                        if pending_text:
+                            assistant_deltas.append(pending_text)
+                            events.append({"type": "chat.delta", "text": pending_text})
 
                 return
 
             # 文本消息：可能来自 content_blocks 或 content
-            if hasattr(message, "content_blocks") and getattr(message, "content_blocks"):
-                for block in message.content_blocks:
+            # 说明：content_blocks 是按需计算的属性，只取一次
+            content_blocks = getattr(message, "content_blocks", None)
+            if content_blocks:
+                for block in content_blocks:
                     block_type = block.get("type")
 
                     if block_type == "text":
                         text_delta = block.get("text", "")
                         if text_delta:
+                            text_delta = str(text_delta)
                             if state.saw_tool_call and state.active_tool_ids:
-                                state.pending_text_deltas.append(str(text_delta))
+                                state.pending_text.write(text_delta)
                             else:
-                                assistant_deltas.append(str(text_delta))
-                                events.append({"type": "chat.delta", "text": str(text_delta)})
+                                assistant_deltas.append(text_delta)
+                                events.append({"type": "chat.delta", "text": text_delta})
 
                     elif block_type in ("tool_call_chunk", "tool_call"):
-                        chunk_name = block.get("name")
-                        chunk_id = block.get("id")
+                        # 说明：id / name 在入口处规范成 str 一次，后续集合操作与事件构造直接复用
+                        chunk_name = _as_str_id(block.get("name"))
+                        tid = _as_str_id(block.get("id"))
                         chunk_args = block.get("args")
                         # 兼容异常输出：有些模型会把普通文本误标为 tool_call_chunk，且 name/id 为空
                         # 这种情况需要回退为普通文本，避免正文被吞掉
-                        if not chunk_name and not chunk_id and isinstance(chunk_args, str) and chunk_args:
+                        if not chunk_name and not tid and isinstance(chunk_args, str) and chunk_args:
                             if state.saw_tool_call and state.active_tool_ids:
-                                state.pending_text_deltas.append(str(chunk_args))
+                                state.pending_text.write(chunk_args)
                             else:
-                                assistant_deltas.append(str(chunk_args))
-                                events.append({"type": "chat.delta", "text": str(chunk_args)})
+                                assistant_deltas.append(chunk_args)
+                                events.append({"type": "chat.delta", "text": chunk_args})
                             return
                         # 记录 LLM 原始 tool_call 参数，便于排查空参数问题
-                        logger.debug(
-                            "llm tool_call raw | name=%s | id=%s | args=%s",
-                            str(chunk_name),
-                            str(chunk_id),
-                            self._safe_preview(chunk_args),
-                        )
+                        # 说明：_safe_preview 会做一次 JSON 序列化，每个参数分片都会走到这里，未开 debug 时直接跳过
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(
+                                "llm tool_call raw | name=%s | id=%s | args=%s",
+                                chunk_name,
+                                tid,
+                                self._safe_preview(chunk_args),
+                            )
 
                         # 记录工具名与最近的 tool_id，便于后续拼接 args 分片
-                        if chunk_id:
-                            tool_id_str = str(chunk_id)
-                            state.last_tool_id = tool_id_str
+                        if tid:
+                            state.last_tool_id = tid
                             if chunk_name:
-                                state.tool_id_to_name[tool_id_str] = str(chunk_name)
+                                state.tool_id_to_name[tid] = chunk_name
 
                         # 尝试把 args 分片拼起来，解析出完整 JSON
                         buffer_id = None
-                        if chunk_id:
-                            buffer_id = str(chunk_id)
+                        if tid:
+                            buffer_id = tid
                         elif state.last_tool_id and state.last_tool_id in state.active_tool_ids:
                             buffer_id = state.last_tool_id
                         elif len(state.active_tool_ids) == 1:
@@ -282,13 +457,16 @@ class AgentStreamEventService:
                                 # 解析成功后清空缓存，避免重复解析
                                 state.pending_tool_args.pop(buffer_id, None)
 
-                        if chunk_id and chunk_id not in state.started_tools and chunk_name:
+                        # 说明：先 add 再比较集合长度，一次哈希操作同时完成“是否首次出现”的判断和登记
+                        started_count = len(state.started_tools)
+                        if tid and chunk_name:
+                            state.started_tools.add(tid)
+                        if len(state.started_tools) > started_count:
                             args_value = self._parse_tool_args(chunk_args)
                             state.saw_tool_call = True
 
                             try:
-                                tool_id_str = str(chunk_id)
-                                state.active_tool_ids.add(tool_id_str)
+                                state.active_tool_ids.add(tid)
                                 # 工具启动时先用已有参数占位，后续如果解析到完整参数会再次更新
                                 self._emit_tool_start(
                                     events=events,
@@ -296,18 +474,16 @@ class AgentStreamEventService:
                                     thread_id=thread_id,
                                     assistant_id=assistant_id,
                                     current_message_id=current_message_id,
-                                    tool_id=tool_id_str,
-                                    tool_name=str(chunk_name),
+                                    tool_id=tid,
+                                    tool_name=chunk_name,
                                     args_value=args_value,
                                 )
                             except Exception:
                                 pass
 
-                            state.started_tools.add(str(chunk_id))
-
                         # 如果已解析出完整参数，更新 tool.start（用相同 id 覆盖 args）
                         if parsed_args is not None and buffer_id:
-                            tool_name = state.tool_id_to_name.get(buffer_id) or (str(chunk_name) if chunk_name else "")
+                            tool_name = state.tool_id_to_name.get(buffer_id) or chunk_name or ""
                             if tool_name:
                                 state.active_tool_ids.add(buffer_id)
                                 self._emit_tool_start(
@@ -323,58 +499,57 @@ class AgentStreamEventService:
                                 state.started_tools.add(buffer_id)
 
             elif hasattr(message, "content"):
-                content = getattr(message, "content", None)
+                content = message.content
                 if isinstance(content, str) and content:
                     if state.saw_tool_call and state.active_tool_ids:
-                        state.pending_text_deltas.append(str(content))
+                        state.pending_text.write(content)
                     else:
-                        assistant_deltas.append(str(content))
-                        events.append({"type": "chat.delta", "text": str(content)})
+                        assistant_deltas.append(content)
+                        events.append({"type": "chat.delta", "text": content})
 
                 tool_calls = getattr(message, "tool_calls", None)
                 if isinstance(tool_calls, list) and tool_calls:
                     for tc in tool_calls:
                         if not isinstance(tc, dict):
                             continue
-                        tc_id = tc.get("id")
-                        tc_name = tc.get("name")
+                        tid = _as_str_id(tc.get("id"))
+                        tc_name = _as_str_id(tc.get("name"))
                         tc_args = tc.get("args")
 
-                        if tc_id:
-                            tool_id_str = str(tc_id)
-                            state.last_tool_id = tool_id_str
+                        if tid:
+                            state.last_tool_id = tid
                             if tc_name:
-                                state.tool_id_to_name[tool_id_str] = str(tc_name)
+                                state.tool_id_to_name[tid] = tc_name
 
                         # 记录 LLM 原始 tool_call 参数，便于排查空参数问题
-                        if tc_id and str(tc_id) not in state.started_tools and tc_name:
+                        started_count = len(state.started_tools)
+                        if tid and tc_name:
+                            state.started_tools.add(tid)
+                        if len(state.started_tools) > started_count:
                             logger.debug(
                                 "llm tool_call raw | name=%s | id=%s | args=%s",
-                                str(tc_name),
-                                str(tc_id),
+                                tc_name,
+                                tid,
                                 self._safe_preview(tc_args),
                             )
                             args_value = self._parse_tool_args(tc_args)
                             state.saw_tool_call = True
 
                             try:
-                                tool_id_str = str(tc_id)
-                                state.active_tool_ids.add(tool_id_str)
+                                state.active_tool_ids.add(tid)
                                 self._emit_tool_start(
                                     events=events,
                                     state=state,
                                     thread_id=thread_id,
                                     assistant_id=assistant_id,
                                     current_message_id=current_message_id,
-                                    tool_id=tool_id_str,
-                                    tool_name=str(tc_name),
+                                    tool_id=tid,
+                                    tool_name=tc_name,
                                     args_value=args_value,
                                 )
                             except Exception:
                                 pass
 
-                            state.started_tools.add(str(tc_id))
-
         for message in messages:
             handle_message(message)
 
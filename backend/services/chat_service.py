@@ -59,10 +59,10 @@ class ChatService:
         references: list[dict[str, Any]] | None = None,
         suggested_questions: list[str] | None = None,
         created_at: datetime | None = None,
-    ) -> bool:
-        """保存 AI 回复消息，返回是否成功"""
+    ) -> str | None:
+        """保存 AI 回复消息，成功返回消息 ID，失败返回 None"""
         try:
-            self.mongo.append_chat_message(
+            message_id = self.mongo.append_chat_message(
                 thread_id=thread_id,
                 assistant_id=assistant_id,
                 role="assistant",
@@ -78,9 +78,44 @@ class ChatService:
                 created_at=created_at,
             )
             logger.info(f"SUCCESS AI 回复已保存 | thread_id={thread_id} | content_len={len(content)}")
-            return True
+            return message_id
         except Exception as e:
             logger.error(f"FAIL AI 回复保存失败 | thread_id={thread_id} | error={e}")
+            return None
+
+    def update_assistant_message(
+        self,
+        thread_id: str,
+        message_id: str,
+        content: str,
+        attachments: list[Any] | None = None,
+        references: list[dict[str, Any]] | None = None,
+    ) -> bool:
+        """覆盖已落库 AI 回复的正文（流式增量落库），返回是否成功"""
+        try:
+            self.mongo.update_chat_message_content(
+                thread_id=thread_id,
+                message_id=message_id,
+                content=content,
+                attachments=attachments,
+                references=references,
+            )
+            return True
+        except Exception as e:
+            logger.error(f"FAIL AI 回复更新失败 | thread_id={thread_id} | message_id={message_id} | error={e}")
+            return False
+
+    def save_suggested_questions(self, thread_id: str, message_id: str, questions: list[str]) -> bool:
+        """回填 AI 回复的推荐问题，返回是否成功"""
+        try:
+            self.mongo.set_message_suggested_questions(
+                thread_id=thread_id,
+                message_id=message_id,
+                questions=questions,
+            )
+            return True
+        except Exception as e:
+            logger.error(f"FAIL 推荐问题保存失败 | thread_id={thread_id} | message_id={message_id} | error={e}")
             return False
     
     def save_chat_memory(
@@ -119,3 +154,15 @@ class ChatService:
         except Exception as e:
             logger.error(f"FAIL 获取聊天记忆失败 | thread_id={thread_id} | error={e}")
             return ""
+
+
+_chat_service: ChatService | None = None
+
+
+def get_chat_service() -> ChatService:
+    """获取全局聊天服务单例（无请求级状态，可跨请求复用）。"""
+
+    global _chat_service
+    if _chat_service is None:
+        _chat_service = ChatService()
+    return _chat_service
@@ -14,22 +14,31 @@ from __future__ import annotations
 
 import base64
 import asyncio
+import functools
+import hashlib
 import inspect
+import itertools
 import logging
+import os
+import re
 import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, AsyncGenerator
+from typing import Any, AsyncGenerator, Callable
 
 import httpx
 import openai
 from deepagents import create_deep_agent
 from deepagents.backends.filesystem import FilesystemBackend
 from deepagents.middleware.subagents import SubAgent
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
 
+from backend.middleware.turn_context_middleware import TurnContextMiddleware
 from backend.services.agent_stream_event_service import AgentStreamEventService
 from backend.config.deepagents_settings import create_model, settings, build_langchain_run_config
 from backend.services.checkpointer_provider import get_checkpointer
+from backend.services.rag_semantic_cache import get_answer_semantic_cache
 from backend.services.rag_service import RagService
 from backend.services.skills_sync_service import SkillsSyncService
 from backend.utils.tools import fetch_url, http_request, web_search, write_todos
@@ -41,11 +50,12 @@ from backend.prompts.chat_prompts import (
     task_subagent_type_rules_prompt,
     tool_whitelist_prompt,
     suggested_questions_prompt,
+    SUGGESTED_QUESTIONS_CONTEXT_CHARS,
 )
 
 from backend.database.mongo_manager import get_mongo_manager, get_beijing_time
-from backend.services.chat_service import ChatService
-from backend.services.checkpoint_service import CheckpointService
+from backend.services.chat_service import get_chat_service
+from backend.services.checkpoint_service import get_checkpoint_service
 from backend.services.mcp_tool_service import get_mcp_tool_service
 from backend.services.session_cancel_service import get_session_cancel_service
 from backend.services.model_router_service import ModelRouterService
@@ -53,6 +63,208 @@ from backend.services.model_router_service import ModelRouterService
 
 logger = logging.getLogger(__name__)
 
+# 静态系统提示词（沙箱环境 + 引用规则 + 文件写入规则 + task 规则），模块加载时拼一次即可，
+# 避免每个请求重复拼接数 KB 的固定文本
+_BASE_SYSTEM_PROMPT: str = "\n\n".join(
+    [
+        sandbox_environment_prompt(),
+        reference_rules_prompt(),
+        file_write_rules_prompt(),
+        task_subagent_type_rules_prompt(),
+        research_task_rules_prompt(),
+    ]
+).strip()
+
+
+# <selected_sources> 段落的固定头尾，中间按附件逐行插入
+_SOURCES_HEADER: tuple[str, ...] = (
+    "<selected_sources>",
+    "用户已附带来源如下（请把这些来源视为唯一上下文）：",
+)
+_SOURCES_FOOTER: tuple[str, ...] = (
+    "使用规则：",
+    "- 回答需要引用附件内容时，必须调用 rag_query 基于上述来源检索。",
+    "- 不要调用 read_file 去读取工作区路径来替代附件内容。",
+    "</selected_sources>",
+)
+
+
+# 推荐问题 LRU 缓存：prompt 只由用户问题 + AI 回复前 N 字决定，重试/重新生成/常见寒暄可直接复用
+_SUGGESTED_QUESTIONS_CACHE_MAX = 1024
+_suggested_questions_cache: OrderedDict[str, list[str]] = OrderedDict()
+
+# 推荐问题逐行匹配：跳过空行和 # 开头的行，捕获去掉首尾空白后的内容
+_SUGGESTED_QUESTION_LINE_RE = re.compile(r"^\s*([^#\s].*?)\s*$", re.M)
+
+
+# 流结束时最多等待推荐问题这么久（秒）；超时则先结束流，推荐问题生成后在后台回填到消息上
+_SUGGESTED_QUESTIONS_WAIT_SECONDS = float(os.getenv("DEEPAGENTS_SUGGESTED_QUESTIONS_WAIT_SECONDS") or "3")
+
+# 单次附件元数据查询的超时（秒）；超时按未命中处理，用 mongo_id 作为文件名，不让慢查询拖住首包
+_ATTACHMENT_META_TIMEOUT_SECONDS = float(os.getenv("DEEPAGENTS_ATTACHMENT_META_TIMEOUT_SECONDS") or "3")
+
+# 流结束前等待后台落库的上限（秒）；Mongo 卡住时不让 SSE 连接一直挂着，未完成的写入留在后台继续执行
+_FINAL_FLUSH_TIMEOUT_SECONDS = float(os.getenv("DEEPAGENTS_FINAL_FLUSH_TIMEOUT_SECONDS") or "5")
+
+# 持有流结束后仍在运行的后台任务引用，避免被 GC 提前回收
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _suggested_questions_cache_key(user_text: str, assistant_text: str) -> str:
+    payload = f"{user_text}\0{assistant_text[:SUGGESTED_QUESTIONS_CONTEXT_CHARS]}"
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# 固定的基础工具（MCP 工具与别名在 _build_tools 中追加）
+_BASE_TOOLS: tuple[Any, ...] = (http_request, fetch_url, write_todos, *((web_search,) if settings.has_tavily else ()))
+
+# 最近一次构建的完整工具列表：(MCP 工具列表对象, 工具列表)；MCP 服务缓存未变时直接复用，别名不必每轮重建
+_built_tools_cache: tuple[Any, list[Any]] | None = None
+
+
+@functools.lru_cache(maxsize=8)
+def _get_chat_model(model_name: str | None) -> Any:
+    """按模型名复用对话模型实例（配置来自进程级环境变量，运行期不变）。"""
+    return create_model(model_name=model_name)
+
+
+# 整轮回答语义缓存（默认关闭）：同一附件集合下语义几乎相同、检索证据也基本一致的问题，直接回放上一轮回答
+# 说明：回放不经过模型和沙箱，但会把这轮问答追加到 LangGraph checkpoint；只缓存带附件、未调用任何 agent 工具的单角色回答
+# 限制：缓存 key 只看问题语义和检索证据，不看对话历史，因此按会话隔离（thread_id 进命名空间）：
+# - 不同会话、不同用户即使附件相同也不会互相回放（默认 assistant_id 都是 "agent"，不能只按它隔离）
+# - 同一会话内依赖上文的追问（如"那第二个呢？"）仍可能命中上文不同时的回答，开启前需评估
+_ANSWER_CACHE_ENABLED = str(os.getenv("DEEPAGENTS_ANSWER_CACHE_ENABLED") or "").strip().lower() in {
+    "1",
+    "true",
+    "yes",
+    "on",
+}
+_ANSWER_CACHE_MIN_EVIDENCE_JACCARD = 0.8
+_ANSWER_REPLAY_CHUNK_CHARS = 64
+
+
+def _evidence_keys(references: list[dict[str, Any]]) -> list[tuple[str, str]]:
+    """把检索引用归一成 (mongo_id/source, 片段正文) 集合，用于判断两次回答的证据是否一致。"""
+    return sorted(
+        {
+            (str(ref.get("mongo_id") or ref.get("source") or ""), str(ref.get("text") or ""))
+            for ref in references
+            if isinstance(ref, dict)
+        }
+    )
+
+
+def _evidence_jaccard(left: list[tuple[str, str]], right: list[tuple[str, str]]) -> float:
+    left_set, right_set = set(left), set(right)
+    if not left_set or not right_set:
+        return 0.0
+    return len(left_set & right_set) / len(left_set | right_set)
+
+
+# 关键逻辑：chat.delta 合并下发阈值（字符数 / 时间间隔，任一满足即 flush）
+_DELTA_FLUSH_CHARS = 32
+_DELTA_FLUSH_SECONDS = 0.02
+
+# 关键逻辑：当前文本段每新增这么多字符就增量落库一次，长回复结束时只需补最后一小段
+_SEGMENT_PERSIST_CHARS = 2048
+
+
+@dataclass
+class _AstreamCancelGuard:
+    """agent.astream 取消监听状态。
+
+    说明：
+    - awaiting：当前是否正挂起在 agent.astream 的下一个 chunk 上（awaiting_event 在进入挂起时置位）
+    - requested：已收到取消通知；流式循环逐 chunk 只读这个标记，不再加锁查询取消服务
+    - fired：监听任务是否已经触发过取消
+    - 只有挂起在 astream 上时才取消任务，避免误伤上层消费者自身的 await
+    """
+
+    awaiting: bool = False
+    requested: bool = False
+    fired: bool = False
+    awaiting_event: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+# 等待 chunk 超过 flush 截止时间时产出的占位对象，提示上层把合并缓冲里的文本先推出去
+_FLUSH_TICK = object()
+
+
+async def _iter_with_cancel_guard(
+    stream: Any,
+    guard: _AstreamCancelGuard,
+    flush_deadline: Callable[[], float | None] | None = None,
+) -> AsyncGenerator[Any, None]:
+    """逐个拉取 astream 的 chunk，并标记“正在等待 agent 输出”的区间。
+
+    说明：
+    - flush_deadline 返回非 None 时（上层缓冲里有待下发的文本），等待下一个 chunk 最多到该时间点；
+      到期先产出 _FLUSH_TICK，拉取中的 chunk 不取消，下一轮继续等待它
+    - 没有截止时间时直接 await，不额外创建任务
+    """
+    pending: asyncio.Future[Any] | None = None
+    try:
+        while True:
+            guard.awaiting = True
+            guard.awaiting_event.set()
+            try:
+                deadline = flush_deadline() if flush_deadline is not None else None
+                if deadline is None and pending is None:
+                    item = await stream.__anext__()
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(stream.__anext__())
+                    if deadline is not None and not pending.done():
+                        await asyncio.wait((pending,), timeout=max(deadline - time.monotonic(), 0.0))
+                    if deadline is None or pending.done():
+                        next_item, pending = pending, None
+                        item = await next_item
+                    else:
+                        item = _FLUSH_TICK
+            except StopAsyncIteration:
+                return
+            finally:
+                guard.awaiting = False
+                guard.awaiting_event.clear()
+            yield item
+    finally:
+        # 说明：被取消或提前退出时，不留下仍在拉取 astream 的后台任务
+        if pending is not None and not pending.done():
+            pending.cancel()
+
+
+async def _watch_cancel(
+    *,
+    cancel_service: Any,
+    thread_id: str,
+    cancel_version: int,
+    guard: _AstreamCancelGuard,
+    target_task: asyncio.Task | None,
+) -> None:
+    """订阅取消通知，命中后直接取消正在等待 agent 输出的任务。
+
+    说明：
+    - 事件驱动，不再定时轮询；取消请求可能来自线程池，通过 call_soon_threadsafe 回到事件循环
+    - 收到取消时如果消费者正在处理 chunk（没有挂起在 astream 上），先只置 requested，
+      由流式循环在下一个 chunk 处按正常取消流程收尾；等它再次挂起到 astream 上时才打断任务
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = asyncio.Event()
+    unsubscribe = cancel_service.subscribe(thread_id, lambda: loop.call_soon_threadsafe(cancelled.set))
+    try:
+        # 说明：订阅之前就已发生的取消，用版本号补查一次
+        if not cancel_service.is_cancelled(thread_id, cancel_version):
+            await cancelled.wait()
+        guard.requested = True
+        if target_task is None:
+            return
+        while not guard.awaiting:
+            await guard.awaiting_event.wait()
+        guard.fired = True
+        target_task.cancel()
+    finally:
+        unsubscribe()
+
 
 class ChatStreamService:
     """聊天流服务类。
@@ -86,78 +298,136 @@ class ChatStreamService:
             return None
         return session_id, write_id
 
+    def _build_attachment_meta(self, *, mongo, file_ref: str) -> dict[str, Any]:
+        """构建单个附件的元数据。"""
+        source_ref = str(file_ref)
+        filename = source_ref
+        fs_ref = self._parse_filesystem_write_ref(source_ref)
+        if fs_ref:
+            # 关键逻辑：当来源是 filesystem_writes 时，优先显示文档标题，避免前端只看到长 ID。
+            session_id, write_id = fs_ref
+            try:
+                write = mongo.get_filesystem_write(write_id=write_id, session_id=session_id)
+                if isinstance(write, dict):
+                    metadata = write.get("metadata") if isinstance(write.get("metadata"), dict) else {}
+                    file_path = str(write.get("file_path") or "")
+                    filename = str(
+                        metadata.get("title")
+                        or (Path(file_path).name if file_path else "")
+                        or write_id
+                    )
+            except Exception:
+                filename = source_ref
+        else:
+            try:
+                detail = mongo.get_document_detail(doc_id=source_ref)
+                if isinstance(detail, dict) and detail.get("filename"):
+                    filename = str(detail.get("filename"))
+            except Exception:
+                filename = source_ref
+        return {"mongo_id": source_ref, "filename": filename}
+
     def _build_attachments_meta(self, *, mongo, file_refs: list[str]) -> list[dict[str, Any]]:
         """构建附件元数据列表。"""
+        return [self._build_attachment_meta(mongo=mongo, file_ref=ref) for ref in file_refs]
+
+    async def _resolve_attachments_meta(self, *, mongo, file_refs: list[str]) -> list[dict[str, Any]]:
+        """并发构建附件元数据列表。
+
+        说明：
+        - 普通文档走一次批量 $in 查询（只取 filename），不再每个附件一次往返
+        - filesystem_writes 引用（fsw:）仍按条查询，与批量查询一起放到线程池里并发执行
+        - 返回顺序与 file_refs 一致；查询异常、超时或未命中时回退为 mongo_id 作为文件名
+        """
+        doc_refs = [ref for ref in file_refs if not self._parse_filesystem_write_ref(ref)]
+        fs_refs = [ref for ref in file_refs if self._parse_filesystem_write_ref(ref)]
+
+        timeout = _ATTACHMENT_META_TIMEOUT_SECONDS
+        results = await asyncio.gather(
+            asyncio.wait_for(asyncio.to_thread(mongo.get_document_filenames, doc_ids=doc_refs), timeout),
+            *(
+                asyncio.wait_for(
+                    asyncio.to_thread(self._build_attachment_meta, mongo=mongo, file_ref=ref), timeout
+                )
+                for ref in fs_refs
+            ),
+            return_exceptions=True,
+        )
+        doc_filenames = results[0] if isinstance(results[0], dict) else {}
+        fs_meta = {
+            ref: result for ref, result in zip(fs_refs, results[1:]) if not isinstance(result, BaseException)
+        }
+
         attachments_meta: list[dict[str, Any]] = []
         for ref in file_refs:
-            source_ref = str(ref)
-            filename = source_ref
-            fs_ref = self._parse_filesystem_write_ref(source_ref)
-            if fs_ref:
-                # 关键逻辑：当来源是 filesystem_writes 时，优先显示文档标题，避免前端只看到长 ID。
-                session_id, write_id = fs_ref
-                try:
-                    write = mongo.get_filesystem_write(write_id=write_id, session_id=session_id)
-                    if isinstance(write, dict):
-                        metadata = write.get("metadata") if isinstance(write.get("metadata"), dict) else {}
-                        file_path = str(write.get("file_path") or "")
-                        filename = str(
-                            metadata.get("title")
-                            or (Path(file_path).name if file_path else "")
-                            or write_id
-                        )
-                except Exception:
-                    filename = source_ref
-            else:
-                try:
-                    detail = mongo.get_document_detail(doc_id=source_ref)
-                    if isinstance(detail, dict) and detail.get("filename"):
-                        filename = str(detail.get("filename"))
-                except Exception:
-                    filename = source_ref
-            attachments_meta.append({"mongo_id": source_ref, "filename": filename})
+            meta = fs_meta.get(ref)
+            if meta is None:
+                meta = {"mongo_id": ref, "filename": doc_filenames.get(ref) or ref}
+            attachments_meta.append(meta)
         return attachments_meta
 
-    def _build_system_prompt(
+    def _build_system_prompt_parts(
         self,
         *,
         memory_text: str,
         attachments_meta: list[dict[str, Any]],
-    ) -> str:
-        """构建系统提示词。"""
-        parts = [
-            sandbox_environment_prompt(),
-            reference_rules_prompt(),
-            file_write_rules_prompt(),
-            task_subagent_type_rules_prompt(),
-            research_task_rules_prompt(),
-        ]
-        extra_system_prompt = "\n\n".join(parts).strip()
+    ) -> list[str]:
+        """构建每轮变化的上下文分段（附件 / 会话记忆）。
+
+        说明：
+        - 返回分段列表，调用方继续 append 动态段落，最后统一 "\n\n".join 一次
+        - 不包含 _BASE_SYSTEM_PROMPT：稳定前缀单独传给 create_deep_agent，动态段落由 TurnContextMiddleware 插到本轮用户输入前
+        """
+        prompt_parts: list[str] = []
 
         if attachments_meta:
-            lines = [
-                "<selected_sources>",
-                "用户已附带来源如下（请把这些来源视为唯一上下文）：",
-            ]
-            for a in attachments_meta:
-                lines.append(f"- {a.get('filename') or a.get('mongo_id')} (id={a.get('mongo_id')})")
-            lines.extend(
-                [
-                    "使用规则：",
-                    "- 回答需要引用附件内容时，必须调用 rag_query 基于上述来源检索。",
-                    "- 不要调用 read_file 去读取工作区路径来替代附件内容。",
-                    "</selected_sources>",
-                ]
+            prompt_parts.append(
+                "\n".join(
+                    itertools.chain(
+                        _SOURCES_HEADER,
+                        (f"- {a.get('filename') or a.get('mongo_id')} (id={a.get('mongo_id')})" for a in attachments_meta),
+                        _SOURCES_FOOTER,
+                    )
+                )
             )
-            block = "\n".join(lines)
-            extra_system_prompt = (extra_system_prompt + "\n\n" + block).strip()
         else:
-            if memory_text.strip():
-                extra_system_prompt = (
-                    (extra_system_prompt + "\n\n" + "<chat_memory>\n" + memory_text.strip() + "\n</chat_memory>")
-                    .strip()
-                )
-        return extra_system_prompt
+            memory = memory_text.strip()
+            if memory:
+                prompt_parts.append("<chat_memory>\n" + memory + "\n</chat_memory>")
+        return prompt_parts
+
+    async def _generate_suggested_questions(self, *, model: Any, user_text: str, assistant_text: str) -> list[str]:
+        """生成推荐问题（最多 3 条），失败时返回空列表。
+
+        说明：
+        - 相同的 (用户问题, 回复前 N 字) 命中进程内 LRU 缓存时直接返回，跳过一次 LLM 调用
+        - 只缓存非空结果，失败不会被缓存下来
+        """
+        cache_key = _suggested_questions_cache_key(user_text, assistant_text)
+        cached = _suggested_questions_cache.get(cache_key)
+        if cached is not None:
+            _suggested_questions_cache.move_to_end(cache_key)
+            return list(cached)
+
+        try:
+            question_msg = await model.ainvoke(
+                [HumanMessage(content=suggested_questions_prompt(user_text, assistant_text))]
+            )
+        except Exception:
+            return []
+        questions_text = getattr(question_msg, "content", "") or ""
+        if not isinstance(questions_text, str):
+            return []
+        # 说明：正则迭代器惰性匹配，凑够 3 条即停止，不再扫描和切分整段输出
+        questions = list(
+            itertools.islice((m.group(1) for m in _SUGGESTED_QUESTION_LINE_RE.finditer(questions_text)), 3)
+        )
+        if questions:
+            _suggested_questions_cache[cache_key] = questions
+            _suggested_questions_cache.move_to_end(cache_key)
+            while len(_suggested_questions_cache) > _SUGGESTED_QUESTIONS_CACHE_MAX:
+                _suggested_questions_cache.popitem(last=False)
+        return list(questions)
 
     def _build_tool_whitelist_prompt(self, tools: list[Any], rag_tool: Any) -> str:
         """构建工具白名单提示词。"""
@@ -190,31 +460,41 @@ class ChatStreamService:
         )
         return tool_whitelist_prompt(sorted(runtime_tool_names))
 
-    def _build_effective_user_text(self, *, text: str, rag_references: list[dict[str, Any]]) -> str:
-        """构建有效用户输入（包含强制 RAG 引用上下文）。"""
-        effective_user_text = text
-        if rag_references:
-            ctx_lines = [
+    def _build_effective_user_text(self, *, text: str, rag_snippets_block: str) -> str:
+        """构建有效用户输入（包含强制 RAG 引用上下文）。
+
+        说明：rag_snippets_block 由 RagService 预先拼好，这里直接复用，不再重复遍历引用。
+        """
+        if not rag_snippets_block:
+            return text
+        return "\n\n".join(
+            [
+                str(text or "").strip(),
                 "请只基于下面的附件检索片段完成总结，禁止引入其它记忆/常识内容，且必须用 [1][2] 标注引用：",
+                rag_snippets_block,
             ]
-            for ref in rag_references[:8]:
-                src = ref.get("source") or "unknown"
-                snippet = ref.get("text") or ""
-                idx = ref.get("index")
-                ctx_lines.append(f"[{idx}] source={src}\n{snippet}")
-            effective_user_text = (str(text or "").strip() + "\n\n" + "\n\n".join(ctx_lines)).strip()
-        return effective_user_text
+        ).strip()
+
+    async def _provision_sandbox(self, *, thread_id: str) -> Any:
+        """获取或创建当前会话的 OpenSandbox 沙箱。"""
+        from backend.services.opensandbox_backend import get_sandbox_manager
+
+        sandbox_manager = get_sandbox_manager()
+        return await sandbox_manager.get_or_create_sandbox(
+            session_id=thread_id,
+            timeout_seconds=600,  # 10 分钟超时
+        )
 
     async def _build_tools(self) -> list[Any]:
-        """构建工具列表（含可选 MCP 工具）。"""
-        tools: list[Any] = [http_request, fetch_url, write_todos]
-        if settings.has_tavily:
-            tools.append(web_search)
+        """构建工具列表（含可选 MCP 工具）。
 
+        说明：返回的列表在请求间共享，调用方只读不改
+        """
+        global _built_tools_cache
+        mcp_tools: list[Any] = []
         try:
-            mcp_tools = await get_mcp_tool_service().get_tools()
+            mcp_tools = await get_mcp_tool_service().get_tools() or []
             if mcp_tools:
-                tools.extend(mcp_tools)
                 logger.info(
                     "MCP tools loaded | tools_count=%s",
                     len(mcp_tools),
@@ -224,8 +504,16 @@ class ChatStreamService:
                 "MCP tools load skipped | err=%s",
                 str(_mcp_exc),
             )
+        # 说明：MCP 服务在配置未变时返回同一个缓存列表对象，据此判断工具集合是否变化
+        mcp_key = mcp_tools or None
+        cached = _built_tools_cache
+        if cached is not None and cached[0] is mcp_key:
+            return cached[1]
+
+        tools: list[Any] = [*_BASE_TOOLS, *mcp_tools]
         # 关键逻辑：兼容 LLM 误把工具名重复输出（如 web_searchweb_search）
         tools.extend(self._build_tool_aliases(tools))
+        _built_tools_cache = (mcp_key, tools)
         return tools
 
     def _build_tool_aliases(self, tools: list[Any]) -> list[Any]:
@@ -265,6 +553,86 @@ class ChatStreamService:
             aliases.append(_alias)
         return aliases
 
+    async def _append_turn_to_checkpoint(self, *, thread_id: str, user_text: str, answer: str) -> None:
+        """把一轮问答直接追加到会话的 LangGraph checkpoint，不执行模型。
+
+        说明：
+        - 只更新 messages 通道；最小配置的 deep agent 与正常对话的图结构一致（model/tools 节点），以 model 节点身份写入
+        - 模型实例只用于编译图，不会被调用
+        """
+        async with get_checkpointer() as checkpointer:
+            agent = create_deep_agent(
+                model=_get_chat_model(None),
+                tools=[],
+                checkpointer=checkpointer,
+                interrupt_on={},
+            )
+            await agent.aupdate_state(
+                build_langchain_run_config(thread_id=thread_id),
+                {"messages": [HumanMessage(content=user_text), AIMessage(content=answer)]},
+                as_node="model",
+            )
+
+    async def _replay_cached_answer(
+        self,
+        *,
+        cached: dict[str, Any],
+        thread_id: str,
+        assistant_id: str,
+        attachments_meta: list[dict[str, Any]],
+        rag_references: list[dict[str, Any]],
+        checkpoint_user_text: str,
+        memory_user_text: str,
+        persist_chat_memory: bool,
+        emit_suggested_questions: bool,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """回放语义缓存中的回答：事件序列与正常回答一致，并照常写 checkpoint、落库 assistant 消息和会话记忆。
+
+        说明：
+        - checkpoint_user_text 与正常回答写入 agent 的用户消息一致（含强制检索片段）
+        - 带附件时不使用会话记忆，下一轮只能从 checkpoint 拿到上下文，所以这轮问答必须写进去
+        """
+        from backend.utils.snowflake import generate_snowflake_id
+
+        answer = str(cached.get("answer") or "")
+        questions = list(cached.get("suggested_questions") or []) if emit_suggested_questions else []
+
+        yield {"type": "session.status", "status": "thinking"}
+        yield {"type": "message.start", "message_id": str(generate_snowflake_id())}
+        for start in range(0, len(answer), _ANSWER_REPLAY_CHUNK_CHARS):
+            yield {"type": "chat.delta", "text": answer[start : start + _ANSWER_REPLAY_CHUNK_CHARS]}
+
+        try:
+            await self._append_turn_to_checkpoint(thread_id=thread_id, user_text=checkpoint_user_text, answer=answer)
+        except Exception:
+            logger.warning("cached answer checkpoint write failed | thread_id=%s", thread_id, exc_info=True)
+
+        chat_service = get_chat_service()
+        try:
+            await asyncio.to_thread(
+                chat_service.save_assistant_message,
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                content=answer,
+                attachments=attachments_meta,
+                references=rag_references,
+                suggested_questions=questions or None,
+            )
+            if persist_chat_memory:
+                await asyncio.to_thread(
+                    chat_service.save_chat_memory,
+                    thread_id=thread_id,
+                    assistant_id=assistant_id,
+                    user_text=memory_user_text,
+                    assistant_text=answer,
+                )
+        except Exception:
+            logger.warning("cached answer persist failed | thread_id=%s", thread_id, exc_info=True)
+
+        if questions:
+            yield {"type": "suggested.questions", "questions": questions}
+        yield {"type": "session.status", "status": "done"}
+
     async def _handle_stream_error(
         self,
         *,
@@ -360,46 +728,61 @@ class ChatStreamService:
         """
         start_ts = time.monotonic()
         logger.debug(
-            f"stream_chat start | thread_id={thread_id} | assistant_id={assistant_id} | text_len={len(str(text or ''))}"
+            "stream_chat start | thread_id=%s | assistant_id=%s | text_len=%d",
+            thread_id,
+            assistant_id,
+            len(str(text or "")),
         )
-        if file_refs is None:
-            file_refs = []
+        # 关键逻辑：附件 ID 只在入口统一转成 str 列表一次，后续各处直接复用
+        file_refs = [str(x) for x in file_refs] if isinstance(file_refs, list) else []
 
         # 清理旧 checkpoint，防止接口首包延迟过高
-        try:
-            checkpoint_service = CheckpointService()
-            await checkpoint_service.cleanup_keep_last(session_id=thread_id)
-        except Exception:
-            pass
+        # 说明：清理与后续的附件/记忆/RAG 准备互不依赖，这里只启动任务，打开 checkpointer 前再等待
+        cleanup_task = asyncio.create_task(get_checkpoint_service().cleanup_keep_last(session_id=thread_id))
+
+        # 创建 OpenSandbox 远程沙箱（远程容器拉起，通常是首包前最慢的一步）
+        # 说明：沙箱、MCP 工具列表都不依赖附件/记忆/RAG/分流/模型，入口处即启动，与后续步骤重叠执行，用到时再 await
+        sandbox_task = asyncio.create_task(self._provision_sandbox(thread_id=thread_id))
+        # 说明：提前 return 时该任务可能无人 await，这里统一取走异常，避免 "exception was never retrieved" 告警
+        sandbox_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # 说明：_build_tools 内部已吞掉 MCP 加载异常，不需要额外兜底
+        tools_task = asyncio.create_task(self._build_tools())
 
-        # 加载会话记忆（用于上下文延续）
         mongo = get_mongo_manager()
-        memory_text = ""
-        try:
-            memory_text = mongo.get_chat_memory(thread_id=thread_id, assistant_id=assistant_id)
-        except Exception:
-            memory_text = ""
 
-        # 组装系统提示词：沙箱环境指南 + 引用规则 + 文件写入规则
         # 处理附件元数据：将 MongoDB 文档 ID 转为文件名，并生成附件上下文提示词
         attachments_meta: list[dict[str, Any]] = []
-        if isinstance(file_refs, list):
-            attachments_meta = self._build_attachments_meta(mongo=mongo, file_refs=file_refs)
+        if file_refs:
+            attachments_meta = await self._resolve_attachments_meta(mongo=mongo, file_refs=file_refs)
 
-        extra_system_prompt = self._build_system_prompt(
+        # 加载会话记忆（用于上下文延续）
+        # 说明：带附件时提示词只使用附件上下文，不会用到记忆，直接跳过这次 Mongo 查询
+        memory_text = ""
+        if not attachments_meta:
+            try:
+                memory_text = await asyncio.to_thread(
+                    mongo.get_chat_memory, thread_id=thread_id, assistant_id=assistant_id
+                )
+            except Exception:
+                memory_text = ""
+
+        prompt_parts = self._build_system_prompt_parts(
             memory_text=memory_text,
             attachments_meta=attachments_meta,
         )
 
         # 保存用户消息到 MongoDB（包含附件元数据）
-        chat_service = ChatService()
+        chat_service = get_chat_service()
         user_speaker_type = str((user_speaker or {}).get("speaker_type") or "").strip() or None
         user_speaker_id = str((user_speaker or {}).get("speaker_id") or "").strip() or None
         user_speaker_name = str((user_speaker or {}).get("speaker_name") or "").strip() or None
         user_speaker_title = str((user_speaker or {}).get("speaker_title") or "").strip() or None
         user_speaker_personality = str((user_speaker or {}).get("speaker_personality") or "").strip() or None
+        user_save_task: asyncio.Future[Any] | None = None
         if persist_user_message:
-            chat_service.save_user_message(
+            # 说明：放到线程池执行并与强制 RAG 检索并行；agent 开始输出前会先等它完成，保证用户消息先于回复落库
+            user_save_task = asyncio.ensure_future(asyncio.to_thread(
+                chat_service.save_user_message,
                 thread_id=thread_id,
                 assistant_id=assistant_id,
                 content=str(text),
@@ -409,7 +792,7 @@ class ChatStreamService:
                 speaker_title=user_speaker_title,
                 speaker_personality=user_speaker_personality,
                 attachments=attachments_meta,
-            )
+            ))
 
         # 初始化 RAG 相关变量：用于引用管理（给前端展示 & 最终落库）
         rag_references: list[dict[str, Any]] = []
@@ -419,14 +802,60 @@ class ChatStreamService:
             user_text=str(text),
             thread_id=thread_id,
             assistant_id=assistant_id,
-            file_refs=[str(x) for x in file_refs] if isinstance(file_refs, list) else [],
-            system_prompt=extra_system_prompt,
+            file_refs=file_refs,
+            persist_after=user_save_task,
         )
-        extra_system_prompt = rag_prep.extra_system_prompt
+        if user_save_task is not None:
+            await user_save_task
+        if rag_prep.rag_context_prompt:
+            prompt_parts.append(rag_prep.rag_context_prompt)
         rag_references = rag_prep.rag_references
+        rag_snippets_block = rag_prep.rag_snippets_block
         for ev in rag_prep.events:
             yield ev
 
+        try:
+            await cleanup_task
+        except Exception:
+            pass
+
+        # 关键逻辑：回答语义缓存命中时直接回放上一轮回答，跳过模型和沙箱，只把这轮问答补写进 checkpoint
+        # 说明：除问题语义相近外，还要求本轮强制检索的证据与缓存时基本一致（附件内容变化后证据会变）
+        answer_cache_namespace = (thread_id, assistant_id, tuple(sorted(file_refs)))
+        answer_cache_embedding: list[float] | None = None
+        if _ANSWER_CACHE_ENABLED and rag_references and assistant_speaker is None:
+            answer_cache_embedding = await asyncio.to_thread(
+                rag_service.embed_query, assistant_id=assistant_id, file_refs=file_refs, text=str(text)
+            )
+            cached_entries = (
+                get_answer_semantic_cache().get(answer_cache_namespace, answer_cache_embedding)
+                if answer_cache_embedding is not None
+                else None
+            )
+            if cached_entries and (
+                _evidence_jaccard(cached_entries[0].get("evidence") or [], _evidence_keys(rag_references))
+                >= _ANSWER_CACHE_MIN_EVIDENCE_JACCARD
+            ):
+                logger.info("answer cache hit | thread_id=%s | assistant_id=%s", thread_id, assistant_id)
+                # 说明：入口处提前启动的沙箱、工具任务在回放路径用不到，直接取消
+                sandbox_task.cancel()
+                tools_task.cancel()
+                async for ev in self._replay_cached_answer(
+                    cached=cached_entries[0],
+                    thread_id=thread_id,
+                    assistant_id=assistant_id,
+                    attachments_meta=attachments_meta,
+                    rag_references=rag_references,
+                    checkpoint_user_text=self._build_effective_user_text(
+                        text=str(text), rag_snippets_block=rag_snippets_block
+                    ),
+                    memory_user_text=str(memory_user_text if memory_user_text is not None else text),
+                    persist_chat_memory=persist_chat_memory,
+                    emit_suggested_questions=emit_suggested_questions,
+                ):
+                    yield ev
+                return
+
         # 使用 LangGraph checkpointer 进行会话状态持久化
         async with get_checkpointer() as checkpointer:
             # 关键逻辑：分流 LLM 是异步调用，必须在当前事件循环内 await，避免跨线程复用异步对象
@@ -437,7 +866,7 @@ class ChatStreamService:
                     user_text=str(text),
                     has_attachments=bool(attachments_meta),
                     has_rag=bool(rag_references),
-                    files_count=len(file_refs or []),
+                    files_count=len(file_refs),
                 )
                 selected_model_name = decision.model_name
                 logger.info(
@@ -451,8 +880,9 @@ class ChatStreamService:
                 logger.info("router decision failed | thread_id=%s | err=%s", thread_id, str(exc))
 
             # 初始化模型（如果失败则推送错误事件并结束流）
+            # 说明：此时沙箱仍在后台创建，模型构造放到线程池，不阻塞沙箱任务推进
             try:
-                model = create_model(model_name=selected_model_name)
+                model = await asyncio.to_thread(_get_chat_model, selected_model_name)
             except Exception as e:
                 err_msg = f"模型初始化失败：{type(e).__name__}: {e}"
                 logger.exception(err_msg)
@@ -460,23 +890,19 @@ class ChatStreamService:
                 yield {"type": "session.status", "status": "done"}
                 return
 
-            logger.debug(f"模型初始化成功 | thread_id={thread_id} | elapsed_ms={int((time.monotonic()-start_ts)*1000)}")
+            logger.debug(
+                "模型初始化成功 | thread_id=%s | elapsed_ms=%d", thread_id, int((time.monotonic() - start_ts) * 1000)
+            )
             
-            # 初始化基础工具列表：HTTP 请求、网页抓取
-            tools = await self._build_tools()
+            # 初始化基础工具列表：HTTP 请求、网页抓取（+ MCP 工具，入口处已提前开始加载）
+            tools = await tools_task
 
-            # 创建 OpenSandbox 远程沙箱（如果配置可用）
+            # 等待前面提前启动的 OpenSandbox 沙箱任务
             # 说明：沙箱用于执行代码、操作文件系统、运行技能等，提供安全的隔离环境
             sandbox_backend = None
             sandbox_type = None
             try:
-                from backend.services.opensandbox_backend import get_sandbox_manager
-
-                sandbox_manager = get_sandbox_manager()
-                sandbox_backend = await sandbox_manager.get_or_create_sandbox(
-                    session_id=thread_id,
-                    timeout_seconds=600,  # 10 分钟超时
-                )
+                sandbox_backend = await sandbox_task
                 sandbox_type = "opensandbox"
                 logger.info(f"OpenSandbox backend created for session: {thread_id}, sandbox_id: {sandbox_backend.id}")
 
@@ -496,7 +922,10 @@ class ChatStreamService:
                 return
 
             logger.debug(
-                f"sandbox ready | thread_id={thread_id} | has_sandbox={sandbox_backend is not None} | elapsed_ms={int((time.monotonic()-start_ts)*1000)}"
+                "sandbox ready | thread_id=%s | has_sandbox=%s | elapsed_ms=%d",
+                thread_id,
+                sandbox_backend is not None,
+                int((time.monotonic() - start_ts) * 1000),
             )
 
             # 强制要求所有工作都在沙箱中进行，如果没有沙箱则直接报错
@@ -605,7 +1034,8 @@ class ChatStreamService:
                     return {"status": "error", "message": f"save_filesystem_write failed: {str(e)}"}
 
             # 注入 MongoDB 文档入库工具：用于在 write_file 之后保存文档卡片
-            tools.append(save_filesystem_write)
+            # 说明：_build_tools 返回的是跨请求共享的缓存列表，这里新建列表追加本轮工具，不能原地修改
+            tools = [*tools, save_filesystem_write]
 
             # 关键逻辑：按官方推荐，直接调用 deepagents.create_deep_agent
             backend = sandbox_backend
@@ -624,12 +1054,18 @@ class ChatStreamService:
                 "tools": [*tools, rag_prep.rag_tool],
             }
 
-            extra_system_prompt = (extra_system_prompt + "\n\n" + self._build_tool_whitelist_prompt(tools, rag_prep.rag_tool)).strip()
+            # 关键逻辑：系统消息只放稳定内容（基础规则 + 工具白名单），每轮变化的附件/记忆/<rag_context>
+            # 由中间件作为临时消息插到本轮用户输入前，保证 [系统消息 + 历史对话] 跨轮次字节一致，便于前缀缓存
+            stable_system_prompt = "\n\n".join(
+                [_BASE_SYSTEM_PROMPT, self._build_tool_whitelist_prompt(tools, rag_prep.rag_tool)]
+            )
+            turn_context = "\n\n".join(prompt_parts)
 
             agent = create_deep_agent(
                 model=model,
                 tools=[*tools, rag_prep.rag_tool],
-                system_prompt=extra_system_prompt,
+                system_prompt=stable_system_prompt,
+                middleware=[TurnContextMiddleware(turn_context)],
                 checkpointer=checkpointer,
                 backend=backend,
                 skills=skills,
@@ -662,23 +1098,87 @@ class ChatStreamService:
             yield message_start_event
 
             logger.debug(
-                f"agent astream begin | thread_id={thread_id} | message_id={current_message_id} | elapsed_ms={int((time.monotonic()-start_ts)*1000)}"
+                "agent astream begin | thread_id=%s | message_id=%s | elapsed_ms=%d",
+                thread_id,
+                current_message_id,
+                int((time.monotonic() - start_ts) * 1000),
             )
 
             # 构建有效的用户文本（如果有强制 RAG 引用，则加入引用上下文）
-            effective_user_text = self._build_effective_user_text(text=str(text), rag_references=rag_references)
+            effective_user_text = self._build_effective_user_text(
+                text=str(text), rag_snippets_block=rag_snippets_block
+            )
 
             # 准备流式输入和状态变量
             stream_input = {"messages": [HumanMessage(content=effective_user_text)]}
             assistant_accum: list[str] = []
             full_assistant_accum: list[str] = []  # 完整文本，用于 memory
+            full_assistant_chars = 0
+            # 推荐问题预生成：回复攒够前 N 字后即在后台发起，与剩余 token 的生成重叠
+            questions_task: asyncio.Task | None = None
+            next_questions_check = SUGGESTED_QUESTIONS_CONTEXT_CHARS
+            question_user_text = str(memory_user_text if memory_user_text is not None else text)
             stream_event_service = AgentStreamEventService(mongo=mongo)
             stream_state = stream_event_service.init_state()
 
+            # 当前 assistant 文本段的落库状态：首次写入后回填消息 id，之后同一段按 id 覆盖正文
+            segment_message: dict[str, Any] = {"id": None}
+            segment_chars = 0
+            segment_persisted_chars = 0
+
+            def _persist_segment(
+                *,
+                segment: dict[str, Any],
+                content: str,
+                created_at: Any = None,
+                attachments: list[dict[str, Any]] | None = None,
+                references: list[dict[str, Any]] | None = None,
+            ) -> None:
+                """在后台写队列中执行：文本段首次插入，之后只覆盖正文（写队列有序，id 一定先回填）。"""
+                message_id = segment.get("id")
+                if message_id:
+                    chat_service.update_assistant_message(
+                        thread_id, message_id, content, attachments=attachments, references=references
+                    )
+                    return
+                segment["id"] = chat_service.save_assistant_message(
+                    thread_id=thread_id,
+                    assistant_id=assistant_id,
+                    content=content,
+                    speaker_type=assistant_speaker_type,
+                    speaker_id=assistant_speaker_id,
+                    speaker_name=assistant_speaker_name,
+                    speaker_title=assistant_speaker_title,
+                    speaker_personality=assistant_speaker_personality,
+                    attachments=attachments,
+                    references=references,
+                    created_at=created_at,
+                )
+
             # 获取会话取消服务，用于支持中断流式生成
             cancel_service = get_session_cancel_service()
             cancel_version = cancel_service.get_version(thread_id)
-            
+
+            # chat.delta 合并缓冲：减少逐 token 的 yield / SSE 帧 / JSON 序列化次数
+            delta_buf: list[str] = []
+            delta_buf_chars = 0
+            last_delta_flush = time.monotonic()
+            first_delta_sent = False
+
+            def _drain_delta_buf() -> dict[str, Any] | None:
+                nonlocal delta_buf_chars, last_delta_flush
+                last_delta_flush = time.monotonic()
+                if not delta_buf:
+                    return None
+                merged = "".join(delta_buf)
+                delta_buf.clear()
+                delta_buf_chars = 0
+                return {"type": "chat.delta", "text": merged}
+
+            def _delta_flush_deadline() -> float | None:
+                # 说明：缓冲非空时，最晚在上次 flush 后 _DELTA_FLUSH_SECONDS 下发，不依赖下一个文本增量到达
+                return last_delta_flush + _DELTA_FLUSH_SECONDS if delta_buf else None
+
             # 开始流式处理 agent 输出
             # 说明：部分模型供应方偶发会主动断开连接，导致 httpx 报 incomplete chunked read
             # 这里在“尚未输出任何内容”时允许快速重试一次，避免用户空响应
@@ -686,10 +1186,27 @@ class ChatStreamService:
             max_rate_retries = 2
             retry_count = 0
             rate_retry_count = 0
+
+            # 关键逻辑：后台监听取消，工具长时间执行（没有新 chunk）时也能立即中断 astream
+            cancel_guard = _AstreamCancelGuard()
+            current_task = asyncio.current_task()
+            cancel_watcher = asyncio.create_task(
+                _watch_cancel(
+                    cancel_service=cancel_service,
+                    thread_id=thread_id,
+                    cancel_version=cancel_version,
+                    guard=cancel_guard,
+                    target_task=current_task,
+                )
+            )
+            # 本轮是否被取消或报错结束（这类不完整的回答不进回答缓存）
+            stream_aborted = False
+            # 说明：循环内每个 chunk 都会用到的方法提前绑定到局部变量，省去逐 chunk 的属性查找
+            parse_chunk = stream_event_service.parse_chunk
             try:
                 while True:
                     try:
-                        async for chunk in agent.astream(
+                        agent_stream = agent.astream(
                             stream_input,
                             stream_mode=["messages"],
                             subgraphs=True,
@@ -702,17 +1219,27 @@ class ChatStreamService:
                                     "has_attachments": bool(file_refs),
                                 },
                             ),
-                        ):
+                        )
+                        async for chunk in _iter_with_cancel_guard(agent_stream, cancel_guard, _delta_flush_deadline):
                             # 检测会话是否已被取消，如果是则中断流式生成
-                            if cancel_service.is_cancelled(thread_id, cancel_version):
+                            # 说明：标记由 _watch_cancel 收到取消通知时置位，这里逐 chunk 只读一个属性
+                            if cancel_guard.requested:
                                 logger.info(f"会话已取消，中断流式生成: session_id={thread_id}")
+                                stream_aborted = True
+                                flushed = _drain_delta_buf()
+                                if flushed:
+                                    yield flushed
                                 yield {"type": "session.status", "status": "cancelled"}
                                 break
 
-                            # 记录 parse 前的时间戳，用于确保 assistant 文本段的 created_at 早于 tool 消息
-                            pre_parse_time = get_beijing_time()
+                            # 关键逻辑：缓冲文本到了合并窗口仍没有新 chunk（推理块、工具执行、供应方卡顿等），直接推出去
+                            if chunk is _FLUSH_TICK:
+                                flushed = _drain_delta_buf()
+                                if flushed:
+                                    yield flushed
+                                continue
 
-                            parsed = stream_event_service.parse_chunk(
+                            parsed = parse_chunk(
                                 chunk=chunk,
                                 state=stream_state,
                                 thread_id=thread_id,
@@ -722,35 +1249,102 @@ class ChatStreamService:
                             )
 
                             # 先累积本轮 delta（使文本在检测 tool.start 前已入 accum）
-                            for delta in parsed.assistant_deltas:
-                                assistant_accum.append(str(delta))
-                                full_assistant_accum.append(str(delta))
+                            # 说明：parse_chunk 产出的 delta 已经是 str，直接 extend，避免逐条 str() 和方法查找
+                            if parsed.assistant_deltas:
+                                assistant_accum.extend(parsed.assistant_deltas)
+                                full_assistant_accum.extend(parsed.assistant_deltas)
+                                delta_chars = sum(map(len, parsed.assistant_deltas))
+                                full_assistant_chars += delta_chars
+                                segment_chars += delta_chars
+                                if segment_chars - segment_persisted_chars >= _SEGMENT_PERSIST_CHARS:
+                                    # 说明：顺便把分片压成一个字符串，后续增量落库不必从头 join
+                                    segment_snapshot = "".join(assistant_accum)
+                                    assistant_accum = [segment_snapshot]
+                                    segment_persisted_chars = segment_chars
+                                    stream_event_service.schedule_write(
+                                        _persist_segment,
+                                        segment=segment_message,
+                                        content=segment_snapshot.strip(),
+                                    )
+                                if (
+                                    emit_suggested_questions
+                                    and questions_task is None
+                                    and full_assistant_chars >= next_questions_check
+                                    and not stream_state.active_tool_ids
+                                ):
+                                    # 说明：prompt 只用回复的前 N 字，攒够后结果与流结束时再生成完全一致
+                                    question_context = "".join(full_assistant_accum).strip()
+                                    if len(question_context) >= SUGGESTED_QUESTIONS_CONTEXT_CHARS:
+                                        questions_task = asyncio.create_task(
+                                            self._generate_suggested_questions(
+                                                model=model,
+                                                user_text=question_user_text,
+                                                assistant_text=question_context[:SUGGESTED_QUESTIONS_CONTEXT_CHARS],
+                                            )
+                                        )
+                                    else:
+                                        next_questions_check = full_assistant_chars + 64
 
                             # 关键逻辑：如果本轮事件包含 tool.start，把已累积的文本段
                             # 保存为独立的 assistant 消息（created_at < tool 消息），实现历史交叉
-                            if any(ev.get("type") == "tool.start" for ev in parsed.events):
+                            if parsed.events and any(ev.get("type") == "tool.start" for ev in parsed.events):
                                 segment_text = "".join(assistant_accum).strip()
                                 if segment_text:
-                                    try:
-                                        chat_service.save_assistant_message(
-                                            thread_id=thread_id,
-                                            assistant_id=assistant_id,
-                                            content=segment_text,
-                                            speaker_type=assistant_speaker_type,
-                                            speaker_id=assistant_speaker_id,
-                                            speaker_name=assistant_speaker_name,
-                                            speaker_title=assistant_speaker_title,
-                                            speaker_personality=assistant_speaker_personality,
-                                            created_at=pre_parse_time,
-                                        )
-                                    except Exception:
-                                        logger.debug("save assistant segment failed", exc_info=True)
+                                    # 关键逻辑：与 tool message 走同一条后台写入链，保证落库顺序且不阻塞流式输出
+                                    # 说明：tool message 的 created_at 在后台 worker 真正执行时才取，而 worker 要等本轮让出
+                                    # 事件循环后才会执行；这里只在出现 tool.start 时取一次时间，仍然早于 tool 消息
+                                    stream_event_service.schedule_write(
+                                        _persist_segment,
+                                        segment=segment_message,
+                                        content=segment_text,
+                                        created_at=get_beijing_time(),
+                                    )
                                     assistant_accum = []
+                                    segment_message = {"id": None}
+                                    segment_chars = 0
+                                    segment_persisted_chars = 0
 
                             for ev in parsed.events:
+                                if ev.get("type") == "chat.delta":
+                                    delta_text = ev.get("text") or ""
+                                    delta_buf.append(delta_text)
+                                    delta_buf_chars += len(delta_text)
+                                    # 说明：首个文本增量立即下发，不让合并窗口拖慢首字时间
+                                    if (
+                                        not first_delta_sent
+                                        or delta_buf_chars >= _DELTA_FLUSH_CHARS
+                                        or time.monotonic() - last_delta_flush >= _DELTA_FLUSH_SECONDS
+                                    ):
+                                        first_delta_sent = True
+                                        yield _drain_delta_buf()
+                                    continue
+                                # 结构化事件（tool.start/tool.end 等）前先把缓冲文本推出去，保证顺序
+                                flushed = _drain_delta_buf()
+                                if flushed:
+                                    yield flushed
                                 yield ev
+                        flushed = _drain_delta_buf()
+                        if flushed:
+                            yield flushed
+                        break
+                    except asyncio.CancelledError:
+                        if not cancel_guard.fired:
+                            raise
+                        # 取消由本地监听触发：撤销任务取消状态，按正常取消流程收尾（落库已生成内容）
+                        uncancel = getattr(current_task, "uncancel", None)
+                        if uncancel is not None:
+                            uncancel()
+                        logger.info(f"会话已取消，立即中断流式生成: session_id={thread_id}")
+                        stream_aborted = True
+                        flushed = _drain_delta_buf()
+                        if flushed:
+                            yield flushed
+                        yield {"type": "session.status", "status": "cancelled"}
                         break
                     except Exception as exc:
+                        flushed = _drain_delta_buf()
+                        if flushed:
+                            yield flushed
                         should_continue, retry_count, rate_retry_count, stream_state, err_msg = await self._handle_stream_error(
                             exc=exc,
                             thread_id=thread_id,
@@ -764,68 +1358,134 @@ class ChatStreamService:
                         )
                         if should_continue:
                             continue
+                        stream_aborted = True
                         if err_msg:
                             yield {"type": "error", "message": err_msg}
                         break
             finally:
+                if cancel_watcher is not None:
+                    cancel_watcher.cancel()
+                # 说明：用 logger 的惰性格式化，未开启 debug 时不拼接日志字符串
                 logger.debug(
-                    f"stream_chat finalize | thread_id={thread_id} | elapsed_ms={int((time.monotonic()-start_ts)*1000)} | assistant_chars={len(''.join(assistant_accum))}"
+                    "stream_chat finalize | thread_id=%s | elapsed_ms=%d | assistant_chars=%d",
+                    thread_id,
+                    int((time.monotonic() - start_ts) * 1000),
+                    sum(map(len, assistant_accum)),
                 )
                 try:
-                    if stream_state.pending_text_deltas:
-                        for delta in stream_state.pending_text_deltas:
-                            assistant_accum.append(str(delta))
-                            full_assistant_accum.append(str(delta))
-                            yield {"type": "chat.delta", "text": str(delta)}
-                        stream_state.pending_text_deltas = []
+                    flushed = _drain_delta_buf()
+                    if flushed:
+                        yield flushed
+                    pending_text = stream_state.drain_pending_text()
+                    if pending_text:
+                        assistant_accum.append(pending_text)
+                        full_assistant_accum.append(pending_text)
+                        yield {"type": "chat.delta", "text": pending_text}
 
                     # 最后一段 assistant 文本（可能是唯一一段，也可能是最后一段）
                     assistant_text = "".join(assistant_accum).strip()
                     # 完整文本用于 memory 和推荐问题
                     full_text = "".join(full_assistant_accum).strip()
-                    suggested_questions: list[str] = []
-
-                    if full_text and emit_suggested_questions:
-                        try:
-                            question_source_text = str(memory_user_text if memory_user_text is not None else text)
-                            question_prompt = suggested_questions_prompt(question_source_text, full_text)
-
-                            question_msg = await model.ainvoke([HumanMessage(content=question_prompt)])
-                            questions_text = getattr(question_msg, "content", "") or ""
-                            suggested_questions = [
-                                q.strip()
-                                for q in questions_text.strip().split("\n")
-                                if q.strip() and not q.strip().startswith("#")
-                            ][:3]
-
-                            if suggested_questions:
-                                yield {"type": "suggested.questions", "questions": suggested_questions}
-                        except Exception:
-                            pass
 
+                    # 关键逻辑：最终消息先进后台写队列（排在 tool message 之后），推荐问题生成与落库并行；
+                    # 推荐问题生成后再回填到这条消息上
+                    # 说明：最后一段若已增量落库过，这里只覆盖正文并补上附件/引用
+                    final_message: dict[str, str | None] = {}
                     if assistant_text:
-                        chat_service.save_assistant_message(
-                            thread_id=thread_id,
-                            assistant_id=assistant_id,
-                            content=assistant_text,
-                            speaker_type=assistant_speaker_type,
-                            speaker_id=assistant_speaker_id,
-                            speaker_name=assistant_speaker_name,
-                            speaker_title=assistant_speaker_title,
-                            speaker_personality=assistant_speaker_personality,
-                            attachments=attachments_meta,
-                            references=rag_references,
-                            suggested_questions=suggested_questions,
-                        )
+                        final_segment = segment_message
+
+                        def _save_final_message() -> None:
+                            _persist_segment(
+                                segment=final_segment,
+                                content=assistant_text,
+                                attachments=attachments_meta,
+                                references=rag_references,
+                            )
+                            final_message["id"] = final_segment.get("id")
+
+                        stream_event_service.schedule_write(_save_final_message)
                     if full_text and persist_chat_memory:
                         memory_user = str(memory_user_text if memory_user_text is not None else text)
-                        chat_service.save_chat_memory(
+                        stream_event_service.schedule_write(
+                            chat_service.save_chat_memory,
                             thread_id=thread_id,
                             assistant_id=assistant_id,
                             user_text=memory_user,
                             assistant_text=full_text,
                         )
+
+                    suggested_questions: list[str] = []
+                    if full_text and emit_suggested_questions:
+                        if questions_task is None:
+                            questions_task = asyncio.create_task(
+                                self._generate_suggested_questions(
+                                    model=model,
+                                    user_text=question_user_text,
+                                    assistant_text=full_text,
+                                )
+                            )
+
+                        def _attach_suggested_questions(questions: list[str]) -> None:
+                            message_id = final_message.get("id")
+                            if message_id:
+                                chat_service.save_suggested_questions(thread_id, message_id, questions)
+
+                        # 关键逻辑：推荐问题只等一个很短的预算，避免最后一个 token 之后流“卡住”；
+                        # 超时则直接结束流，生成完成后再在后台回填到最终消息上（前端刷新历史即可看到）
+                        try:
+                            suggested_questions = await asyncio.wait_for(
+                                asyncio.shield(questions_task), timeout=_SUGGESTED_QUESTIONS_WAIT_SECONDS
+                            )
+                        except asyncio.TimeoutError:
+                            suggested_questions = []
+                            if assistant_text:
+
+                                async def _attach_late_questions(task: asyncio.Task) -> None:
+                                    late_questions = await task
+                                    if late_questions:
+                                        stream_event_service.schedule_write(
+                                            _attach_suggested_questions, questions=late_questions
+                                        )
+                                        await stream_event_service.flush_writes()
+
+                                late_task = asyncio.create_task(_attach_late_questions(questions_task))
+                                _background_tasks.add(late_task)
+                                late_task.add_done_callback(_background_tasks.discard)
+
+                        if suggested_questions:
+                            yield {"type": "suggested.questions", "questions": suggested_questions}
+                            if assistant_text:
+                                stream_event_service.schedule_write(
+                                    _attach_suggested_questions, questions=suggested_questions
+                                )
+
+                    # 说明：只缓存一次性完整输出、没有经过 agent 工具调用的回答，回放时不会缺少中间步骤
+                    if (
+                        answer_cache_embedding is not None
+                        and not stream_aborted
+                        and not stream_state.started_tools
+                        and assistant_text
+                        and assistant_text == full_text
+                    ):
+                        get_answer_semantic_cache().put(
+                            answer_cache_namespace,
+                            answer_cache_embedding,
+                            [
+                                {
+                                    "answer": full_text,
+                                    "evidence": _evidence_keys(rag_references),
+                                    "suggested_questions": list(suggested_questions),
+                                }
+                            ],
+                        )
                 except Exception:
                     pass
 
+                # 等待后台 tool message / 文本段 / 最终消息落库完成，避免生成器关闭后写入丢失
+                if not await stream_event_service.flush_writes(timeout=_FINAL_FLUSH_TIMEOUT_SECONDS):
+                    logger.warning(
+                        "stream_chat final flush timed out, writes continue in background | thread_id=%s",
+                        thread_id,
+                    )
+
                 yield {"type": "session.status", "status": "done"}
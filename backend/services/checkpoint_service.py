@@ -5,7 +5,7 @@ from dataclasses import dataclass
 
 import aiosqlite
 
-from backend.services.checkpointer_provider import get_db_path
+from backend.services.checkpointer_provider import get_checkpoint_db, get_db_path
 
 
 @dataclass(frozen=True)
@@ -56,48 +56,43 @@ class CheckpointService:
         deleted_checkpoints = 0
         deleted_writes = 0
 
-        async with aiosqlite.connect(str(db_path)) as db:
+        async with get_checkpoint_db(db_path) as db:
             # 关键逻辑：有些环境会存在“数据库文件已创建，但 checkpoint 表尚未初始化”的情况。
             # 这里直接返回 0，避免删除会话时抛 no such table。
             has_checkpoints = await self._table_exists(db, "checkpoints")
             if not has_checkpoints:
                 return CheckpointCleanupResult(deleted_checkpoints=0, deleted_writes=0)
 
-            # 找到需要删除的旧 checkpoint_id 列表
-            cursor = await db.execute(
-                """
+            # 关键逻辑：旧 checkpoint_id 直接用子查询圈定，不再先 SELECT 到 Python 再拼 IN (?, ?, ...)
+            # 说明：两条 DELETE 放在同一个 IMMEDIATE 事务里，一次提交；先删 writes，再删 checkpoints，避免残留
+            old_ids_subquery = """
                 SELECT checkpoint_id
                 FROM checkpoints
                 WHERE thread_id = ?
                 ORDER BY checkpoint_id DESC
                 LIMIT -1 OFFSET ?
-                """,
-                (session_id, self._keep_last),
-            )
-            rows = await cursor.fetchall()
-            old_ids = [r[0] for r in rows if r and r[0]]
-
-            if not old_ids:
-                return CheckpointCleanupResult(deleted_checkpoints=0, deleted_writes=0)
-
-            placeholders = ",".join(["?"] * len(old_ids))
-
-            # 先删 writes，再删 checkpoints，避免残留
+            """
             has_writes = await self._table_exists(db, "writes")
-            if has_writes:
-                cur_w = await db.execute(
-                    f"DELETE FROM writes WHERE thread_id = ? AND checkpoint_id IN ({placeholders})",
-                    (session_id, *old_ids),
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                if has_writes:
+                    cur_w = await db.execute(
+                        f"DELETE FROM writes WHERE thread_id = ? AND checkpoint_id IN ({old_ids_subquery})",
+                        (session_id, session_id, self._keep_last),
+                    )
+                    deleted_writes = int(cur_w.rowcount or 0)
+
+                cur_c = await db.execute(
+                    f"DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id IN ({old_ids_subquery})",
+                    (session_id, session_id, self._keep_last),
                 )
-                deleted_writes = int(cur_w.rowcount or 0)
-
-            cur_c = await db.execute(
-                f"DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id IN ({placeholders})",
-                (session_id, *old_ids),
-            )
-            deleted_checkpoints = int(cur_c.rowcount or 0)
+                deleted_checkpoints = int(cur_c.rowcount or 0)
 
-            await db.commit()
+                await db.commit()
+            except Exception:
+                # 说明：连接可能是进程共享的，失败时必须回滚，不能把未完成的事务留给后续请求
+                await db.rollback()
+                raise
 
         return CheckpointCleanupResult(deleted_checkpoints=deleted_checkpoints, deleted_writes=deleted_writes)
 
@@ -108,7 +103,7 @@ class CheckpointService:
             return CheckpointCleanupResult(deleted_checkpoints=0, deleted_writes=0)
 
         db_path = get_db_path()
-        async with aiosqlite.connect(str(db_path)) as db:
+        async with get_checkpoint_db(db_path) as db:
             # 关键逻辑：兼容尚未初始化 checkpoint 表的数据库文件。
             # 例如新环境首次删除会话时，db 可能存在但表不存在。
             has_writes = await self._table_exists(db, "writes")
@@ -117,15 +112,31 @@ class CheckpointService:
             deleted_writes = 0
             deleted_checkpoints = 0
 
-            if has_writes:
-                cur_w = await db.execute("DELETE FROM writes WHERE thread_id = ?", (session_id,))
-                deleted_writes = int(cur_w.rowcount or 0)
-            if has_checkpoints:
-                cur_c = await db.execute("DELETE FROM checkpoints WHERE thread_id = ?", (session_id,))
-                deleted_checkpoints = int(cur_c.rowcount or 0)
-            await db.commit()
+            try:
+                if has_writes:
+                    cur_w = await db.execute("DELETE FROM writes WHERE thread_id = ?", (session_id,))
+                    deleted_writes = int(cur_w.rowcount or 0)
+                if has_checkpoints:
+                    cur_c = await db.execute("DELETE FROM checkpoints WHERE thread_id = ?", (session_id,))
+                    deleted_checkpoints = int(cur_c.rowcount or 0)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
 
         return CheckpointCleanupResult(
             deleted_checkpoints=deleted_checkpoints,
             deleted_writes=deleted_writes,
         )
+
+
+_checkpoint_service: CheckpointService | None = None
+
+
+def get_checkpoint_service() -> CheckpointService:
+    """获取全局 checkpoint 服务单例（keep_last 在首次创建时从环境变量读取）。"""
+
+    global _checkpoint_service
+    if _checkpoint_service is None:
+        _checkpoint_service = CheckpointService()
+    return _checkpoint_service
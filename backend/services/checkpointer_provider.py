@@ -3,16 +3,43 @@
 说明：
 - 承接原 deepagents_cli.sessions 的职责。
 - checkpointer 数据落在相对路径 .deepagents/sessions.db，避免绝对路径导致部署问题。
+- 服务启动时打开一条共享连接（open_shared_checkpointer），各请求复用同一个 AsyncSqliteSaver，
+  不再每轮对话重新打开数据库、重复 PRAGMA/建表检查；未打开共享连接时（脚本、测试）回退为按次打开。
 """
 
 from __future__ import annotations
 
+import asyncio
 from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import AsyncIterator
 
+import aiosqlite
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 
+# 共享连接只在打开它的事件循环内复用（aiosqlite/AsyncSqliteSaver 的锁与 future 都绑定事件循环）
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+# 说明：LangGraph 的主键是 (thread_id, checkpoint_ns, checkpoint_id, ...)，cleanup_keep_last 按 thread_id
+# 取 checkpoint_id 倒序时会走临时排序；补两条 (thread_id, checkpoint_id) 索引，让清理变成索引扫描
+_SQLITE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_checkpoints_thread_checkpoint ON checkpoints(thread_id, checkpoint_id DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_writes_thread_checkpoint ON writes(thread_id, checkpoint_id)",
+)
+
+_shared_conn: aiosqlite.Connection | None = None
+_shared_saver: AsyncSqliteSaver | None = None
+_shared_loop: asyncio.AbstractEventLoop | None = None
+_shared_db_path: Path | None = None
+
+
 def get_db_path() -> Path:
     """获取 checkpoint 数据库路径。"""
 
@@ -21,10 +48,88 @@ def get_db_path() -> Path:
     return db_path
 
 
+def _get_shared_saver() -> AsyncSqliteSaver | None:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+    if _shared_saver is None or _shared_loop is not loop:
+        return None
+    return _shared_saver
+
+
+async def open_shared_checkpointer() -> None:
+    """打开进程级共享的 checkpoint 连接（在服务启动时调用，重复调用无副作用）。
+
+    说明：PRAGMA 与辅助索引只在这里执行一次，之后所有请求复用这条连接
+    """
+
+    global _shared_conn, _shared_saver, _shared_loop, _shared_db_path
+    if _get_shared_saver() is not None:
+        return
+
+    db_path = get_db_path()
+    conn = await aiosqlite.connect(str(db_path))
+    try:
+        for pragma in _SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+        saver = AsyncSqliteSaver(conn)
+        await saver.setup()
+        for statement in _SQLITE_INDEXES:
+            await conn.execute(statement)
+        await conn.commit()
+    except BaseException:
+        # 说明：aiosqlite 的工作线程不是守护线程，初始化失败时必须关闭连接，否则进程退出会被卡住
+        await conn.close()
+        raise
+
+    _shared_conn = conn
+    _shared_saver = saver
+    _shared_loop = asyncio.get_running_loop()
+    _shared_db_path = db_path.resolve()
+
+
+async def close_shared_checkpointer() -> None:
+    """关闭共享的 checkpoint 连接（在服务退出时调用）。"""
+
+    global _shared_conn, _shared_saver, _shared_loop, _shared_db_path
+    conn = _shared_conn
+    _shared_conn = None
+    _shared_saver = None
+    _shared_loop = None
+    _shared_db_path = None
+    if conn is not None:
+        await conn.close()
+
+
 @asynccontextmanager
-async def get_checkpointer():
+async def get_checkpointer() -> AsyncIterator[AsyncSqliteSaver]:
     """异步获取 SQLite checkpointer。"""
 
+    saver = _get_shared_saver()
+    if saver is not None:
+        yield saver
+        return
+
     db_path = get_db_path()
     async with AsyncSqliteSaver.from_conn_string(str(db_path)) as saver:
         yield saver
+
+
+@asynccontextmanager
+async def get_checkpoint_db(db_path: Path) -> AsyncIterator[aiosqlite.Connection]:
+    """获取用于直接维护 checkpoint 表的连接。
+
+    说明：
+    - db_path 与共享连接一致时复用共享连接，并持有 saver 的锁，避免与 checkpointer 的读写在同一连接上交错
+    - 否则临时打开一条连接，用完即关
+    """
+
+    saver = _get_shared_saver()
+    if saver is not None and _shared_conn is not None and _shared_db_path == Path(db_path).resolve():
+        async with saver.lock:
+            yield _shared_conn
+        return
+
+    async with aiosqlite.connect(str(db_path)) as db:
+        yield db
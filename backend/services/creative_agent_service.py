@@ -7,11 +7,14 @@
 
 from __future__ import annotations
 
+import functools
 import json
+import re
 import sqlite3
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Iterator
 
 from deepagents import create_deep_agent
 from deepagents.backends import FilesystemBackend
@@ -19,6 +22,7 @@ from langchain.agents.middleware.types import AgentMiddleware, ModelRequest
 from langgraph.checkpoint.sqlite import SqliteSaver
 
 from backend.config.deepagents_settings import create_model
+from backend.utils.json_utils import json_loads
 
 
 @dataclass(slots=True)
@@ -65,17 +69,23 @@ class ToolPermissionPolicy:
     """工具白名单策略。"""
 
     def __init__(self, allowed_tools: set[str]) -> None:
-        self.allowed_tools = allowed_tools
+        self.allowed_tools = frozenset(allowed_tools)
+        # 说明：模型每次调用拿到的通常是同一批工具对象，按对象身份记住上一次的过滤结果
+        self._last_filtered: tuple[tuple[Any, ...], list[Any]] | None = None
+
+    def _is_allowed(self, tool: Any) -> bool:
+        name = getattr(tool, "name", None)
+        if name is None and callable(tool):
+            name = getattr(tool, "__name__", None)
+        return isinstance(name, str) and name in self.allowed_tools
 
     def filter_tools(self, tools: list[Any]) -> list[Any]:
-        filtered: list[Any] = []
-        for tool in tools:
-            name = getattr(tool, "name", None)
-            if name is None and callable(tool):
-                name = getattr(tool, "__name__", None)
-            if isinstance(name, str) and name in self.allowed_tools:
-                filtered.append(tool)
-        return filtered
+        last = self._last_filtered
+        if last is not None and len(last[0]) == len(tools) and all(a is b for a, b in zip(last[0], tools)):
+            return list(last[1])
+        filtered = [tool for tool in tools if self._is_allowed(tool)]
+        self._last_filtered = (tuple(tools), filtered)
+        return list(filtered)
 
 
 class ToolPermissionMiddleware(AgentMiddleware):
@@ -85,7 +95,13 @@ class ToolPermissionMiddleware(AgentMiddleware):
         self._policy = policy
 
     def wrap_model_call(self, request: ModelRequest, handler):  # type: ignore[override]
-        filtered_tools = self._policy.filter_tools(list(request.tools or []))
+        tools = request.tools
+        if not tools:
+            return handler(request)
+        filtered_tools = self._policy.filter_tools(tools)
+        # 说明：没有工具被拦下时直接透传，省一次 request.override 拷贝
+        if len(filtered_tools) == len(tools):
+            return handler(request)
         return handler(request.override(tools=filtered_tools))
 
 
@@ -103,43 +119,133 @@ AGENT_A_ALLOWED_TOOLS = {
 
 AGENT_BC_ALLOWED_TOOLS = {"ls", "read_file", "glob", "grep"}
 
+# 创作 checkpoint 库的连接参数：WAL 下不同 run 的连接读写互不阻塞，NORMAL 同步减少每次 checkpoint 提交的 fsync
+_CHECKPOINT_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
 
-class LlmPreAgentPlanner:
-    """Pre-Agent 方案生成器。"""
 
-    def __init__(self) -> None:
-        self._llm = create_model()
+@functools.lru_cache(maxsize=1)
+def _shared_llm() -> Any:
+    """进程内共享的创作模式模型实例（Pre-Agent 与 A/B/C 共用，配置来自环境变量，运行期不变）。
+
+    说明：ChatOpenAI 调用时不修改自身状态（bind/with_config 返回新对象），多个 run 的线程并发使用是安全的
+    """
+    return create_model()
+
+
+_PLAN_KEYS = ("content_goal", "agent_a_prompt", "agent_b_prompt", "agent_c_prompt", "output_requirements")
+
+# 增量扫描 JSON 结构字符：转义序列整体匹配，避免把 \" 当成字符串边界
+_JSON_STRUCTURE_RE = re.compile(r'\\.|["{}\[\]]', re.S)
+
+
+def _iter_content_text(content: list[Any]) -> Iterator[str]:
+    for item in content:
+        if isinstance(item, str):
+            yield item
+        elif isinstance(item, dict):
+            text = item.get("text")
+            if isinstance(text, str) and text:
+                yield text
+
+
+def _content_to_text(content: Any) -> str:
+    """把消息 content 转成纯文本（流式逐 chunk 调用，Pre-Agent 与 A/B/C 共用）。
+
+    说明：绝大多数 chunk 的 content 就是 str，先走这条最短路径；分块列表只取文本块，空文本块跳过
+    """
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(_iter_content_text(content))
+    return str(content or "")
+
 
-    def _extract_json(self, raw_text: str) -> dict[str, Any]:
-        raw = str(raw_text or "").strip()
-        if not raw:
+def _parse_loose_json(raw_text: str) -> dict[str, Any]:
+    """解析模型输出里的 JSON 对象，失败返回空 dict。
+
+    说明：
+    - 先整体解析（orjson）；失败时截取第一个 { 到最后一个 } 之间的内容再解析一次，兼容 ```json 围栏和前后说明文字
+    - 解析结果不是对象时同样视为失败，调用方可以放心 .get
+    """
+    raw = str(raw_text or "").strip()
+    if not raw:
+        return {}
+    try:
+        parsed = json_loads(raw)
+    except json.JSONDecodeError:
+        start = raw.find("{")
+        end = raw.rfind("}")
+        if start < 0 or end <= start:
             return {}
         try:
-            return json.loads(raw)
+            parsed = json_loads(raw[start : end + 1])
         except json.JSONDecodeError:
-            start = raw.find("{")
-            end = raw.rfind("}")
-            if start >= 0 and end > start:
-                try:
-                    return json.loads(raw[start : end + 1])
-                except json.JSONDecodeError:
-                    return {}
             return {}
+    return parsed if isinstance(parsed, dict) else {}
+
 
-    def _content_to_text(self, content: Any) -> str:
-        if isinstance(content, str):
-            return content
-        if isinstance(content, list):
-            parts: list[str] = []
-            for item in content:
-                if isinstance(item, dict):
-                    text = item.get("text")
-                    if isinstance(text, str) and text:
-                        parts.append(text)
-                elif isinstance(item, str):
-                    parts.append(item)
-            return "\n".join(parts)
-        return str(content or "")
+class _JsonObjectScanner:
+    """在流式文本里增量定位第一个完整的 JSON 对象。
+
+    说明：
+    - 跳过对象之前的内容（例如 ```json 围栏、前言），之后按分片跟踪括号深度（忽略字符串内部）
+    - 每个分片只扫描一次；顶层对象闭合时 feed 返回对象文本，之后不再扫描
+    """
+
+    def __init__(self) -> None:
+        self._parts: list[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._started = False
+        self._carry = ""
+        self.result: str | None = None
+
+    def feed(self, text: str) -> str | None:
+        if self.result is not None:
+            return self.result
+        scan = self._carry + text
+        self._carry = ""
+        if not self._started:
+            start = scan.find("{")
+            if start < 0:
+                return None
+            self._started = True
+            scan = scan[start:]
+
+        last_end = 0
+        for m in _JSON_STRUCTURE_RE.finditer(scan):
+            last_end = m.end()
+            ch = m.group()
+            if ch == '"':
+                self._in_string = not self._in_string
+            elif self._in_string or len(ch) > 1:
+                continue
+            elif ch in "{[":
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._parts.append(scan[:last_end])
+                    self.result = "".join(self._parts)
+                    return self.result
+        # 说明：分片恰好以转义符结尾时，留到下一个分片和后续字符一起识别
+        if last_end < len(scan) and scan.endswith("\\"):
+            self._carry = "\\"
+            scan = scan[:-1]
+        self._parts.append(scan)
+        return None
+
+
+class LlmPreAgentPlanner:
+    """Pre-Agent 方案生成器。"""
+
+    def __init__(self) -> None:
+        self._llm = _shared_llm()
 
     def plan(
         self,
@@ -164,22 +270,32 @@ class LlmPreAgentPlanner:
         )
 
         chunks: list[str] = []
+        scanner = _JsonObjectScanner()
+        parsed: dict[str, Any] = {}
         try:
             for chunk in self._llm.stream(prompt):
-                text = self._content_to_text(getattr(chunk, "content", ""))
+                text = _content_to_text(getattr(chunk, "content", ""))
                 if text:
                     chunks.append(text)
                     if on_chunk:
                         on_chunk(text)
+                    # 关键逻辑：边收边扫描，JSON 对象一闭合就解析；字段齐全时提前结束流，不再等围栏/结尾废话
+                    object_text = scanner.feed(text)
+                    if object_text is not None:
+                        parsed = _parse_loose_json(object_text)
+                        if all(key in parsed for key in _PLAN_KEYS):
+                            break
         except Exception:
             chunks = []
+            parsed = {}
 
-        text = "".join(chunks).strip()
-        if not text:
-            result = self._llm.invoke(prompt)
-            text = self._content_to_text(getattr(result, "content", ""))
+        if not parsed:
+            text = "".join(chunks).strip()
+            if not text:
+                result = self._llm.invoke(prompt)
+                text = _content_to_text(getattr(result, "content", ""))
+            parsed = _parse_loose_json(text)
 
-        parsed = self._extract_json(text)
         fallback = default_prompt_plan(user_prompt)
         if not parsed:
             return fallback
@@ -207,40 +323,78 @@ class DeepCreativeAgentClient:
         self._prompt_plan = prompt_plan
         self._workspace_root = workspace_root
 
-        backend = FilesystemBackend(root_dir=self._workspace_root, virtual_mode=False)
-        llm = create_model()
+        self._backend = FilesystemBackend(root_dir=self._workspace_root, virtual_mode=False)
+        self._llm = _shared_llm()
 
         checkpoint_dir = Path(".deepagents") / "creative" / "checkpoint"
         checkpoint_dir.mkdir(parents=True, exist_ok=True)
         db_path = checkpoint_dir / "agent_memory.sqlite"
         self._checkpoint_conn = sqlite3.connect(db_path, check_same_thread=False)
-        checkpointer = SqliteSaver(self._checkpoint_conn)
+        for pragma in _CHECKPOINT_SQLITE_PRAGMAS:
+            self._checkpoint_conn.execute(pragma)
+        self._checkpointer = SqliteSaver(self._checkpoint_conn)
 
         self._thread_id_a = f"creative:{self._run_id}:agent_a"
         self._thread_id_b = f"creative:{self._run_id}:agent_b"
         self._thread_id_c = f"creative:{self._run_id}:agent_c"
 
-        self._agent_a = create_deep_agent(
-            model=llm,
-            system_prompt=self._agent_a_system_prompt(),
-            backend=backend,
-            checkpointer=checkpointer,
-            middleware=[ToolPermissionMiddleware(ToolPermissionPolicy(AGENT_A_ALLOWED_TOOLS))],
+        # 说明：各阶段提示词的固定前缀在构造时拼好，每次调用只追加变化的部分；
+        # 同一 run 内多轮 A→B→C 调用的前缀逐字节一致，上游模型服务的前缀缓存可以命中
+        plan = self._prompt_plan
+        self._clarify_preamble = (
+            "请做需求理解与澄清。"
+            f"\n目标内容类型: {plan.content_goal}"
+            f"\n输出要求: {plan.output_requirements}"
+            "\n输出格式: 1) 需求摘要 2) 关键要点 3) 边界与异常 4) 待确认问题。"
         )
-        self._agent_b = create_deep_agent(
-            model=llm,
-            system_prompt=self._agent_b_system_prompt(),
-            backend=backend,
-            checkpointer=checkpointer,
-            middleware=[ToolPermissionMiddleware(ToolPermissionPolicy(AGENT_BC_ALLOWED_TOOLS))],
+        self._draft_preamble = (
+            f"请输出目标内容成品，目标类型: {plan.content_goal}。"
+            f"\n输出要求: {plan.output_requirements}"
+            "\n请使用 Markdown 输出，并保证结构清晰、可审阅。"
         )
-        self._agent_c = create_deep_agent(
-            model=llm,
-            system_prompt=self._agent_c_system_prompt(),
-            backend=backend,
-            checkpointer=checkpointer,
-            middleware=[ToolPermissionMiddleware(ToolPermissionPolicy(AGENT_BC_ALLOWED_TOOLS))],
+        self._review_preamble = (
+            "请从校验视角审查当前内容并返回问题列表。"
+            f"\n目标内容类型: {plan.content_goal}"
+            f"\n校验角色: {plan.agent_b_prompt}"
+            "\n请只输出 JSON: {\"issues\": [\"...\"]}。"
         )
+        self._judge_preamble = (
+            "请评估 Agent B 提出的问题是否合理并返回 JSON。"
+            f"\n目标内容类型: {plan.content_goal}"
+            f"\n判定角色: {plan.agent_c_prompt}"
+            "\n请只输出 JSON: {\"judgement\": \"reasonable|unreasonable\", \"reason\": \"...\"}。"
+        )
+
+        # 说明：角色 Agent 按需构造。多数阶段只用到 Agent A，不再每次都把 A/B/C 三张图全部编译一遍
+        self._agents: dict[str, Any] = {}
+        self._agents_lock = threading.Lock()
+
+    def _get_agent(self, agent_name: str) -> Any:
+        """获取角色 Agent，首次使用时才构造（线程安全，同一角色只构造一次）。"""
+        agent = self._agents.get(agent_name)
+        if agent is not None:
+            return agent
+        with self._agents_lock:
+            agent = self._agents.get(agent_name)
+            if agent is None:
+                if agent_name == "agent_a":
+                    system_prompt = self._agent_a_system_prompt()
+                    allowed_tools = AGENT_A_ALLOWED_TOOLS
+                elif agent_name == "agent_b":
+                    system_prompt = self._agent_b_system_prompt()
+                    allowed_tools = AGENT_BC_ALLOWED_TOOLS
+                else:
+                    system_prompt = self._agent_c_system_prompt()
+                    allowed_tools = AGENT_BC_ALLOWED_TOOLS
+                agent = create_deep_agent(
+                    model=self._llm,
+                    system_prompt=system_prompt,
+                    backend=self._backend,
+                    checkpointer=self._checkpointer,
+                    middleware=[ToolPermissionMiddleware(ToolPermissionPolicy(allowed_tools))],
+                )
+                self._agents[agent_name] = agent
+        return agent
 
     def close(self) -> None:
         try:
@@ -271,44 +425,16 @@ class DeepCreativeAgentClient:
             "请只输出 JSON: {\"judgement\": \"reasonable|unreasonable\", \"reason\": \"...\"}。"
         )
 
-    def _content_to_text(self, content: Any) -> str:
-        if isinstance(content, str):
-            return content
-        if isinstance(content, list):
-            parts: list[str] = []
-            for item in content:
-                if isinstance(item, dict):
-                    text = item.get("text")
-                    if isinstance(text, str):
-                        parts.append(text)
-                elif isinstance(item, str):
-                    parts.append(item)
-            return "\n".join(parts)
-        return str(content or "")
-
     def _extract_last_text(self, result: dict[str, Any]) -> str:
         messages = result.get("messages", [])
         for msg in reversed(messages):
             msg_type = getattr(msg, "type", "")
             if msg_type in {"ai", "assistant"}:
-                return self._content_to_text(getattr(msg, "content", ""))
+                return _content_to_text(getattr(msg, "content", ""))
             if isinstance(msg, dict) and msg.get("role") in {"ai", "assistant"}:
-                return self._content_to_text(msg.get("content", ""))
+                return _content_to_text(msg.get("content", ""))
         return ""
 
-    def _safe_json(self, raw_text: str) -> dict[str, Any]:
-        try:
-            return json.loads(raw_text)
-        except json.JSONDecodeError:
-            start = raw_text.find("{")
-            end = raw_text.rfind("}")
-            if start >= 0 and end > start:
-                try:
-                    return json.loads(raw_text[start : end + 1])
-                except json.JSONDecodeError:
-                    return {}
-            return {}
-
     def _thread_id_for(self, agent_name: str) -> str:
         if agent_name == "agent_a":
             return self._thread_id_a
@@ -319,11 +445,11 @@ class DeepCreativeAgentClient:
     def _invoke_text(
         self,
         *,
-        agent: Any,
         prompt: str,
         agent_name: str,
         on_chunk: Callable[[str], None] | None = None,
     ) -> str:
+        agent = self._get_agent(agent_name)
         chunks: list[str] = []
         invoke_payload = {"messages": [{"role": "user", "content": prompt}]}
         invoke_config = {"configurable": {"thread_id": self._thread_id_for(agent_name)}}
@@ -339,9 +465,9 @@ class DeepCreativeAgentClient:
                         continue
                     message_chunk, _metadata = stream_item
                     if isinstance(message_chunk, dict):
-                        chunk_text = self._content_to_text(message_chunk.get("content", ""))
+                        chunk_text = _content_to_text(message_chunk.get("content", ""))
                     else:
-                        chunk_text = self._content_to_text(getattr(message_chunk, "content", ""))
+                        chunk_text = _content_to_text(getattr(message_chunk, "content", ""))
                     if chunk_text:
                         chunks.append(chunk_text)
                         if on_chunk:
@@ -367,14 +493,11 @@ class DeepCreativeAgentClient:
         on_chunk: Callable[[str], None] | None = None,
     ) -> str:
         prompt = (
-            "请做需求理解与澄清。"
-            f"\n目标内容类型: {self._prompt_plan.content_goal}"
-            f"\n输出要求: {self._prompt_plan.output_requirements}"
-            "\n输出格式: 1) 需求摘要 2) 关键要点 3) 边界与异常 4) 待确认问题。"
-            f"\n用户需求: {user_prompt}"
+            self._clarify_preamble
+            + f"\n用户需求: {user_prompt}"
             f"\n用户反馈: {feedback or '无'}"
         )
-        return self._invoke_text(agent=self._agent_a, prompt=prompt, agent_name="agent_a", on_chunk=on_chunk)
+        return self._invoke_text(prompt=prompt, agent_name="agent_a", on_chunk=on_chunk)
 
     def draft_doc(
         self,
@@ -386,15 +509,13 @@ class DeepCreativeAgentClient:
         on_chunk: Callable[[str], None] | None = None,
     ) -> str:
         prompt = (
-            f"请输出目标内容成品，目标类型: {self._prompt_plan.content_goal}。"
-            f"\n输出要求: {self._prompt_plan.output_requirements}"
-            "\n请使用 Markdown 输出，并保证结构清晰、可审阅。"
-            f"\n用户需求: {user_prompt}"
+            self._draft_preamble
+            + f"\n用户需求: {user_prompt}"
             f"\n需求确认: {clarified_requirement}"
             f"\n待修复问题: {issues if issues else '无'}"
             f"\nAgent C 判定意见: {c_reason or '无'}"
         )
-        return self._invoke_text(agent=self._agent_a, prompt=prompt, agent_name="agent_a", on_chunk=on_chunk)
+        return self._invoke_text(prompt=prompt, agent_name="agent_a", on_chunk=on_chunk)
 
     def review_doc(
         self,
@@ -406,20 +527,16 @@ class DeepCreativeAgentClient:
         c_reason: str,
         on_chunk: Callable[[str], None] | None = None,
     ) -> list[str]:
+        # 说明：校验清单在同一 run 内不变，放在每轮都会变化的当前内容之前，延长可复用的前缀
         prompt = (
-            "请从校验视角审查当前内容并返回问题列表。"
-            f"\n目标内容类型: {self._prompt_plan.content_goal}"
-            f"\n校验角色: {self._prompt_plan.agent_b_prompt}"
-            "\n请只输出 JSON: {\"issues\": [\"...\"]}。"
-            f"\n用户需求: {user_prompt}"
+            self._review_preamble
+            + f"\n用户需求: {user_prompt}"
             f"\nA 的需求理解: {clarified_requirement}"
-            f"\n当前内容:\n{demo_doc}"
             f"\n校验清单: {checklist}"
+            f"\n当前内容:\n{demo_doc}"
             f"\nAgent C 反馈(若有): {c_reason or '无'}"
         )
-        parsed = self._safe_json(
-            self._invoke_text(agent=self._agent_b, prompt=prompt, agent_name="agent_b", on_chunk=on_chunk)
-        )
+        parsed = _parse_loose_json(self._invoke_text(prompt=prompt, agent_name="agent_b", on_chunk=on_chunk))
         issues = parsed.get("issues", [])
         if isinstance(issues, list):
             return [str(item) for item in issues if str(item).strip()]
@@ -435,18 +552,13 @@ class DeepCreativeAgentClient:
         on_chunk: Callable[[str], None] | None = None,
     ) -> tuple[str, str]:
         prompt = (
-            "请评估 Agent B 提出的问题是否合理并返回 JSON。"
-            f"\n目标内容类型: {self._prompt_plan.content_goal}"
-            f"\n判定角色: {self._prompt_plan.agent_c_prompt}"
-            "\n请只输出 JSON: {\"judgement\": \"reasonable|unreasonable\", \"reason\": \"...\"}。"
-            f"\n用户需求: {user_prompt}"
+            self._judge_preamble
+            + f"\n用户需求: {user_prompt}"
             f"\nA 的需求理解: {clarified_requirement}"
             f"\n当前内容:\n{demo_doc}"
             f"\n问题清单: {issues}"
         )
-        parsed = self._safe_json(
-            self._invoke_text(agent=self._agent_c, prompt=prompt, agent_name="agent_c", on_chunk=on_chunk)
-        )
+        parsed = _parse_loose_json(self._invoke_text(prompt=prompt, agent_name="agent_c", on_chunk=on_chunk))
         judgement = str(parsed.get("judgement", "unreasonable")).lower()
         reason = str(parsed.get("reason", "未给出理由"))
         if judgement not in {"reasonable", "unreasonable"}:
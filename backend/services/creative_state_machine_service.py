@@ -7,7 +7,7 @@ from pathlib import Path
 from typing import Any, Callable
 
 from backend.database.mongo_manager import get_beijing_time, get_mongo_manager
-from backend.services.chat_service import ChatService
+from backend.services.chat_service import get_chat_service
 from backend.services.creative_agent_service import (
     CreativeAppError,
     DeepCreativeAgentClient,
@@ -39,7 +39,7 @@ class CreativeStateMachineService:
 
     def __init__(self, *, workspace_root: Path | None = None) -> None:
         self._mongo = get_mongo_manager()
-        self._chat = ChatService()
+        self._chat = get_chat_service()
         self._workspace_root = workspace_root or Path(".")
 
     def _serialize_dt(self, value: Any) -> Any:
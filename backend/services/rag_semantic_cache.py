@@ -0,0 +1,147 @@
+"""RAG 检索语义缓存。
+
+说明：
+- 以 query embedding 为 key，缓存检索命中列表；余弦相似度超过阈值即视为命中
+- 多轮对话里的追问经常与上一轮问题语义接近，命中后可以跳过一次向量检索
+- 按命名空间（assistant_id + 附件集合）隔离，避免不同来源之间串结果
+- 带 TTL + LRU 淘汰，单进程内存实现
+- 同一实现也用作整轮回答的语义缓存（get_answer_semantic_cache），条目里存回答正文与证据
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Hashable, Sequence
+
+import numpy as np
+
+
+@dataclass
+class _Namespace:
+    """单个命名空间下的缓存条目。"""
+
+    keys: list[np.ndarray] = field(default_factory=list)
+    hits: list[list[dict[str, Any]]] = field(default_factory=list)
+    created_at: list[float] = field(default_factory=list)
+
+
+class RagSemanticCache:
+    """基于 embedding 余弦相似度的检索结果缓存。"""
+
+    def __init__(
+        self,
+        *,
+        threshold: float = 0.95,
+        ttl_seconds: float = 600.0,
+        max_entries_per_namespace: int = 64,
+        max_namespaces: int = 256,
+    ) -> None:
+        self._threshold = float(threshold)
+        self._ttl_seconds = float(ttl_seconds)
+        self._max_entries = max(int(max_entries_per_namespace), 1)
+        self._max_namespaces = max(int(max_namespaces), 1)
+        self._namespaces: OrderedDict[Hashable, _Namespace] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _normalize(self, embedding: Sequence[float]) -> np.ndarray | None:
+        vec = np.asarray(embedding, dtype=np.float32)
+        if vec.ndim != 1 or not vec.size:
+            return None
+        norm = float(np.linalg.norm(vec))
+        if norm <= 0.0:
+            return None
+        return vec / norm
+
+    def _evict_expired(self, ns: _Namespace, now: float) -> None:
+        if self._ttl_seconds <= 0:
+            return
+        keep = [i for i, ts in enumerate(ns.created_at) if now - ts <= self._ttl_seconds]
+        if len(keep) == len(ns.created_at):
+            return
+        ns.keys = [ns.keys[i] for i in keep]
+        ns.hits = [ns.hits[i] for i in keep]
+        ns.created_at = [ns.created_at[i] for i in keep]
+
+    def get(self, namespace: Hashable, embedding: Sequence[float]) -> list[dict[str, Any]] | None:
+        """查找语义相近的缓存结果，未命中返回 None。"""
+        vec = self._normalize(embedding)
+        if vec is None:
+            return None
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns is None:
+                return None
+            self._evict_expired(ns, time.monotonic())
+            if not ns.keys:
+                return None
+            try:
+                scores = np.vstack(ns.keys) @ vec
+            except ValueError:
+                # embedding 维度变化（例如切换了 embedding 模型），直接视为未命中
+                return None
+            best = int(np.argmax(scores))
+            if float(scores[best]) < self._threshold:
+                return None
+            self._namespaces.move_to_end(namespace)
+            return list(ns.hits[best])
+
+    def put(self, namespace: Hashable, embedding: Sequence[float], hits: list[dict[str, Any]]) -> None:
+        """写入缓存。"""
+        vec = self._normalize(embedding)
+        if vec is None:
+            return
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns is None:
+                ns = _Namespace()
+                self._namespaces[namespace] = ns
+            self._namespaces.move_to_end(namespace)
+            ns.keys.append(vec)
+            ns.hits.append(list(hits))
+            ns.created_at.append(time.monotonic())
+            if len(ns.keys) > self._max_entries:
+                del ns.keys[0], ns.hits[0], ns.created_at[0]
+            while len(self._namespaces) > self._max_namespaces:
+                self._namespaces.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._namespaces.clear()
+
+
+_rag_semantic_cache: RagSemanticCache | None = None
+_rag_semantic_cache_lock = threading.Lock()
+
+
+def get_rag_semantic_cache() -> RagSemanticCache:
+    """获取进程内共享的 RAG 语义缓存实例。"""
+    global _rag_semantic_cache
+    if _rag_semantic_cache is None:
+        with _rag_semantic_cache_lock:
+            if _rag_semantic_cache is None:
+                _rag_semantic_cache = RagSemanticCache(
+                    threshold=float(os.getenv("DEEPAGENTS_RAG_CACHE_THRESHOLD") or "0.95"),
+                    ttl_seconds=float(os.getenv("DEEPAGENTS_RAG_CACHE_TTL_SECONDS") or "600"),
+                )
+    return _rag_semantic_cache
+
+
+_answer_semantic_cache: RagSemanticCache | None = None
+
+
+def get_answer_semantic_cache() -> RagSemanticCache:
+    """获取进程内共享的回答语义缓存实例（阈值比检索缓存更严格）。"""
+    global _answer_semantic_cache
+    if _answer_semantic_cache is None:
+        with _rag_semantic_cache_lock:
+            if _answer_semantic_cache is None:
+                _answer_semantic_cache = RagSemanticCache(
+                    threshold=float(os.getenv("DEEPAGENTS_ANSWER_CACHE_THRESHOLD") or "0.97"),
+                    ttl_seconds=float(os.getenv("DEEPAGENTS_ANSWER_CACHE_TTL_SECONDS") or "600"),
+                    max_entries_per_namespace=32,
+                )
+    return _answer_semantic_cache
@@ -1,28 +1,52 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import itertools
 import logging
 import uuid
 from dataclasses import dataclass
-from typing import Any, Callable
+from pathlib import Path
+from typing import Any, Awaitable, Callable
 
 from backend.database.mongo_manager import get_beijing_time
+from backend.services.rag_semantic_cache import get_rag_semantic_cache
 
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=64)
+def _get_rag_middleware(assistant_id: str, source_files_key: tuple[str, ...], workspace_root: str) -> Any:
+    """按 (assistant_id, 附件集合, 工作区) 复用 LlamaIndexRagMiddleware 实例。
+
+    说明：
+    - rag_query 在一轮对话里可能被 agent 调用多次，这里避免每次都重新构造中间件
+    - lru_cache 限制实例数量，长时间运行的进程不会无限增长
+    """
+    from backend.middleware.rag_middleware import LlamaIndexRagMiddleware
+
+    return LlamaIndexRagMiddleware(
+        assistant_id=assistant_id,
+        workspace_root=Path(workspace_root),
+        source_files=list(source_files_key) or None,
+    )
+
+
 @dataclass(frozen=True)
 class RagPreparationResult:
     """RAG 预处理结果。
 
     说明：
-    - extra_system_prompt：用于拼接到上层系统提示词里
+    - rag_context_prompt：<rag_context> 段落（无命中时为空串），由上层追加到系统提示词分段里
+    - rag_snippets_block：检索片段正文（只拼一次），供系统提示词与用户输入后缀复用
     - rag_references：用于最终落库到 assistant message（给前端展示引用）
     - events：用于上层 SSE 透传（rag.references / tool.start / tool.end）
     - rag_tool：返回一个可注入 agent 的 rag_query 工具函数
     """
 
-    extra_system_prompt: str
+    rag_context_prompt: str
+    rag_snippets_block: str
     rag_references: list[dict[str, Any]]
     events: list[dict[str, Any]]
     rag_tool: Callable[[str], list[dict[str, Any]]]
@@ -50,6 +74,9 @@ class RagService:
         assistant_id: str,
         file_refs: list[str],
     ) -> Callable[[str], list[dict[str, Any]]]:
+        source_files_key = tuple(sorted(file_refs))
+        semantic_cache = get_rag_semantic_cache()
+
         def rag_query(query: str) -> list[dict[str, Any]]:
             """RAG 检索工具函数（注入到 agent 中）。
 
@@ -60,33 +87,48 @@ class RagService:
             - 列表，每个元素包含 index/source/score/text/mongo_id，用于前端引用展示。
             """
             try:
-                from backend.middleware.rag_middleware import LlamaIndexRagMiddleware
-
-                rag = LlamaIndexRagMiddleware(
-                    assistant_id=assistant_id,
-                    workspace_root=self._base_dir,
-                    source_files=[str(x) for x in file_refs] if isinstance(file_refs, list) else None,
+                rag = _get_rag_middleware(assistant_id, source_files_key, str(self._base_dir))
+                # 关键逻辑：语义相近的追问直接复用上一次的检索结果，跳过向量检索
+                # 说明：命名空间带上索引文件签名，索引重建/重新入库后旧结果自然失效，不必等 TTL
+                query_embedding = rag.embed(query)
+                cached_hits = (
+                    semantic_cache.get((assistant_id, source_files_key, rag.index_signature()), query_embedding)
+                    if query_embedding is not None
+                    else None
                 )
-                hits = rag.query(query)
-                out: list[dict[str, Any]] = []
-                for i, r in enumerate(hits, start=1):
-                    if not isinstance(r, dict):
-                        continue
-                    out.append(
-                        {
-                            "index": i,
-                            "source": r.get("source"),
-                            "score": r.get("score"),
-                            "text": r.get("text"),
-                            "mongo_id": r.get("mongo_id"),
-                        }
-                    )
-                return out
+                if cached_hits is not None:
+                    hits = cached_hits
+                else:
+                    hits = rag.query(query, embedding=query_embedding)
+                    if query_embedding is not None and hits:
+                        # 说明：query 可能刚触发过重建，写入时重新取一次签名
+                        semantic_cache.put(
+                            (assistant_id, source_files_key, rag.index_signature()), query_embedding, hits
+                        )
+                # 说明：先过滤再编号，保证 index 连续，上层无需再做 isinstance 过滤
+                return [
+                    {
+                        "index": i,
+                        "source": r.get("source"),
+                        "score": r.get("score"),
+                        "text": r.get("text"),
+                        "mongo_id": r.get("mongo_id"),
+                    }
+                    for i, r in enumerate((r for r in hits if isinstance(r, dict)), start=1)
+                ]
             except Exception:
                 return []
 
         return rag_query
 
+    def embed_query(self, *, assistant_id: str, file_refs: list[str], text: str) -> list[float] | None:
+        """计算查询文本的 embedding（复用同一附件集合的 RAG 中间件，强制检索刚算过时直接命中记忆）。"""
+        try:
+            rag = _get_rag_middleware(assistant_id, tuple(sorted(file_refs)), str(self._base_dir))
+            return rag.embed(str(text or "").strip())
+        except Exception:
+            return None
+
     async def force_rag_if_needed(
         self,
         *,
@@ -94,18 +136,28 @@ class RagService:
         thread_id: str,
         assistant_id: str,
         file_refs: list[str],
-        system_prompt: str,
+        persist_after: Awaitable[Any] | None = None,
     ) -> RagPreparationResult:
+        """有附件时执行一次强制检索。
+
+        说明：
+        - 检索本身放到线程池执行，不阻塞事件循环
+        - persist_after：上层尚未完成的落库步骤（通常是用户消息写入）。检索与其并行，
+          但 tool message 必须等它完成后再写，保证消息历史里用户消息排在 rag_query 之前
+        - tool message 在检索结束后一次写入（含开始/结束时间），不再分 running/done 两次往返
+        """
         events: list[dict[str, Any]] = []
         rag_references: list[dict[str, Any]] = []
-        extra_system_prompt = system_prompt
+        rag_context_prompt = ""
+        rag_snippets_block = ""
 
         rag_tool = self.build_rag_tool(assistant_id=assistant_id, file_refs=file_refs)
 
         # 无附件时，直接返回（rag_tool 仍可用，但上层一般不会注入）
         if not file_refs:
             return RagPreparationResult(
-                extra_system_prompt=extra_system_prompt,
+                rag_context_prompt=rag_context_prompt,
+                rag_snippets_block=rag_snippets_block,
                 rag_references=rag_references,
                 events=events,
                 rag_tool=rag_tool,
@@ -114,7 +166,8 @@ class RagService:
         q = str(user_text or "").strip()
         if not q:
             return RagPreparationResult(
-                extra_system_prompt=extra_system_prompt,
+                rag_context_prompt=rag_context_prompt,
+                rag_snippets_block=rag_snippets_block,
                 rag_references=rag_references,
                 events=events,
                 rag_tool=rag_tool,
@@ -122,48 +175,49 @@ class RagService:
 
         tool_call_id = f"rag-{uuid.uuid4().hex[:8]}"
 
-        try:
-            self._mongo.upsert_tool_message(
-                thread_id=thread_id,
-                assistant_id=assistant_id,
-                tool_call_id=tool_call_id,
-                tool_name="rag_query",
-                tool_args={"query": q, "files": [str(x) for x in file_refs]},
-                tool_status="running",
-                started_at=get_beijing_time(),
-            )
-        except Exception:
-            pass
+        # 关键逻辑：先把检索丢进线程池，再等待前置落库，两者耗时取 max 而不是相加
+        started_at = get_beijing_time()
+        retrieval_task = asyncio.ensure_future(asyncio.to_thread(rag_tool, q))
+        if persist_after is not None:
+            try:
+                await persist_after
+            except Exception:
+                pass
 
         events.append({"type": "tool.start", "id": tool_call_id, "name": "rag_query", "args": {"query": q}})
 
         # 执行一次强制检索，用于构造 <rag_context>
-        forced_hits = rag_tool(q)
-        rag_references = [x for x in forced_hits if isinstance(x, dict)]
+        rag_references = await retrieval_task
 
         if rag_references:
             events.append({"type": "rag.references", "references": rag_references})
 
-            ctx_lines = [
-                "<rag_context>",
-                "你必须基于以下检索片段回答，并用 [1][2] 形式标注引用：",
-            ]
-            for ref in rag_references[:8]:
-                src = ref.get("source") or "unknown"
-                snippet = ref.get("text") or ""
-                idx = ref.get("index")
-                ctx_lines.append(f"[{idx}] source={src}\n{snippet}")
-            ctx_lines.append("</rag_context>")
-            extra_system_prompt = (extra_system_prompt + "\n\n" + "\n\n".join(ctx_lines)).strip()
+            # 关键逻辑：片段正文只拼一次，系统提示词和用户输入后缀共用同一份字符串
+            rag_snippets_block = "\n\n".join(
+                f"[{ref.get('index')}] source={ref.get('source') or 'unknown'}\n{ref.get('text') or ''}"
+                for ref in itertools.islice(rag_references, 8)
+            )
+            rag_context_prompt = "\n\n".join(
+                [
+                    "<rag_context>",
+                    "你必须基于以下检索片段回答，并用 [1][2] 形式标注引用：",
+                    rag_snippets_block,
+                    "</rag_context>",
+                ]
+            )
 
+        # 说明：强制检索在首包前同步完成，tool message 的开始/结束状态合并成一次写入，省一次 Mongo 往返
         try:
-            self._mongo.upsert_tool_message(
+            await asyncio.to_thread(
+                self._mongo.upsert_tool_message,
                 thread_id=thread_id,
                 assistant_id=assistant_id,
                 tool_call_id=tool_call_id,
                 tool_name="rag_query",
+                tool_args={"query": q, "files": list(file_refs)},
                 tool_status="done" if rag_references else "error",
                 tool_output=rag_references if rag_references else {"error": "no hits"},
+                started_at=started_at,
                 ended_at=get_beijing_time(),
             )
         except Exception:
@@ -180,7 +234,8 @@ class RagService:
         )
 
         return RagPreparationResult(
-            extra_system_prompt=extra_system_prompt,
+            rag_context_prompt=rag_context_prompt,
+            rag_snippets_block=rag_snippets_block,
             rag_references=rag_references,
             events=events,
             rag_tool=rag_tool,
@@ -8,7 +8,7 @@
 from __future__ import annotations
 
 import threading
-from typing import Dict
+from typing import Callable, Dict, List
 
 
 class SessionCancelService:
@@ -23,14 +23,37 @@ class SessionCancelService:
                 if cls._instance is None:
                     cls._instance = super().__new__(cls)
                     cls._instance._cancel_versions: Dict[str, int] = {}
+                    cls._instance._listeners: Dict[str, List[Callable[[], None]]] = {}
                     cls._instance._sessions_lock = threading.Lock()
         return cls._instance
     
     def cancel(self, session_id: str) -> None:
-        """标记会话为已取消（递增取消版本号）"""
+        """标记会话为已取消（递增取消版本号），并通知该会话的订阅者"""
         with self._sessions_lock:
             current = self._cancel_versions.get(session_id, 0)
             self._cancel_versions[session_id] = current + 1
+            listeners = list(self._listeners.get(session_id, ()))
+        # 说明：回调在锁外执行；cancel 可能来自线程池，回调需自行保证线程安全（如 call_soon_threadsafe）
+        for callback in listeners:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def subscribe(self, session_id: str, callback: Callable[[], None]) -> Callable[[], None]:
+        """订阅会话取消通知，返回取消订阅函数（流式请求结束时调用）"""
+        with self._sessions_lock:
+            self._listeners.setdefault(session_id, []).append(callback)
+
+        def unsubscribe() -> None:
+            with self._sessions_lock:
+                callbacks = self._listeners.get(session_id)
+                if callbacks and callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    self._listeners.pop(session_id, None)
+
+        return unsubscribe
 
     def get_version(self, session_id: str) -> int:
         """获取会话当前的取消版本号"""
@@ -1,13 +1,65 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import hashlib
+import io
 import logging
+import tarfile
+import uuid
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Any
 
 
 logger = logging.getLogger(__name__)
 
+# 关键逻辑：沙箱内的“已同步”标记文件，内容是本地 skills 的摘要；复用沙箱时摘要一致就跳过整段同步
+SKILLS_SYNCED_SENTINEL = "/workspace/.skills_synced"
+
+# skills 压缩包在沙箱内的临时存放目录（解压后即删除）
+SKILLS_ARCHIVE_DIR = "/workspace"
+
+# 进程内记录 沙箱 id -> 已同步的 skills 摘要，摘要一致时连一次探测 aexecute 都可以省掉
+# 说明：按 LRU 限制条目数，长时间运行的进程不会随沙箱数量无限增长；被淘汰的沙箱回退为探测标记文件
+_synced_sandbox_digests: OrderedDict[str, str] = OrderedDict()
+_SYNCED_SANDBOX_DIGESTS_MAX = 512
+
+# 最近一次构建的 skills 压缩包（按摘要缓存），新会话的沙箱直接复用，不必重新读盘打包
+_archive_cache: dict[str, bytes] = {}
+
+# 逐文件上传时每批的文件数；多批之间并发发送，避免整体被单次往返串行拖慢
+_UPLOAD_BATCH = 8
+
+
+def _remember_synced_sandbox(sandbox_id: str, digest: str) -> None:
+    """记录沙箱已同步的摘要，超过上限时淘汰最久未使用的沙箱。"""
+    _synced_sandbox_digests[sandbox_id] = digest
+    _synced_sandbox_digests.move_to_end(sandbox_id)
+    while len(_synced_sandbox_digests) > _SYNCED_SANDBOX_DIGESTS_MAX:
+        _synced_sandbox_digests.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=1024)
+def _read_skill_file(path: str, mtime_ns: int, size: int) -> tuple[bytes, str]:
+    """读取单个 skill 文件并计算 sha256；(mtime, size) 作为缓存失效键，文件变化后自动重读。"""
+    content = Path(path).read_bytes()
+    return content, hashlib.sha256(content).hexdigest()
+
+
+def _load_skill_files(upload_plan: list[tuple[str, Path]]) -> tuple[list[tuple[str, bytes]], str]:
+    """按上传计划读取文件内容（命中进程内缓存时不读盘），并计算整体摘要。"""
+    files_to_upload: list[tuple[str, bytes]] = []
+    digest = hashlib.sha256()
+    for remote_path, local_path in upload_plan:
+        st = local_path.stat()
+        content, file_hash = _read_skill_file(str(local_path), st.st_mtime_ns, st.st_size)
+        files_to_upload.append((remote_path, content))
+        digest.update(f"{remote_path}\0{file_hash}\n".encode("utf-8"))
+    return files_to_upload, digest.hexdigest()[:32]
+
 
 @dataclass(frozen=True)
 class SkillsSyncResult:
@@ -28,9 +80,9 @@ class SkillsSyncService:
 
     只负责：
     - 扫描本地 skills/skills/*/SKILL.md
-    - 在沙箱里 mkdir 目录
-    - aupload_files 上传
+    - 打包成 tar.gz 一次上传并解压（失败时回退为 mkdir + 逐文件 aupload_files）
     - 自检（ls/head）
+    - 同步成功后把 skills 摘要写入标记文件，复用沙箱且摘要一致时直接跳过
 
     注意：
     - 这里不创建 sandbox，只接收 sandbox_backend
@@ -40,6 +92,204 @@ class SkillsSyncService:
     def __init__(self, *, base_dir: Path) -> None:
         self._base_dir = base_dir
 
+    def _scan_local_skills(self, *, local_skills_root: Path, remote_root: str) -> tuple[list[tuple[str, Path]], list[str]]:
+        """扫描本地 skills 目录，返回 (远端路径, 本地路径) 列表与需要创建的子目录名。"""
+        upload_plan: list[tuple[str, Path]] = []
+        skill_dirs_to_create: list[str] = []
+
+        allowed_suffixes = {
+            ".md",
+            ".txt",
+            ".py",
+            ".json",
+            ".yaml",
+            ".yml",
+        }
+
+        # 扫描本地 skills 目录，收集所有 SKILL.md 文件
+        for skill_dir in local_skills_root.iterdir():
+            if not skill_dir.is_dir():
+                continue
+            skill_md = skill_dir / "SKILL.md"
+            if not skill_md.exists():
+                continue
+            skill_dirs_to_create.append(skill_dir.name)
+            upload_plan.append((f"{remote_root}/{skill_dir.name}/SKILL.md", skill_md))
+
+            # 同步 skill 目录下的脚本/配置文件到沙箱，保证技能可执行
+            for p in skill_dir.rglob("*"):
+                if not p.is_file():
+                    continue
+                if p.name.startswith("."):
+                    continue
+                if p.name == "SKILL.md":
+                    continue
+                if p.suffix.lower() not in allowed_suffixes:
+                    continue
+
+                rel = p.relative_to(skill_dir).as_posix()
+                upload_plan.append((f"{remote_root}/{skill_dir.name}/{rel}", p))
+
+        return upload_plan, skill_dirs_to_create
+
+    async def _mkdir_remote_dirs(
+        self,
+        *,
+        sandbox_backend: Any,
+        session_id: str,
+        mkdir_all_cmd: str,
+        dirs_count: int,
+    ) -> None:
+        try:
+            mkdir_result = await sandbox_backend.aexecute(mkdir_all_cmd)
+            logger.info(
+                "mkdir skills dirs | session_id=%s | exit_code=%s | dirs_count=%s",
+                session_id,
+                getattr(mkdir_result, "exit_code", ""),
+                dirs_count,
+            )
+            if getattr(mkdir_result, "exit_code", 0) != 0:
+                logger.warning("mkdir skills dirs non-zero | output=%s", getattr(mkdir_result, "output", ""))
+        except Exception as exc:
+            logger.warning("mkdir skills dirs failed: %s: %s", type(exc).__name__, str(exc))
+
+    def _build_archive(self, files_to_upload: list[tuple[str, bytes]]) -> bytes:
+        """把待上传文件打成 tar.gz（成员路径即沙箱内绝对路径去掉开头的 /）。"""
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+            for remote_path, content in files_to_upload:
+                info = tarfile.TarInfo(name=remote_path.lstrip("/"))
+                info.size = len(content)
+                info.mode = 0o644
+                tf.addfile(info, io.BytesIO(content))
+        return buf.getvalue()
+
+    async def _upload_as_archive(
+        self,
+        *,
+        sandbox_backend: Any,
+        session_id: str,
+        files_to_upload: list[tuple[str, bytes]],
+        remote_root: str,
+        digest: str,
+    ) -> bool:
+        """整包上传并在沙箱内解压，成功返回 True；任何失败都返回 False 交给逐文件上传兜底。"""
+        archive_path = f"{SKILLS_ARCHIVE_DIR}/.skills_sync_{uuid.uuid4().hex[:8]}.tgz"
+        try:
+            archive = _archive_cache.get(digest)
+            if archive is None:
+                archive = await asyncio.to_thread(self._build_archive, files_to_upload)
+                # 说明：只保留当前摘要对应的一份，skills 变化后旧包自然被替换
+                _archive_cache.clear()
+                _archive_cache[digest] = archive
+            upload_responses = await sandbox_backend.aupload_files([(archive_path, archive)])
+            for resp in upload_responses or []:
+                if getattr(resp, "error", None):
+                    logger.warning(
+                        "skills archive upload failed | session_id=%s | error=%s",
+                        session_id,
+                        getattr(resp, "error", ""),
+                    )
+                    return False
+
+            extract_result = await sandbox_backend.aexecute(
+                f"mkdir -p {remote_root} && tar -xzf {archive_path} -C / && rm -f {archive_path}"
+                f" && echo {digest} > {SKILLS_SYNCED_SENTINEL}"
+            )
+            if getattr(extract_result, "exit_code", 1) != 0:
+                logger.warning(
+                    "skills archive extract non-zero | session_id=%s | output=%s",
+                    session_id,
+                    getattr(extract_result, "output", ""),
+                )
+                return False
+
+            logger.info(
+                "skills archive uploaded | session_id=%s | files=%s | archive_bytes=%s",
+                session_id,
+                len(files_to_upload),
+                len(archive),
+            )
+            return True
+        except Exception as exc:
+            logger.warning("skills archive upload failed: %s: %s", type(exc).__name__, str(exc))
+            return False
+
+    async def _aupload_in_batches(self, *, sandbox_backend: Any, files: list[tuple[str, bytes]]) -> list[Any]:
+        """按 _UPLOAD_BATCH 分批并发 aupload_files，按原顺序拼回响应列表。
+
+        说明：
+        - 文件数不超过一批时保持单次调用
+        - 某一批整体抛异常时，该批内每个文件都记为失败，不影响其它批次
+        """
+        if len(files) <= _UPLOAD_BATCH:
+            return list(await sandbox_backend.aupload_files(files) or [])
+
+        batches = [files[i : i + _UPLOAD_BATCH] for i in range(0, len(files), _UPLOAD_BATCH)]
+        results = await asyncio.gather(
+            *(sandbox_backend.aupload_files(batch) for batch in batches),
+            return_exceptions=True,
+        )
+        responses: list[Any] = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, BaseException):
+                error = f"{type(result).__name__}: {result}"
+                responses.extend(SimpleNamespace(path=path, error=error) for path, _ in batch)
+            else:
+                responses.extend(result or [])
+        return responses
+
+    async def _upload_files_individually(
+        self,
+        *,
+        sandbox_backend: Any,
+        session_id: str,
+        files_to_upload: list[tuple[str, bytes]],
+        remote_root: str,
+        skill_dirs_to_create: list[str],
+    ) -> tuple[int, int]:
+        """逐文件上传（先 mkdir 再 aupload_files），返回 (成功数, 失败数)。"""
+        # 关键逻辑：确保 skills 根目录和所有子目录存在（一次性执行）
+        mkdir_cmds = [f"mkdir -p {remote_root}"]
+        mkdir_cmds.extend([f"mkdir -p {remote_root}/{name}" for name in skill_dirs_to_create])
+        await self._mkdir_remote_dirs(
+            sandbox_backend=sandbox_backend,
+            session_id=session_id,
+            mkdir_all_cmd=" && ".join(mkdir_cmds),
+            dirs_count=len(skill_dirs_to_create),
+        )
+
+        # 关键逻辑：上传文件并检查每个文件的上传结果（使用异步方法）
+        upload_responses = await self._aupload_in_batches(sandbox_backend=sandbox_backend, files=files_to_upload)
+
+        success_count = 0
+        error_count = 0
+        for resp in upload_responses or []:
+            if getattr(resp, "error", None):
+                error_count += 1
+                logger.error(
+                    "skill upload FAILED | session_id=%s | path=%s | error=%s",
+                    session_id,
+                    getattr(resp, "path", ""),
+                    getattr(resp, "error", ""),
+                )
+            else:
+                success_count += 1
+                logger.debug(
+                    "skill upload OK | session_id=%s | path=%s",
+                    session_id,
+                    getattr(resp, "path", ""),
+                )
+
+        logger.info(
+            "skills upload summary | session_id=%s | success=%s | failed=%s | total=%s",
+            session_id,
+            success_count,
+            error_count,
+            len(upload_responses or []),
+        )
+        return success_count, error_count
+
     async def sync_skills_to_sandbox(
         self,
         *,
@@ -61,119 +311,82 @@ class SkillsSyncService:
             if not local_skills_root.exists():
                 return SkillsSyncResult(events=events, uploaded_files=0, uploaded_failed=0)
 
-            files_to_upload: list[tuple[str, bytes]] = []
-            skill_dirs_to_create: list[str] = []
-
-            allowed_suffixes = {
-                ".md",
-                ".txt",
-                ".py",
-                ".json",
-                ".yaml",
-                ".yml",
-            }
-
-            # 扫描本地 skills 目录，收集所有 SKILL.md 文件
-            for skill_dir in local_skills_root.iterdir():
-                if not skill_dir.is_dir():
-                    continue
-                skill_md = skill_dir / "SKILL.md"
-                if not skill_md.exists():
-                    continue
-                skill_dirs_to_create.append(skill_dir.name)
-                remote_path = f"{remote_root}/{skill_dir.name}/SKILL.md"
-                files_to_upload.append((remote_path, skill_md.read_bytes()))
-
-                # 同步 skill 目录下的脚本/配置文件到沙箱，保证技能可执行
-                for p in skill_dir.rglob("*"):
-                    if not p.is_file():
-                        continue
-                    if p.name.startswith("."):
-                        continue
-                    if p.name == "SKILL.md":
-                        continue
-                    if p.suffix.lower() not in allowed_suffixes:
-                        continue
-
-                    rel = p.relative_to(skill_dir).as_posix()
-                    remote_file = f"{remote_root}/{skill_dir.name}/{rel}"
-                    files_to_upload.append((remote_file, p.read_bytes()))
+            # 关键逻辑：目录扫描与文件读取放到线程里，避免阻塞事件循环；文件内容按 (mtime, size) 进程内缓存
+            upload_plan, skill_dirs_to_create = await asyncio.to_thread(
+                self._scan_local_skills,
+                local_skills_root=local_skills_root,
+                remote_root=remote_root,
+            )
 
             logger.info(
                 "skills files prepared | session_id=%s | files_count=%s | dirs_count=%s",
                 session_id,
-                len(files_to_upload),
+                len(upload_plan),
                 len(skill_dirs_to_create),
             )
 
-            if not files_to_upload:
+            if not upload_plan:
                 return SkillsSyncResult(events=events, uploaded_files=0, uploaded_failed=0)
 
-            # 关键逻辑：确保 skills 根目录和所有子目录存在（一次性执行）
-            mkdir_cmds = [f"mkdir -p {remote_root}"]
-            mkdir_cmds.extend([f"mkdir -p {remote_root}/{name}" for name in skill_dirs_to_create])
-            mkdir_all_cmd = " && ".join(mkdir_cmds)
+            files_to_upload, digest = await asyncio.to_thread(_load_skill_files, upload_plan)
 
+            sandbox_id = str(getattr(sandbox_backend, "id", "") or "")
+            if sandbox_id and _synced_sandbox_digests.get(sandbox_id) == digest:
+                _synced_sandbox_digests.move_to_end(sandbox_id)
+                logger.info("skills sync skipped (cached) | session_id=%s | sandbox_id=%s", session_id, sandbox_id)
+                return SkillsSyncResult(events=events, uploaded_files=0, uploaded_failed=0)
             try:
-                mkdir_result = await sandbox_backend.aexecute(mkdir_all_cmd)
-                logger.info(
-                    "mkdir skills dirs | session_id=%s | exit_code=%s | dirs_count=%s",
-                    session_id,
-                    getattr(mkdir_result, "exit_code", ""),
-                    len(skill_dirs_to_create),
-                )
-                if getattr(mkdir_result, "exit_code", 0) != 0:
-                    logger.warning("mkdir skills dirs non-zero | output=%s", getattr(mkdir_result, "output", ""))
+                probe = await sandbox_backend.aexecute(f"cat {SKILLS_SYNCED_SENTINEL} 2>/dev/null || true")
+                if str(getattr(probe, "output", "") or "").strip() == digest:
+                    if sandbox_id:
+                        _remember_synced_sandbox(sandbox_id, digest)
+                    logger.info("skills sync skipped (sentinel) | session_id=%s | sandbox_id=%s", session_id, sandbox_id)
+                    return SkillsSyncResult(events=events, uploaded_files=0, uploaded_failed=0)
             except Exception as exc:
-                logger.warning("mkdir skills dirs failed: %s: %s", type(exc).__name__, str(exc))
-
-            # 关键逻辑：上传文件并检查每个文件的上传结果（使用异步方法）
-            upload_responses = await sandbox_backend.aupload_files(files_to_upload)
+                logger.warning("skills sentinel probe failed: %s: %s", type(exc).__name__, str(exc))
 
-            success_count = 0
-            error_count = 0
-            for resp in upload_responses or []:
-                if getattr(resp, "error", None):
-                    error_count += 1
-                    logger.error(
-                        "skill upload FAILED | session_id=%s | path=%s | error=%s",
-                        session_id,
-                        getattr(resp, "path", ""),
-                        getattr(resp, "error", ""),
-                    )
-                else:
-                    success_count += 1
-                    logger.debug(
-                        "skill upload OK | session_id=%s | path=%s",
-                        session_id,
-                        getattr(resp, "path", ""),
-                    )
-
-            logger.info(
-                "skills upload summary | session_id=%s | success=%s | failed=%s | total=%s",
-                session_id,
-                success_count,
-                error_count,
-                len(upload_responses or []),
+            # 关键逻辑：优先打成一个 tar.gz 上传，沙箱里一条命令完成 mkdir + 解压 + 写标记
+            archive_ok = await self._upload_as_archive(
+                sandbox_backend=sandbox_backend,
+                session_id=session_id,
+                files_to_upload=files_to_upload,
+                remote_root=remote_root,
+                digest=digest,
             )
+            if archive_ok:
+                success_count, error_count = len(files_to_upload), 0
+                if sandbox_id:
+                    _remember_synced_sandbox(sandbox_id, digest)
+            else:
+                # 回退：逐个文件上传（沙箱缺少 tar 或解压失败时）
+                success_count, error_count = await self._upload_files_individually(
+                    sandbox_backend=sandbox_backend,
+                    session_id=session_id,
+                    files_to_upload=files_to_upload,
+                    remote_root=remote_root,
+                    skill_dirs_to_create=skill_dirs_to_create,
+                )
+                if error_count == 0:
+                    try:
+                        await sandbox_backend.aexecute(f"echo {digest} > {SKILLS_SYNCED_SENTINEL}")
+                        if sandbox_id:
+                            _remember_synced_sandbox(sandbox_id, digest)
+                    except Exception as exc:
+                        logger.warning("skills sentinel write failed: %s: %s", type(exc).__name__, str(exc))
 
             # 关键逻辑：同步后做一次目录自检（不影响主链路，只做日志）
+            # 说明：目录列表与抽样文件 head 合并成一条命令，只占一次沙箱往返
             try:
-                check = await sandbox_backend.aexecute(f"ls -la {remote_root} || true")
-                logger.info("sandbox skills dir check | session_id=%s | %s", session_id, getattr(check, "output", ""))
-
-                # 抽一个文件做 head 检查
+                check_cmd = f"ls -la {remote_root} || true"
                 if files_to_upload:
                     sample_path = files_to_upload[0][0]
-                    head_check = await sandbox_backend.aexecute(
-                        f"head -n 5 {sample_path} 2>&1 || echo 'FILE_NOT_FOUND'"
-                    )
-                    logger.info(
-                        "skill file sample check | session_id=%s | path=%s | output=%s",
-                        session_id,
-                        sample_path,
-                        str(getattr(head_check, "output", ""))[:200],
-                    )
+                    check_cmd += f" ; echo '--- {sample_path}' ; head -n 5 {sample_path} 2>&1 || echo 'FILE_NOT_FOUND'"
+                check = await sandbox_backend.aexecute(check_cmd)
+                logger.info(
+                    "sandbox skills dir check | session_id=%s | %s",
+                    session_id,
+                    str(getattr(check, "output", ""))[:2000],
+                )
             except Exception as exc:
                 logger.warning("sandbox skills dir check failed: %s: %s", type(exc).__name__, str(exc))
 
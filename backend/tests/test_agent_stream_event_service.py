@@ -0,0 +1,224 @@
+import asyncio
+
+from backend.services.agent_stream_event_service import AgentStreamEventService
+
+
+class _FakeMongo:
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, str | None]] = []
+
+    def upsert_tool_message(self, **kwargs):  # noqa: ANN003
+        self.calls.append((kwargs["tool_call_id"], kwargs.get("tool_status")))
+
+
+def test_schedule_write_should_keep_order_and_flush():
+    fake_mongo = _FakeMongo()
+    service = AgentStreamEventService(mongo=fake_mongo)
+
+    async def _run() -> None:
+        service.schedule_write(fake_mongo.upsert_tool_message, tool_call_id="t-1", tool_status="running")
+        service.schedule_write(fake_mongo.upsert_tool_message, tool_call_id="t-1", tool_status="success")
+        await service.flush_writes()
+
+    asyncio.run(_run())
+
+    assert fake_mongo.calls == [("t-1", "running"), ("t-1", "success")]
+
+
+def test_parse_chunk_should_emit_delta_and_tool_end():
+    from langchain_core.messages import AIMessageChunk, ToolMessage
+
+    fake_mongo = _FakeMongo()
+    service = AgentStreamEventService(mongo=fake_mongo)
+    state = service.init_state()
+
+    async def _run() -> tuple[list[dict], list[dict]]:
+        text_out = service.parse_chunk(
+            chunk=((), "messages", (AIMessageChunk(content="hello"), {})),
+            state=state,
+            thread_id="th-1",
+            assistant_id="a-1",
+            current_message_id="m-1",
+        )
+        tool_out = service.parse_chunk(
+            chunk=((), "messages", (ToolMessage(content="ok", tool_call_id="t-1", name="fetch_url"), {})),
+            state=state,
+            thread_id="th-1",
+            assistant_id="a-1",
+            current_message_id="m-1",
+        )
+        await service.flush_writes()
+        return text_out.events, tool_out.events
+
+    text_events, tool_events = asyncio.run(_run())
+
+    assert text_events == [{"type": "chat.delta", "text": "hello"}]
+    assert tool_events[0]["type"] == "tool.end"
+    assert tool_events[0]["status"] == "success"
+    assert tool_events[0]["output"] == "ok"
+    assert fake_mongo.calls == [("t-1", "success")]
+
+
+def test_append_tool_args_chunk_should_parse_once_complete():
+    service = AgentStreamEventService(mongo=_FakeMongo())
+    state = service.init_state()
+
+    assert service._append_tool_args_chunk(state=state, tool_id="t-1", chunk_args='{"url": ') is None
+    assert service._append_tool_args_chunk(state=state, tool_id="t-1", chunk_args='"https://a.b"') is None
+    assert service._append_tool_args_chunk(state=state, tool_id="t-1", chunk_args="}") == {"url": "https://a.b"}
+
+
+def test_append_tool_args_chunk_should_ignore_brackets_inside_strings(monkeypatch):
+    from backend.services import agent_stream_event_service as module
+
+    parse_calls: list[str] = []
+    real_json_loads = module.json_loads
+
+    def counting_json_loads(raw):
+        parse_calls.append(raw)
+        return real_json_loads(raw)
+
+    monkeypatch.setattr(module, "json_loads", counting_json_loads)
+    service = AgentStreamEventService(mongo=_FakeMongo())
+    state = service.init_state()
+    chunks = ['{"code": "if (a) { b[0] = \\', '"}\\"; }", ', '"opts": {"n": 1}', "}"]
+
+    results = [service._append_tool_args_chunk(state=state, tool_id="t-1", chunk_args=c) for c in chunks]
+
+    assert results[:-1] == [None, None, None]
+    assert results[-1] == {"code": 'if (a) { b[0] = "}"; }', "opts": {"n": 1}}
+    # 中间分片即使以 } 结尾也不会触发解析，只在顶层对象闭合时解析一次
+    assert len(parse_calls) == 1
+    assert service._parse_tool_args("not json") == {"value": "not json"}
+
+
+def test_parse_chunk_should_skip_identical_rag_references():
+    import json
+
+    from langchain_core.messages import ToolMessage
+
+    service = AgentStreamEventService(mongo=_FakeMongo())
+    state = service.init_state()
+    forced_refs = [{"index": 1, "source": "a.md", "mongo_id": "d-1", "score": 0.9, "text": "x"}]
+    refs_out = list(forced_refs)
+
+    def _parse(tool_call_id: str, refs: list[dict]) -> list[dict]:
+        message = ToolMessage(content=json.dumps(refs), tool_call_id=tool_call_id, name="rag_query")
+        return service.parse_chunk(
+            chunk=((), "messages", (message, {})),
+            state=state,
+            thread_id="th-1",
+            assistant_id="a-1",
+            current_message_id="m-1",
+            rag_references_out=refs_out,
+        ).events
+
+    same_events = _parse("t-1", forced_refs)
+    new_refs = [{"index": 1, "source": "b.md", "mongo_id": "d-2", "score": 0.8, "text": "y"}]
+    new_events = _parse("t-2", new_refs)
+
+    assert [ev["type"] for ev in same_events] == ["tool.end"]
+    assert [ev["type"] for ev in new_events] == ["rag.references", "tool.end"]
+    assert refs_out == new_refs
+
+
+def test_parse_chunk_should_coalesce_text_buffered_during_tool_call():
+    from langchain_core.messages import AIMessageChunk, ToolMessage
+
+    service = AgentStreamEventService(mongo=_FakeMongo())
+    state = service.init_state()
+
+    def _parse(message) -> list[dict]:
+        return service.parse_chunk(
+            chunk=((), "messages", (message, {})),
+            state=state,
+            thread_id="th-1",
+            assistant_id="a-1",
+            current_message_id="m-1",
+        ).events
+
+    async def _run() -> list[dict]:
+        _parse(AIMessageChunk(content="", tool_calls=[{"id": "t-1", "name": "fetch_url", "args": {}}]))
+        assert _parse(AIMessageChunk(content="foo")) == []
+        assert _parse(AIMessageChunk(content="bar")) == []
+        events = _parse(ToolMessage(content="ok", tool_call_id="t-1", name="fetch_url"))
+        await service.flush_writes()
+        return events
+
+    events = asyncio.run(_run())
+
+    assert [ev["type"] for ev in events] == ["tool.end", "chat.delta"]
+    assert events[1]["text"] == "foobar"
+    assert state.drain_pending_text() == ""
+
+
+def test_schedule_write_should_batch_queued_writes_into_one_thread_hop(monkeypatch):
+    fake_mongo = _FakeMongo()
+    service = AgentStreamEventService(mongo=fake_mongo)
+    batch_sizes: list[int] = []
+    original_run_writes = service._run_writes
+
+    def _spy(batch):
+        batch_sizes.append(len(batch))
+        original_run_writes(batch)
+
+    monkeypatch.setattr(service, "_run_writes", _spy)
+
+    async def _run() -> None:
+        for i in range(5):
+            service.schedule_write(fake_mongo.upsert_tool_message, tool_call_id=f"t-{i}", tool_status="running")
+        await service.flush_writes()
+
+    asyncio.run(_run())
+
+    assert [call[0] for call in fake_mongo.calls] == [f"t-{i}" for i in range(5)]
+    assert batch_sizes == [5]
+
+
+def test_run_writes_should_merge_consecutive_tool_upserts_into_bulk_write():
+    log: list[object] = []
+
+    class _BulkMongo(_FakeMongo):
+        def bulk_upsert_tool_messages(self, items):  # noqa: ANN001
+            log.append([item["tool_call_id"] for item in items])
+
+    fake_mongo = _BulkMongo()
+    service = AgentStreamEventService(mongo=fake_mongo)
+
+    service._run_writes(
+        [
+            (fake_mongo.upsert_tool_message, {"tool_call_id": "t-1", "tool_status": "running"}),
+            (fake_mongo.upsert_tool_message, {"tool_call_id": "t-2", "tool_status": "running"}),
+            (lambda **_: log.append("segment"), {}),
+            (fake_mongo.upsert_tool_message, {"tool_call_id": "t-1", "tool_status": "success"}),
+        ]
+    )
+
+    # 连续的 upsert 合成一次 bulk，被其它写入隔开时保持原顺序，单条时直接走 upsert_tool_message
+    assert log == [["t-1", "t-2"], "segment"]
+    assert fake_mongo.calls == [("t-1", "success")]
+
+
+def test_flush_writes_should_stop_waiting_after_timeout_but_keep_writing():
+    import threading
+
+    release = threading.Event()
+    written: list[str] = []
+    service = AgentStreamEventService(mongo=_FakeMongo())
+
+    def _slow_write() -> None:
+        release.wait(5)
+        written.append("slow")
+
+    async def _run() -> tuple[bool, bool]:
+        service.schedule_write(_slow_write)
+        timed_out = await service.flush_writes(timeout=0.05)
+        release.set()
+        drained = await service.flush_writes()
+        return timed_out, drained
+
+    timed_out, drained = asyncio.run(_run())
+
+    assert timed_out is False
+    assert drained is True
+    assert written == ["slow"]
@@ -1,5 +1,8 @@
+import asyncio
+import time
 from pathlib import Path
 
+from backend.services import chat_stream_service as chat_stream_service_module
 from backend.services.chat_stream_service import ChatStreamService
 
 
@@ -17,6 +20,10 @@ class _FakeMongo:
             return None
         return {"filename": "需求文档.md"}
 
+    def get_document_filenames(self, *, doc_ids: list[str]):  # noqa: ANN001
+        self.bulk_calls = getattr(self, "bulk_calls", 0) + 1
+        return {"mongo-1": "需求文档.md"} if "mongo-1" in doc_ids else {}
+
 
 def test_build_attachments_meta_should_support_filesystem_write_ref(tmp_path: Path):
     service = ChatStreamService(base_dir=tmp_path)
@@ -30,3 +37,393 @@ def test_build_attachments_meta_should_support_filesystem_write_ref(tmp_path: Pa
         {"mongo_id": "mongo-1", "filename": "需求文档.md"},
         {"mongo_id": "fsw:s-001:w-001", "filename": "设计方案.md"},
     ]
+
+
+def test_resolve_attachments_meta_should_keep_order_and_fallback(tmp_path: Path):
+    service = ChatStreamService(base_dir=tmp_path)
+
+    fake_mongo = _FakeMongo()
+    result = asyncio.run(
+        service._resolve_attachments_meta(
+            mongo=fake_mongo,
+            file_refs=["fsw:s-001:w-001", "unknown-id", "mongo-1"],
+        )
+    )
+
+    assert result == [
+        {"mongo_id": "fsw:s-001:w-001", "filename": "设计方案.md"},
+        {"mongo_id": "unknown-id", "filename": "unknown-id"},
+        {"mongo_id": "mongo-1", "filename": "需求文档.md"},
+    ]
+    assert fake_mongo.bulk_calls == 1
+
+
+def test_generate_suggested_questions_should_parse_lines_and_swallow_errors():
+    from types import SimpleNamespace
+
+    class _FakeModel:
+        def __init__(self, content=None, exc=None):
+            self._content = content
+            self._exc = exc
+
+        async def ainvoke(self, messages):  # noqa: ANN001
+            if self._exc:
+                raise self._exc
+            return SimpleNamespace(content=self._content)
+
+    service = ChatStreamService(base_dir=Path("."))
+    chat_stream_service_module._suggested_questions_cache.clear()
+
+    questions = asyncio.run(
+        service._generate_suggested_questions(
+            model=_FakeModel("# 推荐\nQ1\n\nQ2\nQ3\nQ4"), user_text="u", assistant_text="a"
+        )
+    )
+    failed = asyncio.run(
+        service._generate_suggested_questions(model=_FakeModel(exc=RuntimeError("x")), user_text="u2", assistant_text="a")
+    )
+
+    assert questions == ["Q1", "Q2", "Q3"]
+    assert failed == []
+
+
+def test_build_system_prompt_parts_should_list_selected_sources():
+    service = ChatStreamService(base_dir=Path("."))
+
+    parts = service._build_system_prompt_parts(
+        memory_text="记忆",
+        attachments_meta=[{"mongo_id": "m1", "filename": "a.pdf"}, {"mongo_id": "m2", "filename": ""}],
+    )
+
+    assert len(parts) == 1
+    lines = parts[0].split("\n")
+    assert lines[0] == "<selected_sources>"
+    assert lines[-1] == "</selected_sources>"
+    assert "- a.pdf (id=m1)" in lines
+    assert "- m2 (id=m2)" in lines
+
+
+def test_generate_suggested_questions_should_reuse_cached_result():
+    from types import SimpleNamespace
+
+    class _CountingModel:
+        def __init__(self) -> None:
+            self.calls = 0
+
+        async def ainvoke(self, messages):  # noqa: ANN001
+            self.calls += 1
+            return SimpleNamespace(content="Q1\nQ2\nQ3")
+
+    service = ChatStreamService(base_dir=Path("."))
+    chat_stream_service_module._suggested_questions_cache.clear()
+    model = _CountingModel()
+    long_reply = "回" * 600
+
+    first = asyncio.run(service._generate_suggested_questions(model=model, user_text="u", assistant_text=long_reply))
+    # 只有 prompt 窗口之外的回复内容不同，仍应命中缓存
+    second = asyncio.run(
+        service._generate_suggested_questions(model=model, user_text="u", assistant_text=long_reply + "尾巴")
+    )
+    third = asyncio.run(service._generate_suggested_questions(model=model, user_text="other", assistant_text=long_reply))
+
+    assert first == second == third == ["Q1", "Q2", "Q3"]
+    assert model.calls == 2
+
+
+def test_resolve_attachments_meta_should_fallback_on_timeout(tmp_path: Path, monkeypatch):
+    service = ChatStreamService(base_dir=tmp_path)
+    monkeypatch.setattr(chat_stream_service_module, "_ATTACHMENT_META_TIMEOUT_SECONDS", 0.05)
+
+    class _SlowMongo(_FakeMongo):
+        def get_document_filenames(self, *, doc_ids: list[str]):  # noqa: ANN001
+            time.sleep(0.5)
+            return super().get_document_filenames(doc_ids=doc_ids)
+
+    result = asyncio.run(
+        service._resolve_attachments_meta(mongo=_SlowMongo(), file_refs=["mongo-1", "fsw:s-001:w-001"])
+    )
+
+    assert result == [
+        {"mongo_id": "mongo-1", "filename": "mongo-1"},
+        {"mongo_id": "fsw:s-001:w-001", "filename": "设计方案.md"},
+    ]
+
+
+def test_replay_cached_answer_should_stream_and_persist(monkeypatch):
+    from contextlib import asynccontextmanager
+
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langgraph.checkpoint.memory import InMemorySaver
+
+    class _FakeChatService:
+        def __init__(self) -> None:
+            self.saved: list[dict] = []
+            self.memory: list[dict] = []
+
+        def save_assistant_message(self, **kwargs):
+            self.saved.append(kwargs)
+            return "msg-1"
+
+        def save_chat_memory(self, **kwargs):
+            self.memory.append(kwargs)
+            return True
+
+    saver = InMemorySaver()
+
+    @asynccontextmanager
+    async def _checkpointer():
+        yield saver
+
+    fake_chat_service = _FakeChatService()
+    monkeypatch.setattr(chat_stream_service_module, "get_chat_service", lambda: fake_chat_service)
+    monkeypatch.setattr(chat_stream_service_module, "get_checkpointer", _checkpointer)
+    monkeypatch.setattr(
+        chat_stream_service_module, "_get_chat_model", lambda name: GenericFakeChatModel(messages=iter([]))
+    )
+    service = ChatStreamService(base_dir=Path("."))
+    references = [{"index": 1, "mongo_id": "m1", "text": "片段"}]
+    answer = "答" * 100
+
+    async def collect():
+        return [
+            ev
+            async for ev in service._replay_cached_answer(
+                cached={"answer": answer, "suggested_questions": ["Q1"]},
+                thread_id="t1",
+                assistant_id="agent",
+                attachments_meta=[{"mongo_id": "m1", "filename": "a.pdf"}],
+                rag_references=references,
+                checkpoint_user_text="问题\n片段",
+                memory_user_text="问题",
+                persist_chat_memory=True,
+                emit_suggested_questions=True,
+            )
+        ]
+
+    events = asyncio.run(collect())
+
+    assert "".join(ev["text"] for ev in events if ev["type"] == "chat.delta") == answer
+    assert events[-2] == {"type": "suggested.questions", "questions": ["Q1"]}
+    assert events[-1] == {"type": "session.status", "status": "done"}
+    assert fake_chat_service.saved[0]["references"] == references
+    assert fake_chat_service.memory[0]["assistant_text"] == answer
+    # 回放的这轮问答写进 checkpoint，下一轮 agent 能看到上下文
+    agent = chat_stream_service_module.create_deep_agent(
+        model=GenericFakeChatModel(messages=iter([])), tools=[], checkpointer=saver
+    )
+    state = agent.get_state({"configurable": {"thread_id": "t1"}})
+    assert [(m.type, m.content) for m in state.values["messages"]] == [
+        ("human", "问题\n片段"),
+        ("ai", answer),
+    ]
+
+
+def test_evidence_jaccard_should_require_matching_snippets():
+    cached = chat_stream_service_module._evidence_keys([{"mongo_id": "m1", "text": "a"}, {"mongo_id": "m1", "text": "b"}])
+
+    same = chat_stream_service_module._evidence_keys([{"mongo_id": "m1", "text": "b"}, {"mongo_id": "m1", "text": "a"}])
+    changed = chat_stream_service_module._evidence_keys([{"mongo_id": "m1", "text": "a"}, {"mongo_id": "m1", "text": "c"}])
+
+    assert chat_stream_service_module._evidence_jaccard(cached, same) == 1.0
+    assert chat_stream_service_module._evidence_jaccard(cached, changed) < 0.8
+    assert chat_stream_service_module._evidence_jaccard(cached, []) == 0.0
+
+
+def test_build_tools_should_reuse_list_while_mcp_tools_unchanged(monkeypatch):
+    def mcp_echo(text: str) -> str:
+        """echo"""
+        return text
+
+    class _FakeMcpService:
+        def __init__(self) -> None:
+            self.tools = [mcp_echo]
+
+        async def get_tools(self):
+            return self.tools
+
+    fake_mcp = _FakeMcpService()
+    monkeypatch.setattr(chat_stream_service_module, "get_mcp_tool_service", lambda: fake_mcp)
+    monkeypatch.setattr(chat_stream_service_module, "_built_tools_cache", None)
+    service = ChatStreamService(base_dir=Path("."))
+
+    first = asyncio.run(service._build_tools())
+    second = asyncio.run(service._build_tools())
+    fake_mcp.tools = [mcp_echo]
+    third = asyncio.run(service._build_tools())
+
+    assert first is second
+    assert third is not first
+    assert "mcp_echomcp_echo" in {getattr(t, "__name__", "") for t in third}
+
+
+def test_stream_chat_should_not_mutate_shared_tool_list_across_turns(monkeypatch):
+    from contextlib import asynccontextmanager
+    from types import SimpleNamespace
+
+    from backend.services.rag_service import RagPreparationResult
+
+    class _StopAfterAgentBuilt(Exception):
+        pass
+
+    class _NoMcp:
+        async def get_tools(self):
+            return []
+
+    class _FakeRagService:
+        def __init__(self, **_):  # noqa: ANN003
+            pass
+
+        async def force_rag_if_needed(self, *, persist_after=None, **_):  # noqa: ANN001, ANN003
+            if persist_after is not None:
+                await persist_after
+            return RagPreparationResult("", "", [], [], lambda query: [])
+
+    class _FakeSkillsSync:
+        def __init__(self, **_):  # noqa: ANN003
+            pass
+
+        async def sync_skills_to_sandbox(self, **_):  # noqa: ANN003
+            return SimpleNamespace(events=[])
+
+    async def _cleanup(**_):  # noqa: ANN003
+        return None
+
+    async def _provision(self, *, thread_id):  # noqa: ANN001
+        return SimpleNamespace(id=f"sb-{thread_id}")
+
+    @asynccontextmanager
+    async def _checkpointer():
+        yield object()
+
+    agent_tools: list[list] = []
+
+    def _create_deep_agent(**kwargs):  # noqa: ANN003
+        agent_tools.append(kwargs["tools"])
+        raise _StopAfterAgentBuilt
+
+    monkeypatch.setattr(chat_stream_service_module, "_built_tools_cache", None)
+    monkeypatch.setattr(chat_stream_service_module, "get_mcp_tool_service", lambda: _NoMcp())
+    monkeypatch.setattr(
+        chat_stream_service_module, "get_checkpoint_service", lambda: SimpleNamespace(cleanup_keep_last=_cleanup)
+    )
+    monkeypatch.setattr(
+        chat_stream_service_module, "get_mongo_manager", lambda: SimpleNamespace(get_chat_memory=lambda **_: "")
+    )
+    monkeypatch.setattr(chat_stream_service_module, "get_chat_service", lambda: SimpleNamespace())
+    monkeypatch.setattr(chat_stream_service_module, "RagService", _FakeRagService)
+    monkeypatch.setattr(chat_stream_service_module, "SkillsSyncService", _FakeSkillsSync)
+    monkeypatch.setattr(chat_stream_service_module, "get_checkpointer", _checkpointer)
+    monkeypatch.setattr(chat_stream_service_module, "_get_chat_model", lambda name: object())
+    monkeypatch.setattr(chat_stream_service_module, "create_deep_agent", _create_deep_agent)
+    monkeypatch.setattr(ChatStreamService, "_provision_sandbox", _provision)
+    service = ChatStreamService(base_dir=Path("."))
+
+    async def _turn(thread_id: str) -> None:
+        try:
+            async for _ in service.stream_chat(text="你好", thread_id=thread_id, persist_user_message=False):
+                pass
+        except _StopAfterAgentBuilt:
+            pass
+
+    shared = asyncio.run(service._build_tools())
+    shared_len = len(shared)
+    asyncio.run(_turn("t-1"))
+    asyncio.run(_turn("t-2"))
+
+    # 每轮各自带一个 save_filesystem_write，共享的缓存列表本身不被修改
+    assert chat_stream_service_module._built_tools_cache[1] is shared
+    assert len(shared) == shared_len
+    for tools in agent_tools:
+        assert [getattr(t, "__name__", "") for t in tools].count("save_filesystem_write") == 1
+    assert len(agent_tools) == 2
+
+
+def test_stream_chat_should_flush_buffered_delta_before_slow_chunk(monkeypatch):
+    from contextlib import asynccontextmanager
+    from types import SimpleNamespace
+
+    from langchain_core.messages import AIMessageChunk
+
+    from backend.services.rag_service import RagPreparationResult
+
+    class _NoMcp:
+        async def get_tools(self):
+            return []
+
+    class _FakeRagService:
+        def __init__(self, **_):  # noqa: ANN003
+            pass
+
+        async def force_rag_if_needed(self, *, persist_after=None, **_):  # noqa: ANN001, ANN003
+            if persist_after is not None:
+                await persist_after
+            return RagPreparationResult("", "", [], [], lambda query: [])
+
+    class _FakeSkillsSync:
+        def __init__(self, **_):  # noqa: ANN003
+            pass
+
+        async def sync_skills_to_sandbox(self, **_):  # noqa: ANN003
+            return SimpleNamespace(events=[])
+
+    async def _cleanup(**_):  # noqa: ANN003
+        return None
+
+    async def _provision(self, *, thread_id):  # noqa: ANN001
+        return SimpleNamespace(id=f"sb-{thread_id}")
+
+    @asynccontextmanager
+    async def _checkpointer():
+        yield object()
+
+    slow_chunk_sent = asyncio.Event()
+
+    class _FakeAgent:
+        async def astream(self, *_, **__):  # noqa: ANN002, ANN003
+            yield ((), "messages", (AIMessageChunk(content="首"), {}))
+            yield ((), "messages", (AIMessageChunk(content="个"), {}))
+            await asyncio.sleep(0.3)
+            slow_chunk_sent.set()
+            # 不产生任何事件的 chunk（例如仅含 usage 的消息块）
+            yield ((), "messages", (AIMessageChunk(content=""), {}))
+
+    monkeypatch.setattr(chat_stream_service_module, "_built_tools_cache", None)
+    monkeypatch.setattr(chat_stream_service_module, "get_mcp_tool_service", lambda: _NoMcp())
+    monkeypatch.setattr(
+        chat_stream_service_module, "get_checkpoint_service", lambda: SimpleNamespace(cleanup_keep_last=_cleanup)
+    )
+    monkeypatch.setattr(
+        chat_stream_service_module, "get_mongo_manager", lambda: SimpleNamespace(get_chat_memory=lambda **_: "")
+    )
+    monkeypatch.setattr(
+        chat_stream_service_module,
+        "get_chat_service",
+        lambda: SimpleNamespace(
+            save_assistant_message=lambda *_, **__: "m-1", update_assistant_message=lambda *_, **__: None
+        ),
+    )
+    monkeypatch.setattr(chat_stream_service_module, "RagService", _FakeRagService)
+    monkeypatch.setattr(chat_stream_service_module, "SkillsSyncService", _FakeSkillsSync)
+    monkeypatch.setattr(chat_stream_service_module, "get_checkpointer", _checkpointer)
+    monkeypatch.setattr(chat_stream_service_module, "_get_chat_model", lambda name: object())
+    monkeypatch.setattr(chat_stream_service_module, "create_deep_agent", lambda **_: _FakeAgent())
+    monkeypatch.setattr(ChatStreamService, "_provision_sandbox", _provision)
+    service = ChatStreamService(base_dir=Path("."))
+
+    async def _run() -> list[tuple[str, bool]]:
+        deltas: list[tuple[str, bool]] = []
+        async for event in service.stream_chat(
+            text="你好",
+            thread_id="t-flush",
+            persist_user_message=False,
+            persist_chat_memory=False,
+            emit_suggested_questions=False,
+        ):
+            if event.get("type") == "chat.delta":
+                deltas.append((event["text"], slow_chunk_sent.is_set()))
+        return deltas
+
+    deltas = asyncio.run(_run())
+
+    # 首个增量立即下发；第二个增量在合并窗口到期时下发，不等慢 chunk 到达
+    assert deltas == [("首", False), ("个", False)]
@@ -0,0 +1,75 @@
+import asyncio
+
+from backend.services.chat_stream_service import _AstreamCancelGuard, _iter_with_cancel_guard, _watch_cancel
+from backend.services.session_cancel_service import SessionCancelService
+
+
+async def _slow_stream():
+    yield "chunk-1"
+    await asyncio.sleep(30)
+    yield "chunk-2"
+
+
+def test_watch_cancel_should_interrupt_pending_astream():
+    cancel_service = SessionCancelService()
+    thread_id = "cancel-watch-test"
+    cancel_service.clear(thread_id)
+
+    async def _run() -> tuple[list[str], bool]:
+        guard = _AstreamCancelGuard()
+        received: list[str] = []
+        watcher = asyncio.create_task(
+            _watch_cancel(
+                cancel_service=cancel_service,
+                thread_id=thread_id,
+                cancel_version=cancel_service.get_version(thread_id),
+                guard=guard,
+                target_task=asyncio.current_task(),
+            )
+        )
+        try:
+            async for chunk in _iter_with_cancel_guard(_slow_stream(), guard):
+                received.append(chunk)
+                cancel_service.cancel(thread_id)
+        except asyncio.CancelledError:
+            asyncio.current_task().uncancel()
+        finally:
+            watcher.cancel()
+        return received, guard.fired
+
+    received, fired = asyncio.run(asyncio.wait_for(_run(), timeout=5))
+    cancel_service.clear(thread_id)
+
+    assert received == ["chunk-1"]
+    assert fired is True
+
+
+def test_watch_cancel_should_wake_on_cancel_notification_and_unsubscribe():
+    cancel_service = SessionCancelService()
+    thread_id = "cancel-notify-test"
+    cancel_service.clear(thread_id)
+
+    async def _run() -> _AstreamCancelGuard:
+        guard = _AstreamCancelGuard()
+        watcher = asyncio.create_task(
+            _watch_cancel(
+                cancel_service=cancel_service,
+                thread_id=thread_id,
+                cancel_version=cancel_service.get_version(thread_id),
+                guard=guard,
+                target_task=None,
+            )
+        )
+        await asyncio.sleep(0)
+        assert guard.requested is False
+        # 取消请求来自线程池时同样能唤醒监听任务
+        await asyncio.to_thread(cancel_service.cancel, thread_id)
+        await watcher
+        return guard
+
+    guard = asyncio.run(asyncio.wait_for(_run(), timeout=5))
+    cancel_service.clear(thread_id)
+
+    assert guard.requested is True
+    assert guard.fired is False
+    assert thread_id not in cancel_service._listeners
@@ -31,3 +31,75 @@ def test_cleanup_keep_last_should_not_fail_when_checkpoint_tables_missing(tmp_pa
 
     assert result.deleted_checkpoints == 0
     assert result.deleted_writes == 0
+
+
+def test_cleanup_keep_last_should_delete_old_checkpoints_and_writes(tmp_path: Path, monkeypatch):
+    import sqlite3
+
+    db_path = tmp_path / "sessions.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE checkpoints (thread_id TEXT, checkpoint_id TEXT)")
+        conn.execute("CREATE TABLE writes (thread_id TEXT, checkpoint_id TEXT)")
+        for idx in range(5):
+            conn.execute("INSERT INTO checkpoints VALUES (?, ?)", ("s1", f"c{idx}"))
+            conn.execute("INSERT INTO writes VALUES (?, ?)", ("s1", f"c{idx}"))
+        conn.execute("INSERT INTO checkpoints VALUES (?, ?)", ("s2", "c0"))
+
+    monkeypatch.setattr(checkpoint_service, "get_db_path", lambda: db_path)
+
+    result = asyncio.run(CheckpointService(keep_last=2).cleanup_keep_last(session_id="s1"))
+
+    assert result.deleted_checkpoints == 3
+    assert result.deleted_writes == 3
+    with sqlite3.connect(db_path) as conn:
+        remaining = conn.execute("SELECT thread_id, checkpoint_id FROM checkpoints ORDER BY 1, 2").fetchall()
+        remaining_writes = conn.execute("SELECT checkpoint_id FROM writes ORDER BY 1").fetchall()
+    assert remaining == [("s1", "c3"), ("s1", "c4"), ("s2", "c0")]
+    assert remaining_writes == [("c3",), ("c4",)]
+
+
+def test_shared_checkpointer_should_be_reused_within_event_loop(tmp_path: Path, monkeypatch):
+    from backend.services import checkpointer_provider
+
+    db_path = tmp_path / "sessions.db"
+    monkeypatch.setattr(checkpointer_provider, "get_db_path", lambda: db_path)
+    monkeypatch.setattr(checkpoint_service, "get_db_path", lambda: db_path)
+
+    async def run():
+        await checkpointer_provider.open_shared_checkpointer()
+        try:
+            async with checkpointer_provider.get_checkpointer() as first:
+                pass
+            async with checkpointer_provider.get_checkpointer() as second:
+                pass
+            result = await CheckpointService(keep_last=2).cleanup_keep_last(session_id="s1")
+            async with checkpointer_provider.get_checkpoint_db(db_path) as db:
+                cur = await db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'")
+                indexes = {row[0] for row in await cur.fetchall()}
+                cur = await db.execute("PRAGMA journal_mode")
+                journal_mode = (await cur.fetchone())[0]
+            return first, second, result, indexes, journal_mode
+        finally:
+            await checkpointer_provider.close_shared_checkpointer()
+
+    first, second, result, indexes, journal_mode = asyncio.run(run())
+
+    assert first is second
+    assert journal_mode == "wal"
+    assert indexes == {"idx_checkpoints_thread_checkpoint", "idx_writes_thread_checkpoint"}
+    assert result.deleted_checkpoints == 0
+    assert checkpointer_provider._shared_saver is None
+
+
+def test_startup_should_survive_checkpointer_open_failure(monkeypatch):
+    from backend.api import web_app
+    from backend.services import checkpointer_provider
+
+    async def _fail() -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(checkpointer_provider, "open_shared_checkpointer", _fail)
+
+    asyncio.run(web_app._startup_open_checkpointer())
+
+    assert checkpointer_provider._shared_saver is None
@@ -0,0 +1,175 @@
+from pathlib import Path
+
+from backend.services import creative_agent_service
+from backend.services.creative_agent_service import DeepCreativeAgentClient, default_prompt_plan
+
+
+class _FakeAgent:
+    def __init__(self, system_prompt: str) -> None:
+        self.system_prompt = system_prompt
+
+    def stream(self, payload, stream_mode, config):  # noqa: ANN001
+        yield ({"content": "ok"}, {})
+
+
+def test_client_should_build_role_agents_lazily(tmp_path: Path, monkeypatch):
+    built: list[str] = []
+
+    def _fake_create_deep_agent(**kwargs):  # noqa: ANN003
+        built.append(kwargs["system_prompt"])
+        return _FakeAgent(kwargs["system_prompt"])
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(creative_agent_service, "_shared_llm", lambda: object())
+    monkeypatch.setattr(creative_agent_service, "create_deep_agent", _fake_create_deep_agent)
+
+    client = DeepCreativeAgentClient(
+        run_id="r-1",
+        prompt_plan=default_prompt_plan("写一份文档"),
+        workspace_root=tmp_path,
+    )
+    try:
+        assert built == []
+        assert client.clarify_requirement(user_prompt="写一份文档", feedback="") == "ok"
+        assert client.draft_doc(user_prompt="写一份文档", clarified_requirement="", issues=[], c_reason="") == "ok"
+        # 只用到 Agent A 时不构造 B/C，同一角色重复调用也只构造一次
+        assert len(built) == 1
+        assert built[0].startswith("你是 Agent A")
+        assert client._checkpoint_conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    finally:
+        client.close()
+
+
+class _FakeChunk:
+    def __init__(self, content: str) -> None:
+        self.content = content
+
+
+class _FakePlannerLlm:
+    def __init__(self, pieces: list[str]) -> None:
+        self.pieces = pieces
+        self.consumed = 0
+        self.invoked = False
+
+    def stream(self, prompt: str):  # noqa: ANN201
+        for piece in self.pieces:
+            self.consumed += 1
+            yield _FakeChunk(piece)
+
+    def invoke(self, prompt: str):  # noqa: ANN201
+        self.invoked = True
+        return _FakeChunk("")
+
+
+def test_planner_should_stop_stream_once_plan_object_is_complete(monkeypatch):
+    llm = _FakePlannerLlm(
+        [
+            "```json\n{",
+            '"content_goal": "接口文档 {v1}", "agent_a_prompt": "写\\',
+            '"作", "agent_b_prompt": "挑刺", ',
+            '"agent_c_prompt": "判定", "output_requirements": "Markdown"}',
+            "\n```\n以上是方案说明。",
+        ]
+    )
+    monkeypatch.setattr(creative_agent_service, "_shared_llm", lambda: llm)
+    streamed: list[str] = []
+
+    plan = creative_agent_service.LlmPreAgentPlanner().plan(user_prompt="写接口文档", on_chunk=streamed.append)
+
+    assert plan.content_goal == "接口文档 {v1}"
+    assert plan.agent_a_prompt == '写"作'
+    assert plan.output_requirements == "Markdown"
+    # 对象闭合且字段齐全后不再消费剩余分片，也不再走 invoke 兜底
+    assert llm.consumed == 4
+    assert llm.invoked is False
+    assert len(streamed) == 4
+
+
+def test_shared_llm_should_create_model_once(monkeypatch):
+    created: list[object] = []
+
+    def _fake_create_model():  # noqa: ANN202
+        created.append(object())
+        return created[-1]
+
+    monkeypatch.setattr(creative_agent_service, "create_model", _fake_create_model)
+    creative_agent_service._shared_llm.cache_clear()
+    try:
+        first = creative_agent_service.LlmPreAgentPlanner()._llm
+        second = creative_agent_service.LlmPreAgentPlanner()._llm
+    finally:
+        creative_agent_service._shared_llm.cache_clear()
+
+    assert first is second
+    assert len(created) == 1
+
+
+def test_review_prompts_should_share_a_stable_prefix_across_rounds(tmp_path: Path, monkeypatch):
+    prompts: list[str] = []
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(creative_agent_service, "_shared_llm", lambda: object())
+    monkeypatch.setattr(creative_agent_service, "create_deep_agent", lambda **_: object())
+
+    client = DeepCreativeAgentClient(
+        run_id="r-2",
+        prompt_plan=default_prompt_plan("写一份文档"),
+        workspace_root=tmp_path,
+    )
+    monkeypatch.setattr(client, "_invoke_text", lambda *, prompt, **_: prompts.append(prompt) or '{"issues": []}')
+    try:
+        for doc in ("第一版", "第二版"):
+            client.review_doc(
+                user_prompt="写一份文档",
+                clarified_requirement="需求",
+                demo_doc=doc,
+                checklist=["结构完整"],
+                c_reason="",
+            )
+    finally:
+        client.close()
+
+    # 两轮审查只有当前内容之后的部分不同，校验清单等固定信息都在公共前缀里
+    stable_prefix = prompts[0].split("第一版")[0]
+    assert prompts[1].startswith(stable_prefix)
+    assert "校验清单" in stable_prefix
+
+
+def test_parse_loose_json_should_handle_fences_and_non_objects():
+    parse = creative_agent_service._parse_loose_json
+
+    assert parse('{"issues": ["a"]}') == {"issues": ["a"]}
+    assert parse('好的：\n```json\n{"judgement": "reasonable", "reason": "ok"}\n```') == {
+        "judgement": "reasonable",
+        "reason": "ok",
+    }
+    assert parse('["not", "an", "object"]') == {}
+    assert parse("没有 JSON") == {}
+
+
+def test_tool_permission_policy_should_reuse_filter_result_for_same_tools():
+    class _Tool:
+        def __init__(self, name: str) -> None:
+            self.name = name
+
+    def grep():  # noqa: ANN202
+        return None
+
+    tools = [_Tool("read_file"), _Tool("write_file"), grep]
+    policy = creative_agent_service.ToolPermissionPolicy({"read_file", "grep"})
+
+    first = policy.filter_tools(tools)
+    second = policy.filter_tools(list(tools))
+
+    assert [getattr(t, "name", None) or t.__name__ for t in first] == ["read_file", "grep"]
+    assert second == first and second is not first
+    # 工具列表变化时重新过滤
+    assert policy.filter_tools([_Tool("write_file")]) == []
+
+
+def test_content_to_text_should_join_text_blocks_only():
+    to_text = creative_agent_service._content_to_text
+
+    assert to_text("plain") == "plain"
+    assert to_text(["a", {"type": "text", "text": "b"}, {"type": "image_url"}, {"text": ""}]) == "a\nb"
+    assert to_text(None) == ""
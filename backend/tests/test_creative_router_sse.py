@@ -1,4 +1,5 @@
 import asyncio
+import json
 
 from backend.api.routers import creative_router
 
@@ -13,6 +14,10 @@ async def _collect_sse_text(resp) -> str:
     return "".join(parts)
 
 
+def _parse_sse_events(merged: str) -> list[dict]:
+    return [json.loads(frame[len("data: "):]) for frame in merged.split("\n\n") if frame]
+
+
 def test_start_stream_route_returns_sse_chunks(monkeypatch):
     class FakeService:
         def start_run(self, **kwargs):
@@ -33,11 +38,12 @@ def test_start_stream_route_returns_sse_chunks(monkeypatch):
         {"text": "写一个产品介绍", "session_id": "s-100", "assistant_id": "agent"},
     )
 
-    merged = asyncio.run(_collect_sse_text(resp))
-    assert '"type": "ack"' in merged
-    assert '"type": "chunk"' in merged
-    assert '"chunk-a"' in merged
-    assert '"type": "done"' in merged
+    events = _parse_sse_events(asyncio.run(_collect_sse_text(resp)))
+    types = [ev["type"] for ev in events]
+    assert "ack" in types
+    assert "chunk" in types
+    assert any(ev.get("text") == "chunk-a" for ev in events)
+    assert "done" in types
 
 
 def test_requirement_stream_route_returns_sse_chunks(monkeypatch):
@@ -61,8 +67,80 @@ def test_requirement_stream_route_returns_sse_chunks(monkeypatch):
         {"action": "confirm", "feedback": ""},
     )
 
-    merged = asyncio.run(_collect_sse_text(resp))
-    assert '"type": "ack"' in merged
-    assert '"type": "chunk"' in merged
-    assert '"draft-1"' in merged
-    assert '"type": "done"' in merged
+    events = _parse_sse_events(asyncio.run(_collect_sse_text(resp)))
+    types = [ev["type"] for ev in events]
+    assert "ack" in types
+    assert "chunk" in types
+    assert any(ev.get("text") == "draft-1" for ev in events)
+    assert "done" in types
+
+
+def test_stream_route_coalesces_small_chunks(monkeypatch):
+    class FakeService:
+        def start_run(self, **kwargs):
+            return {"run_id": "r-300", "status": "pre_agent_generating"}
+
+        def process_start_run(self, *, run_id: str, on_chunk=None):
+            for token in ["首", "个", "字", "符"]:
+                on_chunk(token)
+            return {"run_id": run_id, "status": "pre_agent_pending_confirm"}
+
+        def mark_async_failure(self, *, run_id: str, stage: str, error_message: str):
+            return {"run_id": run_id, "status": "error"}
+
+    monkeypatch.setattr(creative_router, "_service", lambda: FakeService())
+
+    resp = creative_router.creative_run_start_stream(
+        {"text": "写一个产品介绍", "session_id": "s-300", "assistant_id": "agent"},
+    )
+
+    events = _parse_sse_events(asyncio.run(_collect_sse_text(resp)))
+    chunks = [ev["text"] for ev in events if ev["type"] == "chunk"]
+    # 首个 token 单独立即下发，其余小片段合并，且在 done 之前全部推出
+    assert chunks[0] == "首"
+    assert "".join(chunks) == "首个字符"
+    assert len(chunks) < 4
+    assert events[-1]["type"] == "done"
+
+
+def test_stream_route_flushes_buffered_text_while_worker_is_busy(monkeypatch):
+    import threading
+
+    released = threading.Event()
+    worker_released: list[bool] = []
+
+    class FakeService:
+        def start_run(self, **kwargs):
+            return {"run_id": "r-301", "status": "pre_agent_generating"}
+
+        def process_start_run(self, *, run_id: str, on_chunk=None):
+            on_chunk("首")
+            on_chunk("个")
+            # 模拟随后进入长时间的工具调用：缓冲里的文本应当按超时先推给前端
+            worker_released.append(released.wait(5))
+            return {"run_id": run_id, "status": "pre_agent_pending_confirm"}
+
+        def mark_async_failure(self, *, run_id: str, stage: str, error_message: str):
+            return {"run_id": run_id, "status": "error"}
+
+    monkeypatch.setattr(creative_router, "_service", lambda: FakeService())
+
+    resp = creative_router.creative_run_start_stream(
+        {"text": "写一个产品介绍", "session_id": "s-301", "assistant_id": "agent"},
+    )
+
+    async def _consume() -> list[dict]:
+        events: list[dict] = []
+        async for part in resp.body_iterator:
+            text = part.decode("utf-8") if isinstance(part, bytes) else str(part)
+            for ev in _parse_sse_events(text):
+                events.append(ev)
+                if ev["type"] == "chunk" and ev["text"] == "个":
+                    released.set()
+        return events
+
+    events = asyncio.run(_consume())
+
+    assert worker_released == [True]
+    assert [ev["text"] for ev in events if ev["type"] == "chunk"] == ["首", "个"]
+    assert events[-1]["type"] == "done"
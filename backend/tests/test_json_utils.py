@@ -0,0 +1,18 @@
+import json
+
+from backend.utils.json_utils import json_loads, sse_data_frame
+
+
+def test_sse_data_frame_should_keep_unicode_and_frame_format():
+    frame = sse_data_frame({"type": "chat.delta", "text": "你好"})
+
+    assert frame.startswith(b"data: ")
+    assert frame.endswith(b"\n\n")
+    assert json.loads(frame[len(b"data: ") : -2].decode("utf-8")) == {"type": "chat.delta", "text": "你好"}
+    assert "你好".encode("utf-8") in frame
+
+
+def test_sse_data_frame_should_fallback_for_unsupported_values():
+    frame = sse_data_frame({"n": 2**70})
+
+    assert json_loads(frame[len(b"data: ") : -2]) == {"n": 2**70}
@@ -0,0 +1,31 @@
+from backend.database.mongo_manager import MongoDbManager
+
+
+class _FakeCollection:
+    def __init__(self) -> None:
+        self.calls: list[tuple[list, bool]] = []
+
+    def bulk_write(self, ops, ordered):  # noqa: ANN001
+        self.calls.append((ops, ordered))
+
+
+def test_bulk_upsert_tool_messages_should_merge_same_tool_and_write_unordered(monkeypatch):
+    manager = MongoDbManager(mongo_url="mongodb://unused", db_name="db", collection_name="c")
+    collection = _FakeCollection()
+    monkeypatch.setattr(manager, "_chat_collection", lambda: collection)
+
+    base = {"thread_id": "th-1", "assistant_id": "a-1"}
+    manager.bulk_upsert_tool_messages(
+        [
+            {**base, "tool_call_id": "t-1", "tool_name": "fetch_url", "tool_args": {"u": 1}, "tool_status": "running"},
+            {**base, "tool_call_id": "t-2", "tool_name": "rag_query", "tool_status": "running"},
+            {**base, "tool_call_id": "t-1", "tool_name": "fetch_url", "tool_status": "success", "tool_output": "ok"},
+        ]
+    )
+
+    assert len(collection.calls) == 1
+    ops, ordered = collection.calls[0]
+    assert ordered is False
+    assert [op._filter["tool_call_id"] for op in ops] == ["t-1", "t-2"]
+    # 同一个 tool 的 start/end 合并后，$set 取最后一次的状态，且保留先前写入的参数
+    assert ops[0]._doc["$set"] == {"tool_args": {"u": 1}, "tool_status": "success", "tool_output": "ok"}
@@ -43,3 +43,36 @@ def test_iter_mongo_documents_should_support_filesystem_write_ref(tmp_path: Path
     assert docs[0]["meta"]["filename"] == "demo.md"
     assert docs[0]["bytes"].decode("utf-8") == "这是来自 filesystem_writes 的测试内容"
     assert fake_mongo.calls == [("s-001", "w-001")]
+
+
+def test_load_index_should_reuse_loaded_index_until_persisted_files_change(tmp_path: Path):
+    persist_dir = tmp_path / "rag-index"
+    persist_dir.mkdir()
+    docstore = persist_dir / "docstore.json"
+    docstore.write_text("{}", encoding="utf-8")
+
+    middleware = LlamaIndexRagMiddleware(
+        assistant_id="agent",
+        workspace_root=tmp_path,
+        persist_dir=persist_dir,
+    )
+
+    class _StorageContext:
+        @staticmethod
+        def from_defaults(*, persist_dir: str):  # noqa: ANN205
+            return persist_dir
+
+    loads: list[str] = []
+
+    def _load(storage_context):  # noqa: ANN001, ANN202
+        loads.append(storage_context)
+        return object()
+
+    first = middleware._load_index(_StorageContext, _load)
+    assert middleware._load_index(_StorageContext, _load) is first
+    assert len(loads) == 1
+
+    # 索引重建会重写持久化文件，签名变化后重新加载
+    docstore.write_text('{"rebuilt": true}', encoding="utf-8")
+    assert middleware._load_index(_StorageContext, _load) is not first
+    assert len(loads) == 2
@@ -0,0 +1,25 @@
+from backend.services.rag_semantic_cache import RagSemanticCache
+
+
+def test_get_should_hit_similar_embedding_within_namespace():
+    cache = RagSemanticCache(threshold=0.95)
+    hits = [{"index": 1, "source": "a.md", "text": "x"}]
+
+    cache.put(("agent", ("f1",)), [1.0, 0.0, 0.0], hits)
+
+    assert cache.get(("agent", ("f1",)), [0.99, 0.01, 0.0]) == hits
+    assert cache.get(("agent", ("f1",)), [0.0, 1.0, 0.0]) is None
+    assert cache.get(("agent", ("f2",)), [1.0, 0.0, 0.0]) is None
+
+
+def test_get_should_skip_expired_entries(monkeypatch):
+    from backend.services import rag_semantic_cache
+
+    now = [100.0]
+    monkeypatch.setattr(rag_semantic_cache.time, "monotonic", lambda: now[0])
+    cache = RagSemanticCache(ttl_seconds=10)
+
+    cache.put("ns", [1.0, 0.0], [{"index": 1}])
+    now[0] = 120.0
+
+    assert cache.get("ns", [1.0, 0.0]) is None
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+from backend.services.rag_service import RagService
+
+
+class _FakeMongo:
+    def __init__(self, log: list[str]) -> None:
+        self.log = log
+
+    def upsert_tool_message(self, **kwargs):
+        self.log.append(f"tool:{kwargs.get('tool_status')}")
+
+
+def test_force_rag_should_retrieve_in_parallel_and_persist_after_user_message(tmp_path, monkeypatch):
+    log: list[str] = []
+    retrieval_started = threading.Event()
+    service = RagService(mongo=_FakeMongo(log), base_dir=tmp_path)
+
+    def fake_rag_tool(query: str):
+        retrieval_started.set()
+        return [{"index": 1, "source": "a.md", "score": 0.9, "text": "hit", "mongo_id": "m1"}]
+
+    monkeypatch.setattr(service, "build_rag_tool", lambda **_: fake_rag_tool)
+
+    async def save_user_message():
+        # 检索应当在用户消息落库完成之前就已经开始
+        await asyncio.to_thread(retrieval_started.wait, 5)
+        log.append("user")
+
+    async def run():
+        user_save_task = asyncio.ensure_future(save_user_message())
+        result = await service.force_rag_if_needed(
+            user_text="问题",
+            thread_id="t1",
+            assistant_id="agent",
+            file_refs=["m1"],
+            persist_after=user_save_task,
+        )
+        await user_save_task
+        return result
+
+    result = asyncio.run(run())
+
+    assert retrieval_started.is_set()
+    assert log == ["user", "tool:done"]
+    assert result.rag_references[0]["mongo_id"] == "m1"
+    assert "<rag_context>" in result.rag_context_prompt
+
+
+def test_rag_tool_cache_should_miss_after_index_rebuild(tmp_path, monkeypatch):
+    from backend.services import rag_service as rag_service_module
+    from backend.services.rag_semantic_cache import RagSemanticCache
+
+    class _FakeRag:
+        def __init__(self) -> None:
+            self.signature = (("docstore.json", 1, 10),)
+            self.queries = 0
+
+        def embed(self, text: str):
+            return [1.0, 0.0]
+
+        def query(self, query: str, embedding=None):  # noqa: ANN001
+            self.queries += 1
+            return [{"source": "a.md", "score": 0.9, "text": f"v{self.queries}", "mongo_id": "m1"}]
+
+        def index_signature(self):
+            return self.signature
+
+    fake_rag = _FakeRag()
+    monkeypatch.setattr(rag_service_module, "_get_rag_middleware", lambda *args: fake_rag)
+    monkeypatch.setattr(rag_service_module, "get_rag_semantic_cache", lambda: RagSemanticCache())
+    rag_tool = RagService(mongo=_FakeMongo([]), base_dir=tmp_path).build_rag_tool(assistant_id="agent", file_refs=["m1"])
+
+    assert rag_tool("问题")[0]["text"] == "v1"
+    assert rag_tool("问题")[0]["text"] == "v1"
+    assert fake_rag.queries == 1
+
+    # 索引重建后签名变化，旧的缓存结果不再命中
+    fake_rag.signature = (("docstore.json", 2, 12),)
+    assert rag_tool("问题")[0]["text"] == "v2"
+    assert fake_rag.queries == 2
@@ -0,0 +1,158 @@
+import asyncio
+import io
+import shlex
+import tarfile
+from types import SimpleNamespace
+
+from backend.services.skills_sync_service import SkillsSyncService
+
+
+class _FakeSandbox:
+    def __init__(self, sandbox_id: str = "", *, has_tar: bool = True) -> None:
+        self.id = sandbox_id
+        self.has_tar = has_tar
+        self.files: dict[str, bytes] = {}
+        self.commands: list[str] = []
+        self.upload_calls = 0
+
+    async def aexecute(self, cmd: str):
+        self.commands.append(cmd)
+        for part in cmd.split(" && "):
+            argv = shlex.split(part)
+            if argv[0] == "test":
+                return SimpleNamespace(exit_code=0 if argv[-1] in self.files else 1, output="")
+            if argv[0] == "cat":
+                return SimpleNamespace(exit_code=0, output=self.files.get(argv[1], b"").decode())
+            if argv[0] == "echo" and ">" in argv:
+                self.files[argv[-1]] = (argv[1] + "\n").encode()
+            if argv[0] == "rm":
+                self.files.pop(argv[-1], None)
+            if argv[0] == "tar":
+                if not self.has_tar:
+                    return SimpleNamespace(exit_code=127, output="tar: not found")
+                with tarfile.open(fileobj=io.BytesIO(self.files[argv[2]]), mode="r:gz") as tf:
+                    for member in tf.getmembers():
+                        self.files["/" + member.name] = tf.extractfile(member).read()
+        return SimpleNamespace(exit_code=0, output="")
+
+    async def aupload_files(self, files):
+        self.upload_calls += 1
+        self.files.update(files)
+        return [SimpleNamespace(path=path, error=None) for path, _ in files]
+
+
+def _make_skills(tmp_path):
+    skill_dir = tmp_path / "skills" / "skills" / "demo"
+    (skill_dir / "scripts").mkdir(parents=True)
+    (skill_dir / "SKILL.md").write_bytes(b"# demo")
+    (skill_dir / "scripts" / "run.py").write_bytes(b"print(1)")
+    (skill_dir / "image.png").write_bytes(b"\x89PNG")
+
+
+def _skill_files(sandbox: _FakeSandbox) -> dict[str, bytes]:
+    return {k: v for k, v in sandbox.files.items() if k.startswith("/workspace/skills/")}
+
+
+def test_sync_skills_should_upload_skill_files_as_single_archive(tmp_path):
+    _make_skills(tmp_path)
+
+    sandbox = _FakeSandbox()
+    result = asyncio.run(
+        SkillsSyncService(base_dir=tmp_path).sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-1")
+    )
+
+    assert result.uploaded_files == 2
+    assert sandbox.upload_calls == 1
+    assert _skill_files(sandbox) == {
+        "/workspace/skills/skills/demo/SKILL.md": b"# demo",
+        "/workspace/skills/skills/demo/scripts/run.py": b"print(1)",
+    }
+    assert "/workspace/.skills_synced" in sandbox.files
+    assert not any(path.endswith(".tgz") for path in sandbox.files)
+    # 哨兵探测 + 解压 + 自检，各一次沙箱往返
+    assert len(sandbox.commands) == 3
+
+
+def test_sync_skills_should_fallback_to_per_file_upload(tmp_path):
+    _make_skills(tmp_path)
+
+    sandbox = _FakeSandbox(has_tar=False)
+    result = asyncio.run(
+        SkillsSyncService(base_dir=tmp_path).sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-3")
+    )
+
+    assert result.uploaded_files == 2
+    assert "/workspace/skills/skills/demo/scripts/run.py" in sandbox.files
+    assert any(cmd.startswith("mkdir -p /workspace/skills/skills") for cmd in sandbox.commands)
+    assert "/workspace/.skills_synced" in sandbox.files
+
+
+def test_sync_skills_should_skip_when_sentinel_digest_matches(tmp_path):
+    _make_skills(tmp_path)
+    service = SkillsSyncService(base_dir=tmp_path)
+
+    sandbox = _FakeSandbox()
+    asyncio.run(service.sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-2"))
+    result = asyncio.run(service.sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-2"))
+
+    assert result.uploaded_files == 0
+    assert sandbox.upload_calls == 1
+
+
+def test_sync_skills_should_resync_when_local_skills_change(tmp_path):
+    _make_skills(tmp_path)
+    service = SkillsSyncService(base_dir=tmp_path)
+
+    sandbox = _FakeSandbox("sb-changed")
+    asyncio.run(service.sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-4"))
+    # 内容和大小都变化，缓存键失效
+    (tmp_path / "skills" / "skills" / "demo" / "SKILL.md").write_bytes(b"# demo v2")
+    result = asyncio.run(service.sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-4"))
+
+    assert result.uploaded_files == 2
+    assert sandbox.upload_calls == 2
+    assert sandbox.files["/workspace/skills/skills/demo/SKILL.md"] == b"# demo v2"
+
+
+def test_sync_skills_should_upload_per_file_in_concurrent_batches(tmp_path):
+    _make_skills(tmp_path)
+    extra_dir = tmp_path / "skills" / "skills" / "demo" / "docs"
+    extra_dir.mkdir()
+    for idx in range(10):
+        (extra_dir / f"doc{idx}.md").write_bytes(f"doc {idx}".encode())
+
+    class _FlakySandbox(_FakeSandbox):
+        batch_sizes: list[int] = []
+
+        async def aupload_files(self, files):
+            if not files[0][0].endswith(".tgz"):
+                self.batch_sizes.append(len(files))
+                if len(self.batch_sizes) == 2:
+                    raise RuntimeError("upload batch failed")
+            return await super().aupload_files(files)
+
+    sandbox = _FlakySandbox(has_tar=False)
+    result = asyncio.run(
+        SkillsSyncService(base_dir=tmp_path).sync_skills_to_sandbox(sandbox_backend=sandbox, session_id="s-5")
+    )
+
+    # 12 个文件按 8 个一批分成两批并发上传，第二批整体失败只影响该批内的文件
+    assert sandbox.batch_sizes == [8, 4]
+    assert result.uploaded_files == 8
+    assert result.uploaded_failed == 4
+
+
+def test_synced_sandbox_digests_should_evict_oldest_past_limit(monkeypatch):
+    from collections import OrderedDict
+
+    from backend.services import skills_sync_service
+
+    monkeypatch.setattr(skills_sync_service, "_synced_sandbox_digests", OrderedDict())
+    monkeypatch.setattr(skills_sync_service, "_SYNCED_SANDBOX_DIGESTS_MAX", 2)
+
+    skills_sync_service._remember_synced_sandbox("sb-1", "d1")
+    skills_sync_service._remember_synced_sandbox("sb-2", "d2")
+    skills_sync_service._remember_synced_sandbox("sb-1", "d1")
+    skills_sync_service._remember_synced_sandbox("sb-3", "d3")
+
+    assert list(skills_sync_service._synced_sandbox_digests) == ["sb-1", "sb-3"]
@@ -0,0 +1,48 @@
+import asyncio
+from dataclasses import dataclass, replace
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from backend.middleware.turn_context_middleware import TurnContextMiddleware
+
+
+@dataclass
+class _FakeRequest:
+    messages: list
+
+    def override(self, **kwargs):  # noqa: ANN003
+        return replace(self, **kwargs)
+
+
+def test_context_should_be_inserted_before_current_user_turn():
+    history = [
+        HumanMessage(content="上一轮问题"),
+        AIMessage(content="上一轮回答"),
+        HumanMessage(content="本轮问题"),
+        AIMessage(content="", tool_calls=[{"name": "rag_query", "args": {}, "id": "t1"}]),
+        ToolMessage(content="[]", tool_call_id="t1"),
+    ]
+    middleware = TurnContextMiddleware("<chat_memory>\nm\n</chat_memory>")
+    request = _FakeRequest(messages=history)
+
+    seen = middleware.wrap_model_call(request, lambda req: req)
+
+    assert [m.content for m in seen.messages[:4]] == [
+        "上一轮问题",
+        "上一轮回答",
+        "<chat_memory>\nm\n</chat_memory>",
+        "本轮问题",
+    ]
+    assert len(seen.messages) == len(history) + 1
+    # 原始请求（即 agent state）不应被修改
+    assert request.messages is history and len(history) == 5
+
+
+def test_empty_context_should_keep_request_untouched():
+    middleware = TurnContextMiddleware("")
+    request = _FakeRequest(messages=[HumanMessage(content="q")])
+
+    async def _handler(req):
+        return req
+
+    assert asyncio.run(middleware.awrap_model_call(request, _handler)) is request
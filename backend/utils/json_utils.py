@@ -0,0 +1,38 @@
+"""JSON 编解码工具。
+
+说明：
+- 优先使用 orjson（C 实现，流式热路径上明显更快），不可用时回退标准库 json
+- orjson.JSONDecodeError 继承自 json.JSONDecodeError，调用方统一捕获 json.JSONDecodeError 即可
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson 由 langsmith 间接依赖，一般都存在
+    orjson = None  # type: ignore[assignment]
+
+
+def json_loads(data: str | bytes) -> Any:
+    """解析 JSON 文本。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def sse_data_frame(event: Any) -> bytes:
+    """把事件编码成一帧 SSE（data: ...\\n\\n）。
+
+    说明：
+    - orjson 直接输出 UTF-8 bytes，等价于 json.dumps(ensure_ascii=False) 且省去一次 str->bytes 编码
+    - orjson 不支持的类型（例如超大整数）回退标准库，保持原有序列化行为
+    """
+    if orjson is not None:
+        try:
+            return b"data: " + orjson.dumps(event) + b"\n\n"
+        except TypeError:
+            pass
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")